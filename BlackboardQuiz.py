@@ -1,25 +1,95 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
+import contextlib
+import copy
+import functools
+import hashlib
+import importlib
+import inspect
 import itertools
+import json
 import os
 import random
 import re
+import runpy
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
 import time
+import traceback
 import uuid
 import zipfile
 from io import BytesIO, StringIO
 from xml.sax.saxutils import escape, unescape
 
-import lxml.html as html
-import scipy.stats
-import sympy
 from lxml import etree
-from PIL import Image
+
+
+class LazyModule:
+    """Stands in for a module which is slow to import (or is only needed
+    by some features), and only imports it when it is first used. Any
+    submodules given are imported along with it (e.g., scipy.stats, so
+    that scipy.stats works on the stand-in for scipy).
+    """
+    def __init__(self, name, *submodules):
+        self.__dict__['_name'] = name
+        self.__dict__['_submodules'] = submodules
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            for submodule in self._submodules:
+                importlib.import_module(submodule)
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+asyncio = LazyModule('asyncio')
+html = LazyModule('lxml.html')
+sympy = LazyModule('sympy')
+#Scripts used to get scipy.stats from here (BlackboardQuiz.scipy.stats)
+scipy = LazyModule('scipy', 'scipy.stats')
+Image = LazyModule('PIL.Image')
+bs4 = LazyModule('bs4')
+latex2mathml_converter = LazyModule('latex2mathml.converter')
+yaml = LazyModule('yaml')
+pyarrow = LazyModule('pyarrow')
+pyarrow_compute = LazyModule('pyarrow.compute')
+pyarrow_parquet = LazyModule('pyarrow.parquet')
 
 
 def roundSF(val, sf):
     return float('{:.{p}g}'.format(val, p=sf))
 
+def roundSF_array(values, sf):
+    """roundSF for a whole (numpy) array of values at once."""
+    import numpy as np
+    values = np.asarray(values, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        magnitude = np.floor(np.log10(np.abs(values)))
+    exponent = sf - 1 - np.where(np.isfinite(magnitude), magnitude, 0)
+    #Scaling by an exact power of ten (rather than 10**-n) keeps the
+    #results equal to those of roundSF, apart from values within
+    #rounding error of a tie (e.g., 2.675)
+    scale = 10.0 ** np.abs(exponent)
+    return np.where(exponent >= 0, np.round(values * scale) / scale, np.round(values / scale) * scale)
+
+def numq_bounds(answer, errfrac=None, erramt=None, errlow=None, errhigh=None):
+    """The bounds of a numerical question's answer (see Pool.addNumQ)."""
+    if errfrac is None and erramt is None and (errlow is None or errhigh is None):
+        raise Exception("Numerical questions require an error amount, fraction, or bounds")
+    if errfrac != None:
+        #Min max are required here as some questions may have negative answers
+        errlow = min(answer * (1-errfrac), answer * (1+errfrac))
+        errhigh = max(answer * (1-errfrac), answer * (1+errfrac))
+    if erramt != None:
+        errlow = answer - abs(erramt)
+        errhigh = answer + abs(erramt)
+    return errlow, errhigh
+
 def regexSF(val, sf):
     #This is not really functional. It will match floats but not with rounding restrictions!
     #Match the start of the string and any initial whitespace
@@ -50,15 +120,21 @@ def regexSF(val, sf):
 import subprocess
 
 dn = os.path.dirname(os.path.realpath(__file__))
+
+#The ways LaTeX formulas can be embedded (see Package)
+latex_modes = ('mathml', 'png', 'svg')
+
+# Set a default math environment to have amsmath
+default_preamble = r"""\documentclass[varwidth]{standalone}
+        \usepackage{amsmath,amsfonts}
+        \begin{document}"""
+
 def render_latex(formula, display, *args, **kwargs):
     """Renders LaTeX expression to bitmap image data.
     """
 
-    # Set a default math environment to have amsmath
     if 'preamble' not in kwargs:
-        kwargs['preamble'] = r"""\documentclass[varwidth]{standalone}
-        \usepackage{amsmath,amsfonts}
-        \begin{document}"""
+        kwargs['preamble'] = default_preamble
 
     try:
         if display:
@@ -77,14 +153,327 @@ def render_latex(formula, display, *args, **kwargs):
     del im
     return data, width, height
 
+class LatexRenderer:
+    """Renders LaTeX expressions to bitmap (png) or vector (svg) image
+    data, like render_latex, but much faster when rendering many
+    formulas.
+
+    The preamble is only loaded once, and is dumped into a precompiled
+    format file in a private working directory. Each formula still gets
+    its own latex process (fed the formula over its stdin pipe), and
+    its own dvipng/dvisvgm process, but latex starts from that format
+    instead of loading the preamble, so the per-formula cost is just
+    starting the processes and typesetting the formula. Nothing is kept
+    running between formulas, so a formula which fails to render can't
+    affect the next (and the format is rebuilt if it has been lost).
+    """
+    def __init__(self, preamble=default_preamble, dvioptions=['-D','125'], latex='latex', dvipng='dvipng', dvisvgm='dvisvgm', image_format='png'):
+        #The format is dumped before the document begins
+        self.preamble = preamble.replace(r'\begin{document}', '')
+        self.dvioptions = dvioptions
+        self.latex = latex
+        self.dvipng = dvipng
+        self.dvisvgm = dvisvgm
+        if image_format not in ('png', 'svg'):
+            raise ValueError("Unknown image_format "+repr(image_format)+" (expected png or svg)")
+        self.image_format = image_format
+        #svg sizes are in bp (1/72 inch), these are scaled to the pixel
+        #size the same formula would have as a png
+        self.dpi = 125
+        if '-D' in dvioptions:
+            self.dpi = float(dvioptions[list(dvioptions).index('-D')+1])
+        self.workdir = tempfile.mkdtemp(prefix='BlackboardQuiz_latex_')
+        self.format_name = 'preamble'
+        self.have_format = False
+        self.counter = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def run(self, args, input=None):
+        proc = subprocess.run(args, cwd=self.workdir, input=input, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        if proc.returncode != 0:
+            raise RuntimeError(repr(args[0])+" failed with output:\n"+proc.stdout)
+        return proc.stdout
+        
+    def dump_format(self):
+        with open(os.path.join(self.workdir, self.format_name+'.tex'), 'w') as f:
+            f.write(self.preamble+'\n\\dump\n')
+        self.run([self.latex, '-ini', '-interaction=nonstopmode', '-halt-on-error', '-jobname='+self.format_name, '&latex', self.format_name+'.tex'])
+        self.have_format = True
+
+    def render(self, formula, display):
+        """Renders the formula, returning the image data, and its width and
+        height in pixels.
+        """
+        if not self.have_format or not os.path.isfile(os.path.join(self.workdir, self.format_name+'.fmt')):
+            self.dump_format()
+
+        if display:
+            body = r'\begin{align*}'+formula.strip()+r'\end{align*}'
+        else:
+            body = '$'+formula+'$'
+
+        #latex takes its first line of input from stdin when it is not
+        #given a file, so the whole document must be on that one line.
+        self.counter += 1
+        jobname = 'eq'+str(self.counter)
+        document = r'\begin{document}'+body.replace('\n', ' ')+r'\end{document}'+'\n'
+        try:
+            self.run([self.latex, '-fmt='+self.format_name, '-interaction=nonstopmode', '-halt-on-error', '-jobname='+jobname], input=document)
+            if self.image_format == 'svg':
+                #Glyphs are converted to paths so the svg is self-contained
+                output = self.run([self.dvisvgm, '--no-fonts', '-o', jobname+'.svg', jobname+'.dvi'])
+            else:
+                output = self.run([self.dvipng]+list(self.dvioptions)+['--width', '--height', '-o', jobname+'.png', jobname+'.dvi'])
+            with open(os.path.join(self.workdir, jobname+'.'+self.image_format), 'rb') as f:
+                data = f.read()
+        except Exception as e:
+            print('ERROR: Failed rendering latex "'+formula.strip()+'"')
+            raise e
+        finally:
+            for ext in ('.dvi', '.log', '.aux', '.png', '.svg'):
+                try:
+                    os.remove(os.path.join(self.workdir, jobname+ext))
+                except OSError:
+                    pass
+
+        if self.image_format == 'svg':
+            #The size is in the viewBox of the root svg element (in bp)
+            match = re.search(rb'viewBox=[\'"]([-0-9.e ]+)[\'"]', data)
+            if match is None:
+                raise RuntimeError('Could not find the viewBox of the svg for "'+formula.strip()+'"')
+            _, _, width_bp, height_bp = [float(val) for val in match.group(1).split()]
+            return data, int(round(width_bp * self.dpi / 72)), int(round(height_bp * self.dpi / 72))
+        
+        #dvipng reports the image size, so there is no need to decode the image
+        match = re.search(r'height=(-?[0-9]+) width=(-?[0-9]+)', output)
+        if match:
+            return data, int(match.group(2)), int(match.group(1))
+        im = Image.open(BytesIO(data))
+        width, height = im.size
+        del im
+        return data, width, height
+
+def file_digest(filename, chunk_size=1 << 20):
+    """Returns the sha1 digest of a file, reading it in chunks."""
+    digest = hashlib.sha1()
+    with open(filename, mode='rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+def optimise_image(data, ext, max_size=None, format=None, quality=85):
+    """Downscales an image (so neither side is larger than max_size),
+    strips its metadata, and recompresses it, optionally converting it
+    to another format ('png', 'jpeg', or 'webp'). Returns the new image
+    data. This is a plain function so it can run in a process pool.
+    """
+    im = Image.open(BytesIO(data))
+    im.load()
+    if format is None:
+        format = {'.jpg':'jpeg', '.jpeg':'jpeg', '.webp':'webp'}.get(ext.lower(), 'png')
+    if max_size is not None and max(im.size) > max_size:
+        im.thumbnail((max_size, max_size), Image.LANCZOS)
+        
+    #Only the pixel data is written back out, so metadata (EXIF etc.) is dropped
+    if format == 'jpeg':
+        if im.mode not in ('RGB', 'L'):
+            im = im.convert('RGB')
+        options = {'quality':quality, 'optimize':True, 'progressive':True}
+    elif format == 'webp':
+        options = {'quality':quality, 'method':6}
+    else:
+        options = {'optimize':True}
+    out = BytesIO()
+    im.save(out, format=format.upper(), **options)
+    return out.getvalue()
+
+class ImageOptimiser:
+    """Optimises images as they are embedded in a package (pass one to
+    Package as image_optimiser). Images are processed in a pool of
+    workers while the rest of the package is built, and the results are
+    cached on disk by the hash of the original image and the settings,
+    so rebuilding a package only optimises new or changed images.
+
+    Without a format, only images which can be written back in their
+    own format are optimised. With one, bitmaps and TIFFs are converted
+    too. GIFs are always left alone, as they may be animated.
+
+    One optimiser may be shared by several packages. Close it (or use
+    it in a with block) to shut its workers down when done.
+    """
+    extensions = ('.png', '.jpg', '.jpeg', '.webp')
+    converted_extensions = ('.bmp', '.tif', '.tiff')
+    
+    def __init__(self, max_size=None, format=None, quality=85, cache_dir='.BlackboardQuiz_cache/images', workers=None, processes=False):
+        self.max_size = max_size
+        self.format = format
+        self.quality = quality
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        if processes:
+            self.executor = concurrent.futures.ProcessPoolExecutor(workers)
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.original_bytes = 0
+        self.optimised_bytes = 0
+        self.lock = threading.Lock()
+
+    def handles(self, filename):
+        ext = os.path.splitext(filename)[1].lower()
+        return ext in self.extensions or (self.format is not None and ext in self.converted_extensions)
+        
+    def output_name(self, filename):
+        """The filename of the image once it has been optimised."""
+        if self.format is None:
+            return filename
+        return os.path.splitext(filename)[0]+'.'+{'jpeg':'jpg'}.get(self.format, self.format)
+
+    def submit(self, filename, data):
+        """Starts optimising an image and returns a future for the new image data."""
+        ext = os.path.splitext(filename)[1]
+        key = hashlib.sha256(data + repr((ext.lower(), self.max_size, self.format, self.quality)).encode('utf-8')).hexdigest()
+        cache_file = None
+        if self.cache_dir is not None:
+            cache_file = os.path.join(self.cache_dir, key+os.path.splitext(self.output_name(filename))[1])
+            if os.path.isfile(cache_file):
+                with open(cache_file, 'rb') as f:
+                    future = concurrent.futures.Future()
+                    future.set_result(self.count(data, f.read()))
+                    return future
+                
+        future = concurrent.futures.Future()
+        def done(job):
+            try:
+                result = job.result()
+                #Keep the original if it can't be improved on (and doesn't need converting)
+                if self.format is None and len(result) >= len(data):
+                    result = data
+                if cache_file is not None:
+                    with open(cache_file, 'wb') as f:
+                        f.write(result)
+                future.set_result(self.count(data, result))
+            except Exception as e:
+                future.set_exception(e)
+        self.executor.submit(optimise_image, data, ext, self.max_size, self.format, self.quality).add_done_callback(done)
+        return future
+
+    def count(self, original, optimised):
+        with self.lock:
+            self.original_bytes += len(original)
+            self.optimised_bytes += len(optimised)
+        return optimised
+
+    def report(self):
+        """Prints how much the images have been shrunk since the last report."""
+        with self.lock:
+            original, optimised = self.original_bytes, self.optimised_bytes
+            self.original_bytes = self.optimised_bytes = 0
+        if original:
+            print("Optimised images from "+str(original)+" to "+str(optimised)+" bytes ("+'{:.1f}'.format(100.0 * optimised / original)+"%)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown()
+
+class HTMLBuffer:
+    """Collects the HTML of a preview a piece at a time. Adding to a
+    string over and over copies it each time, which gets very slow for
+    pools with many thousands of questions, so the pieces are only
+    joined when the HTML is used.
+    """
+    __slots__ = ('parts',)
+    
+    def __init__(self, text=''):
+        self.parts = [text]
+
+    def __iadd__(self, text):
+        self.parts.append(str(text))
+        return self
+
+    def __str__(self):
+        if len(self.parts) > 1:
+            self.parts = [''.join(self.parts)]
+        return self.parts[0]
+
+    def __add__(self, other):
+        return str(self) + other
+
+    def __radd__(self, other):
+        return other + str(self)
+
+class HTMLSpool(HTMLBuffer):
+    """An HTMLBuffer which keeps the HTML in a temporary file (once it
+    is larger than max_size), for the previews of deferred pools, so
+    the preview of a huge pool isn't held in memory while it is built.
+    """
+    __slots__ = ('file',)
+
+    def __init__(self, text='', max_size=8 << 20):
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_size, mode='w+', encoding='utf-8', newline='')
+        self.file.write(text)
+
+    def __iadd__(self, text):
+        self.file.write(str(text))
+        return self
+
+    def __str__(self):
+        self.file.seek(0)
+        text = self.file.read()
+        self.file.seek(0, 2)
+        return text
+
+    def write_to(self, f, chunk_size=1 << 20):
+        """Writes the HTML (encoded as UTF-8) to a binary file."""
+        self.file.seek(0)
+        for chunk in iter(lambda: self.file.read(chunk_size), ''):
+            f.write(chunk.encode('utf-8'))
+        self.file.seek(0, 2)
+    
 class BlackBoardObject:
 
     def setup_html(self, title):
-        self.htmlfile_head = "<html><head><style>li.correct {list-style-type:none; background-color: #e6ffcc;}\n li.incorrect{list-style-type:none; background-color:#ffcccc} li.correct:before{content:'\\2713\\0020'; color: darkgreen}\n li.incorrect:before{content:'\\2718\\0020'; color: red}\n li::marker { vertical-align: top; } .pool {border: 1px solid black; padding: 0.5em}\n .pool ul li {border-bottom:1px solid black; padding: 0.5em} </style></head><body>"
-        self.htmlfile_head += '<h1>'+title+'</h1><ol class="mainlist">'
-        self.htmlfile = ""
+        self.htmlfile_style = "<html><head><style>li.correct {list-style-type:none; background-color: #e6ffcc;}\n li.incorrect{list-style-type:none; background-color:#ffcccc} li.correct:before{content:'\\2713\\0020'; color: darkgreen}\n li.incorrect:before{content:'\\2718\\0020'; color: red}\n li::marker { vertical-align: top; } .pool {border: 1px solid black; padding: 0.5em}\n .pool ul li {border-bottom:1px solid black; padding: 0.5em} </style></head><body>"
+        self.htmlfile_title = title
+        self.htmlfile_head = self.htmlfile_style + '<h1>'+title+'</h1><ol class="mainlist">'
+        self.htmlfile = HTMLBuffer()
         self.htmlfile_tail = '</ol></body></html>'
     
+    def uuid(self):
+        """Returns a new unique identifier (as a hex string)."""
+        if self.package.deterministic:
+            return '{:032x}'.format(self.build_random.getrandbits(128))
+        return uuid.uuid4().hex
+
+    def object_id(self):
+        """Returns a new Blackboard object id (as used in bbmd_asi_object_id)."""
+        return '_'+str(self.package.bbid())+'_1'
+
+    def process_string(self, text):
+        """Processes the text of a question (see Package.process_string),
+        returning the versions for Blackboard and for the preview."""
+        return self.package.process_string(text)
+    
+    def uuids(self, count):
+        """Returns count new unique identifiers, drawn in one block."""
+        if self.package.deterministic:
+            return [self.uuid() for idx in range(count)]
+        block = os.urandom(16 * count).hex()
+        return [block[idx:idx+32] for idx in range(0, 32 * count, 32)]
+    
     def material(self, node, text):
         material = etree.SubElement(node, 'material')
         mat_extension = etree.SubElement(material, 'mat_extension')
@@ -94,7 +483,7 @@ class BlackBoardObject:
     def metadata(self, node, name='Assessment', typename='Pool', qtype='Multiple Choice', scoremax=0, weight=0, sectiontype='Subsection', instructor_notes='', partialcredit='false'):
         md = etree.SubElement(node, name.lower()+'metadata')
         for key, val in [
-                ('bbmd_asi_object_id', '_'+str(self.package.bbid())+'_1'),
+                ('bbmd_asi_object_id', self.object_id()),
                 ('bbmd_asitype', name),
                 ('bbmd_assessmenttype', typename),
                 ('bbmd_sectiontype', sectiontype),
@@ -115,19 +504,140 @@ class BlackBoardObject:
             etree.SubElement(md, key).text = val
         
         
+def live_arguments(method):
+    """Marks a method of Pool whose arguments are live objects (e.g.,
+    items still reading from a package or a question bank), so its
+    calls can't be recorded and run later (see recordable).
+    """
+    method.live_arguments = True
+    return method
+
+def recordable(method):
+    """Decorates the methods of Pool which add questions, so that they
+    are only recorded while a pool is being recorded (for the build
+    cache, or to build it when it is closed), so that a sharded pool
+    starts a new shard when the current one is full, so that a paged
+    preview is written a page at a time, and so that a question which
+    fails to be added leaves nothing behind.
+
+    Recorded calls are only run when the pool is closed, so their
+    arguments are checked against the method's signature straight
+    away, and copied, so changing them afterwards (e.g., reusing a
+    list of answers) doesn't change the questions. Calls which can't
+    be kept until then (see live_arguments, or ones whose arguments
+    can't be copied) stop the pool recording, so it is built as
+    normal (and isn't cached or deferred).
+    """
+    signature = inspect.signature(method)
+    recorded = not getattr(method, 'live_arguments', False)
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.recording is not None:
+            signature.bind(self, *args, **kwargs)
+            call = None
+            if recorded:
+                try:
+                    call = (method.__name__, copy.deepcopy(args), copy.deepcopy(kwargs))
+                except (TypeError, copy.Error):
+                    pass
+            if call is not None:
+                self.recording.append(call)
+                return
+            self.stop_recording()
+        if self.shard_full():
+            self.write_shard()
+        if self.page_size is None:
+            with self.adding_question():
+                result = method(self, *args, **kwargs)
+        else:
+            with self.preview_page(), self.adding_question():
+                result = method(self, *args, **kwargs)
+        self.count_shard()
+        return result
+    return wrapper
+
 class Pool(BlackBoardObject):
-    def __init__(self, pool_name, package, description="Created by BlackboardQuiz!", instructions="", preview=False, test=None, points_per_q=10, questions_per_test=1):
+    def __init__(self, pool_name, package, description="Created by BlackboardQuiz!", instructions="", preview=False, test=None, points_per_q=10, questions_per_test=1, max_items=None, max_bytes=None):
         """Initialises a question pool
+
+        Very large pools are slow to import and open in Blackboard. If
+        max_items or max_bytes (of question XML) is given, the pool is
+        split into several pools ("pool_name (1)", "pool_name (2)",
+        ...) of at most that size. Sharded pools are not build cached
+        (or deferred). A pool in a test can't be sharded (a ValueError
+        is raised): a random block draws a fixed number of questions
+        from one pool, so a test can't draw from the shards as it would
+        from the whole pool.
+
+        If the package has a preview_page_size, the preview of the pool
+        (if it, or its test, is previewed) is written in pages of that
+        many questions as they are added, with an index page.
         """
         self.package = package
         self.pool_name = pool_name
         self.preview = preview
+        #Each pool of a deterministic package has its own generators, so
+        #pools don't depend on what was generated before them. The
+        #values of generated questions are drawn from random, and the
+        #draws made while building the questions (identifiers and
+        #shuffles) from build_random, so the two don't depend on the
+        #order they are made in.
+        if package.deterministic:
+            self.random = random.Random(repr((package.seed, pool_name)))
+            self.build_random = random.Random(repr((package.seed, pool_name, 'build')))
+        else:
+            self.random = random
+            self.build_random = random
+
+        #With a build cache (or in a deferred package), the questions
+        #are only recorded until the pool is closed, when they are
+        #either built or reused from the cache
+        self.spec = [pool_name, description, instructions]
+        self.quiet = False
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        sharded = max_items is not None or max_bytes is not None
+        if sharded and test is not None:
+            raise ValueError("Pool "+repr(pool_name)+" is in a test, so it can't be split with max_items or max_bytes")
+        self.recording = [] if (package.build_cache is not None or package.deferred) and not sharded else None
+        #If set, a recorded question which fails to build when the pool
+        #is closed is skipped, and passed (its index in the recording,
+        #and the exception) to this, instead of raising
+        self.on_error = None
+        self.bbid_start = package.idcntr
         self.question_counter = 0
         self.test = test
         self.points_per_q = points_per_q
         self.questions_per_test = questions_per_test
-        
-        #Create the question data file
+
+        #The pool resources written so far, as (ref, question count)
+        self.shards = []
+        self.start_shard()
+        self.setup_html('Pool:' + pool_name)
+
+        #The paged preview: the pages written so far, the title, type
+        #and page of each question, and a random sample of the
+        #questions for the example test preview
+        self.page_size = None
+        if package.preview_page_size is not None and (preview or (test is not None and test.preview)):
+            self.page_size = package.preview_page_size
+        self.page_count = 0
+        self.pages = 0
+        self.page_index = []
+        self.page_sample = []
+        self.page_texts = None
+        if package.deterministic:
+            self.page_random = random.Random(repr((package.seed, pool_name, 'preview')))
+        else:
+            self.page_random = random
+
+    def start_shard(self):
+        """Creates the question data file for the pool (or the next
+        shard of it)
+        """
+        pool_name, description, instructions = self.spec
+        self.shard_count = 0
+        self.shard_size = 0
         self.questestinterop = etree.Element("questestinterop")
         assessment = etree.SubElement(self.questestinterop, 'assessment', {'title':self.pool_name})
 
@@ -145,7 +655,118 @@ class Pool(BlackBoardObject):
         
         self.metadata(self.section, 'Section', 'Pool', weight=0)
 
-        self.setup_html('Pool:' + pool_name)
+    def shard_full(self):
+        return (self.max_items is not None and self.shard_count >= self.max_items) or (self.max_bytes is not None and self.shard_size >= self.max_bytes)
+
+    def count_shard(self):
+        """Counts the question just added towards the current shard."""
+        self.shard_count += 1
+        if self.max_bytes is not None:
+            self.shard_size += len(etree.tostring(self.section[-1]))
+
+    def write_shard(self):
+        """Writes the current shard of the pool to the package, and
+        starts the next one.
+        """
+        title = self.pool_name+' ('+str(len(self.shards) + 1)+')'
+        self.questestinterop.find('assessment').set('title', title)
+        ref = self.package.embed_resource(title, "assessment/x-bb-qti-pool", self.questestinterop)
+        self.shards.append((ref, self.shard_count))
+        self.start_shard()
+
+    @contextlib.contextmanager
+    def adding_question(self):
+        """Adds a question (or questions) as a whole: if adding it fails,
+        its (partly built) items and preview are dropped.
+        """
+        #len() of an lxml element counts its children, so the last one
+        #is kept instead (the section always has its metadata)
+        last = self.section[-1]
+        question_counter = self.question_counter
+        preview, self.htmlfile = self.htmlfile, HTMLBuffer()
+        try:
+            yield
+            question = str(self.htmlfile)
+        except BaseException:
+            for item in list(last.itersiblings()):
+                self.section.remove(item)
+            self.question_counter = question_counter
+            raise
+        finally:
+            self.htmlfile = preview
+        self.htmlfile += question
+        
+    @contextlib.contextmanager
+    def preview_page(self):
+        """Collects the preview of the question being added, starting a
+        new page first if the current one is full. If adding the
+        question fails, its (partial) preview is dropped.
+        """
+        if self.page_count >= self.page_size:
+            self.write_page()
+        page, self.htmlfile = self.htmlfile, HTMLBuffer()
+        try:
+            yield
+            question = str(self.htmlfile)
+        finally:
+            self.htmlfile = page
+        self.htmlfile += question
+        self.page_count += 1
+        item = self.section[-1]
+        self.page_index.append((item.get('title'), item.findtext('itemmetadata/bbmd_questiontype'), self.pages + 1))
+
+        #Reservoir sampling, so the sample is kept as the questions are added
+        if len(self.page_sample) < self.questions_per_test:
+            self.page_sample.append(question)
+        else:
+            idx = self.page_random.randrange(len(self.page_index))
+            if idx < self.questions_per_test:
+                self.page_sample[idx] = question
+
+    def page_name(self, page):
+        return self.pool_name+'_page'+str(page)+'_preview.html'
+
+    def write_page(self, last=False):
+        """Writes the current page of the preview, and starts the next one."""
+        self.pages += 1
+        first = len(self.page_index) - self.page_count + 1
+        links = '<p><a href="'+escape(self.pool_name, {'"':'&quot;'})+'_preview.html">Index</a>'
+        if self.pages > 1:
+            links += ' <a href="'+escape(self.page_name(self.pages - 1), {'"':'&quot;'})+'">Previous</a>'
+        if not last:
+            links += ' <a href="'+escape(self.page_name(self.pages + 1), {'"':'&quot;'})+'">Next</a>'
+        links += '</p>'
+        text = self.htmlfile_style + '<h1>'+self.htmlfile_title+' (page '+str(self.pages)+')</h1>' + links + '<ol class="mainlist" start="'+str(first)+'">' + self.htmlfile + '</ol>' + links + '</body></html>'
+        self.package.zf.writestr(self.package.zipinfo(self.page_name(self.pages)), text)
+        if self.page_texts is not None:
+            self.page_texts.append(text)
+        self.htmlfile = HTMLBuffer()
+        self.page_count = 0
+
+    def write_preview_index(self):
+        """Writes the index page of a paged preview, with the number of
+        questions of each type, the pages, and a search of the question
+        titles.
+        """
+        counts = {}
+        for title, qtype, page in self.page_index:
+            counts[qtype] = counts.get(qtype, 0) + 1
+        text = self.htmlfile_style + '<h1>'+self.htmlfile_title+'</h1>'
+        text += '<p>'+str(len(self.page_index))+' questions, in '+str(self.pages)+' pages of '+str(self.page_size)+'.</p><table>'
+        for qtype, count in sorted(counts.items()):
+            text += '<tr><td>'+escape(qtype)+'</td><td>'+str(count)+'</td></tr>'
+        text += '</table><ol>'
+        for page in range(1, self.pages + 1):
+            last = min(page * self.page_size, len(self.page_index))
+            text += '<li><a href="'+escape(self.page_name(page), {'"':'&quot;'})+'">Questions '+str((page - 1) * self.page_size + 1)+' to '+str(last)+'</a></li>'
+        text += '</ol><p>Search titles: <input id="search" oninput="search()"></p><ol id="results"></ol>'
+        #The titles are searched in the browser, so the index stays small
+        questions = json.dumps([[title, page] for title, qtype, page in self.page_index]).replace('</', '<\\/')
+        text += '<script>var questions = '+questions+', pages = '+json.dumps([self.page_name(page) for page in range(1, self.pages + 1)]).replace('</', '<\\/')+';\n'
+        text += 'function search() {\n var term = document.getElementById("search").value.toLowerCase(), results = document.getElementById("results");\n results.innerHTML = "";\n if (!term) return;\n'
+        text += ' for (var idx = 0, found = 0; idx < questions.length && found < 100; idx++) {\n  if (questions[idx][0].toLowerCase().indexOf(term) < 0) continue;\n'
+        text += '  var li = document.createElement("li"), a = document.createElement("a");\n  a.href = pages[questions[idx][1] - 1]; a.textContent = questions[idx][0];\n  li.value = idx + 1; li.appendChild(a); results.appendChild(li); found++;\n }\n}\n</script></body></html>'
+        self.package.zf.writestr(self.package.zipinfo(self.pool_name+'_preview.html'), text)
         
     def __enter__(self):
         return self
@@ -154,23 +775,183 @@ class Pool(BlackBoardObject):
         self.close()
 
     def close(self):
-        if self.preview:
-            self.package.zf.writestr(self.pool_name+'_preview.html', self.htmlfile_head + self.htmlfile + self.htmlfile_tail)
-        ref = self.package.embed_resource(self.pool_name, "assessment/x-bb-qti-pool", '<?xml version="1.0" encoding="UTF-8"?>\n'+etree.tostring(self.questestinterop, pretty_print=False).decode('utf-8'))
+        data = None
+        if self.recording is not None and self.package.build_cache is not None:
+            data = self.build_cached()
+        elif self.recording is not None:
+            calls, self.recording = self.recording, None
+            data = self.build_deferred(calls)
+        
+        if self.page_size is not None:
+            if self.page_count or not self.pages:
+                self.write_page(last=True)
+            self.write_preview_index()
+        elif self.preview and hasattr(self.htmlfile, 'write_to'):
+            with self.package.zf.open(self.package.zipinfo(self.pool_name+'_preview.html'), mode='w') as f:
+                f.write(self.htmlfile_head.encode('utf-8'))
+                self.htmlfile.write_to(f, self.package.chunk_size)
+                f.write(self.htmlfile_tail.encode('utf-8'))
+        elif self.preview:
+            self.package.zf.writestr(self.package.zipinfo(self.pool_name+'_preview.html'), self.htmlfile_head + self.htmlfile + self.htmlfile_tail)
+        if hasattr(data, 'read'):
+            with data:
+                self.shards.append((self.package.embed_resource(self.pool_name, "assessment/x-bb-qti-pool", lambda f: shutil.copyfileobj(data, f, self.package.chunk_size)), self.question_counter))
+        elif data is not None:
+            self.shards.append((self.package.embed_resource(self.pool_name, "assessment/x-bb-qti-pool", data), self.question_counter))
+        elif not self.shards:
+            self.shards.append((self.package.embed_resource(self.pool_name, "assessment/x-bb-qti-pool", self.questestinterop), self.shard_count))
+        elif self.shard_count:
+            self.write_shard()
         
         if self.test is not None:
-            self.test.add_pool(self, ref)
+            self.test.add_pool(self, self.shards[0][0])
+        
+    def stop_recording(self):
+        """Builds the questions recorded so far, and stops recording, so
+        the rest of the pool is built as normal.
+        """
+        calls, self.recording = self.recording, None
+        for idx, (name, args, kwargs) in enumerate(calls):
+            self.replay(idx, name, args, kwargs)
+
+    def replay(self, idx, name, args, kwargs):
+        """Builds a recorded question."""
+        try:
+            getattr(self, name)(*args, **kwargs)
+        except Exception as e:
+            if self.on_error is None:
+                raise
+            self.on_error(idx, e)
+        
+    def build_deferred(self, calls):
+        """Builds the recorded questions one at a time, writing out the
+        XML of each question as soon as it is built, so only one
+        question's tree is ever in memory. The preview (unless it is
+        split into pages, which are written as they fill) is collected
+        in a temporary file too. Returns the pool's .dat data, as a
+        (spooled temporary) file.
+        """
+        if self.page_size is None:
+            self.htmlfile = HTMLSpool(str(self.htmlfile), self.package.stream_threshold)
+        self.package.canonicalise(self.questestinterop)
+        assessment = self.questestinterop.find('assessment')
+        data = tempfile.SpooledTemporaryFile(max_size=self.package.stream_threshold)
+        data.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+        with etree.xmlfile(data, encoding='us-ascii') as xf:
+            with xf.element('questestinterop'):
+                with xf.element('assessment', assessment.attrib):
+                    for element in assessment:
+                        if element is not self.section:
+                            xf.write(element)
+                    with xf.element('section'):
+                        for element in self.section:
+                            xf.write(element)
+                        start = len(self.section)
+                        for idx, (name, args, kwargs) in enumerate(calls):
+                            self.replay(idx, name, args, kwargs)
+                            for item in self.section[start:]:
+                                self.package.canonicalise(item)
+                                xf.write(item)
+                                self.section.remove(item)
+        data.seek(0)
+        return data
+
+    def build_cached(self):
+        """Builds the recorded questions, or reuses the pool from the
+        build cache if it is unchanged. Returns the pool's .dat data, or
+        None if the pool can't be cached (and was built as normal).
+        """
+        cache = self.package.build_cache
+        calls, self.recording = self.recording, None
+        key = cache.pool_key(self, calls)
+        if key is not None and self.reuse(key):
+            return self.data
+
+        #Build the questions, keeping track of the files they embed (and
+        #the preview pages they fill)
+        self.package.asset_log = []
+        self.package.latex_log = {}
+        if self.page_size is not None:
+            self.page_texts = []
+        try:
+            for idx, (name, args, kwargs) in enumerate(calls):
+                self.replay(idx, name, args, kwargs)
+            assets = self.package.asset_log
+            latex = self.package.latex_log
+        finally:
+            self.package.asset_log = None
+            self.package.latex_log = None
+        if key is None:
+            return None
+        
+        self.package.canonicalise(self.questestinterop)
+        self.data = b'<?xml version="1.0" encoding="UTF-8"?>\n' + etree.tostring(self.questestinterop)
+        cache.store(key, self, assets, latex)
+        return self.data
+
+    def reuse(self, key):
+        """Loads the pool from the build cache, moving its embedded files
+        and object ids over to this package.
+        """
+        cached = self.package.build_cache.load(key)
+        if cached is None:
+            return False
+        data, meta = cached
+
+        #Embed the pool's files again, and point the pool at them
+        xids = {}
+        paths = {}
+        for filename, digest, xid, path in meta['assets']:
+            new_xid, new_path = self.package.embed_file(filename, digest=bytes.fromhex(digest), source=self.package.build_cache.blob(digest))
+            xids[xid.encode('ascii')] = new_xid.encode('ascii')
+            paths[path] = new_path
+            
+        #The pool's equations are numbered in the order this package
+        #first uses them, just as if the pool had been built
+        for formula, display, digest, width_px, height_px, xid, path in meta['latex']:
+            if (formula, display) not in self.package.latex_cache:
+                self.package.embed_latex_image(formula, display, width_px, height_px, digest=bytes.fromhex(digest), source=self.package.build_cache.blob(digest))
+            self.package.log_latex(formula, display)
+            new_xid, new_path = self.package.latex_files[formula, display][3:5]
+            xids[xid.encode('ascii')] = new_xid.encode('ascii')
+            paths[path] = new_path
+            
+        data = re.sub(rb'bbcswebdav/xid-([0-9]+_1)', lambda match: b'bbcswebdav/xid-'+xids.get(match.group(1), match.group(1)), data)
+        if paths:
+            #All paths are swapped in one pass, so a new path is never
+            #mistaken for an old one
+            pattern = re.compile('|'.join(re.escape(path) for path in sorted(paths, key=len, reverse=True)))
+            def replace_paths(text):
+                return pattern.sub(lambda match: paths[match.group(0)], text)
+            meta['htmlfile'] = replace_paths(meta['htmlfile'])
+            meta['pages'] = [replace_paths(text) for text in meta['pages']]
+            meta['page_sample'] = [replace_paths(text) for text in meta['page_sample']]
+
+        #Shift the object ids into the range this pool would have used
+        start, count = meta['bbid_start'], meta['bbid_count']
+        def bbid_processor(match):
+            old = int(match.group(1))
+            if start < old <= start + count:
+                return b'<bbmd_asi_object_id>_'+str(old - start + self.bbid_start).encode('ascii')+b'_1</bbmd_asi_object_id>'
+            return match.group(0)
+        self.data = re.sub(rb'<bbmd_asi_object_id>_([0-9]+)_1</bbmd_asi_object_id>', bbid_processor, data)
+        self.package.idcntr = max(self.package.idcntr, self.bbid_start + count)
         
+        self.htmlfile = HTMLBuffer(meta['htmlfile'])
+        self.question_counter = meta['question_counter']
+        if self.page_size is not None:
+            for text in meta['pages']:
+                self.pages += 1
+                self.package.zf.writestr(self.package.zipinfo(self.page_name(self.pages)), text)
+            self.page_index = [tuple(entry) for entry in meta['page_index']]
+            self.page_sample = meta['page_sample']
+            self.page_count = len(self.page_index) - self.pages * self.page_size
+        print("Reused pool "+repr(self.pool_name)+" from the build cache")
+        return True
+    
+    @recordable
     def addNumQ(self, title, text, answer, errfrac=None, erramt=None, errlow=None, errhigh=None, positive_feedback="Good work", negative_feedback="That's not correct"):
-        if errfrac is None and erramt is None and (errlow is None or errhigh is None):
-            raise Exception("Numerical questions require an error amount, fraction, or bounds")
-        if errfrac != None:
-            #Min max are required here as some questions may have negative answers
-            errlow = min(answer * (1-errfrac), answer * (1+errfrac))
-            errhigh = max(answer * (1-errfrac), answer * (1+errfrac))
-        if erramt != None:
-            errlow = answer - abs(erramt)
-            errhigh = answer + abs(erramt)
+        errlow, errhigh = numq_bounds(answer, errfrac, erramt, errlow, errhigh)
         
         self.question_counter += 1
         question_id = 'q'+str(self.question_counter)
@@ -184,7 +965,7 @@ class Pool(BlackBoardObject):
         flow2 = etree.SubElement(flow1, 'flow', {'class':'QUESTION_BLOCK'})
         flow3 = etree.SubElement(flow2, 'flow', {'class':'FORMATTED_TEXT_BLOCK'})
 
-        bb_question_text, html_question_text = self.package.process_string(text)
+        bb_question_text, html_question_text = self.process_string(text)
         self.htmlfile += '<li>'+html_question_text+'<ul>'
         self.material(flow3, bb_question_text)
 
@@ -195,7 +976,7 @@ class Pool(BlackBoardObject):
         resprocessing = etree.SubElement(item, 'resprocessing', {'scoremodel':'SumOfScores'})
         outcomes = etree.SubElement(resprocessing, 'outcomes', {})
         decvar = etree.SubElement(outcomes, 'decvar', {'varname':'SCORE', 'vartype':'Decimal', 'defaultval':'0', 'minvalue':'0'})
-        respcondition = etree.SubElement(resprocessing, 'respcondition', {'title':uuid.uuid4().hex})
+        respcondition = etree.SubElement(resprocessing, 'respcondition', {'title':self.uuid()})
         conditionvar = etree.SubElement(respcondition, 'conditionvar')
         etree.SubElement(conditionvar, 'vargte', {'respident':'response'}).text = repr(errlow)
         etree.SubElement(conditionvar, 'varlte', {'respident':'response'}).text = repr(errhigh)
@@ -207,18 +988,19 @@ class Pool(BlackBoardObject):
         etree.SubElement(respcondition, 'setvar', {'variablename':'SCORE', 'action':'Set'}).text = '0'
         etree.SubElement(respcondition, 'displayfeedback', {'linkrefid':'incorrect', 'feedbacktype':'Response'})
         itemfeedback = etree.SubElement(item, 'itemfeedback', {'ident':'correct', 'view':'All'})
-        bb_pos_feedback_text, html_pos_feedback_text = self.package.process_string(positive_feedback)
+        bb_pos_feedback_text, html_pos_feedback_text = self.process_string(positive_feedback)
         self.flow_mat2(itemfeedback, bb_pos_feedback_text)
         
         itemfeedback = etree.SubElement(item, 'itemfeedback', {'ident':'incorrect', 'view':'All'})
-        bb_neg_feedback_text, html_neg_feedback_text = self.package.process_string(negative_feedback)
+        bb_neg_feedback_text, html_neg_feedback_text = self.process_string(negative_feedback)
         self.flow_mat2(itemfeedback, bb_neg_feedback_text)
                 
         self.htmlfile += '<li class="correct"><b>'+repr(errlow)+' &le; Answer &le; '+repr(errhigh)+'</b>:'+html_pos_feedback_text+'</li>'
         self.htmlfile += '<li class="incorrect"><b>Else</b>:'+html_neg_feedback_text+'</li>'
         self.htmlfile += '</ul></li>'
-        print("Added NumQ "+repr(title))
+        self.added("NumQ", title)
         
+    @recordable
     def addMCQ(self, title, text, answers, correct=0, positive_feedback="Good work", negative_feedback="That's not correct", shuffle_ans=True):
         
         self.question_counter += 1 
@@ -227,7 +1009,7 @@ class Pool(BlackBoardObject):
         item = etree.SubElement(self.section, 'item', {'title':title, 'maxattempts':'0'})
         md = etree.SubElement(item, 'itemmetadata')
         for key, val in [
-                ('bbmd_asi_object_id', '_'+str(self.package.bbid())+'_1'),
+                ('bbmd_asi_object_id', self.object_id()),
                 ('bbmd_asitype', 'Item'),
                 ('bbmd_assessmenttype', 'Pool'),
                 ('bbmd_sectiontype', 'Subsection'),
@@ -252,7 +1034,7 @@ class Pool(BlackBoardObject):
         flow2 = etree.SubElement(flow1, 'flow', {'class':'QUESTION_BLOCK'})
         flow3 = etree.SubElement(flow2, 'flow', {'class':'FORMATTED_TEXT_BLOCK'})
 
-        bb_question_text, html_question_text = self.package.process_string(text)
+        bb_question_text, html_question_text = self.process_string(text)
         self.htmlfile += '<li>'+html_question_text+'<ul>'
         self.material(flow3, bb_question_text)
 
@@ -263,9 +1045,9 @@ class Pool(BlackBoardObject):
         a_uuids = []
         for idx,text in enumerate(answers):
             flow_label = etree.SubElement(render_choice, 'flow_label', {'class':'Block'})
-            a_uuids.append(uuid.uuid4().hex)
+            a_uuids.append(self.uuid())
             response_label = etree.SubElement(flow_label, 'response_label', {'ident':a_uuids[-1], 'shuffle':'Yes', 'rarea':'Ellipse', 'rrange':'Exact'})
-            bb_answer_text, html_answer_text = self.package.process_string(text)
+            bb_answer_text, html_answer_text = self.process_string(text)
             self.flow_mat1(response_label, bb_answer_text)
             classname="incorrect"
             if idx == correct:
@@ -297,11 +1079,11 @@ class Pool(BlackBoardObject):
             etree.SubElement(respcondition, 'displayfeedback', {'linkrefid':luuid, 'feedbacktype':'Response'})
         
         itemfeedback = etree.SubElement(item, 'itemfeedback', {'ident':'correct', 'view':'All'})
-        bb_pos_feedback_text, html_pos_feedback_text = self.package.process_string(positive_feedback)
+        bb_pos_feedback_text, html_pos_feedback_text = self.process_string(positive_feedback)
         self.flow_mat2(itemfeedback, bb_pos_feedback_text)
         
         itemfeedback = etree.SubElement(item, 'itemfeedback', {'ident':'incorrect', 'view':'All'})
-        bb_neg_feedback_text, html_neg_feedback_text = self.package.process_string(negative_feedback)
+        bb_neg_feedback_text, html_neg_feedback_text = self.process_string(negative_feedback)
         self.flow_mat2(itemfeedback, bb_neg_feedback_text)
 
         for idx, luuid in enumerate(a_uuids):
@@ -315,8 +1097,9 @@ class Pool(BlackBoardObject):
             self.htmlfile += '<div>+:'+html_pos_feedback_text+'</div>'
             self.htmlfile += '<div>-:'+html_neg_feedback_text+'</div>'
         self.htmlfile += '</li>'
-        print("Added MCQ "+repr(title))
+        self.added("MCQ", title)
     
+    @recordable
     def addMAQ(self, title, text, answers, correct=[0], positive_feedback="Good work", negative_feedback="That's not correct", shuffle_ans=True, weights=None):
         # BH: added this
         # correct -> a list with the indices of the correct solutions
@@ -338,7 +1121,7 @@ class Pool(BlackBoardObject):
         item = etree.SubElement(self.section, 'item', {'title':title, 'maxattempts':'0'})
         md = etree.SubElement(item, 'itemmetadata')
         for key, val in [
-                ('bbmd_asi_object_id', '_'+str(self.package.bbid())+'_1'),
+                ('bbmd_asi_object_id', self.object_id()),
                 ('bbmd_asitype', 'Item'),
                 ('bbmd_assessmenttype', 'Pool'),
                 ('bbmd_sectiontype', 'Subsection'),
@@ -363,7 +1146,7 @@ class Pool(BlackBoardObject):
         flow2 = etree.SubElement(flow1, 'flow', {'class':'QUESTION_BLOCK'})
         flow3 = etree.SubElement(flow2, 'flow', {'class':'FORMATTED_TEXT_BLOCK'})
 
-        bb_question_text, html_question_text = self.package.process_string(text)
+        bb_question_text, html_question_text = self.process_string(text)
         self.htmlfile += '<li>'+html_question_text+'\n<ul>'
         self.material(flow3, bb_question_text)
 
@@ -374,9 +1157,9 @@ class Pool(BlackBoardObject):
         a_uuids = []
         for idx,text in enumerate(answers):
             flow_label = etree.SubElement(render_choice, 'flow_label', {'class':'Block'})
-            a_uuids.append(uuid.uuid4().hex)
+            a_uuids.append(self.uuid())
             response_label = etree.SubElement(flow_label, 'response_label', {'ident':a_uuids[-1], 'shuffle':'Yes', 'rarea':'Ellipse', 'rrange':'Exact'})
-            bb_answer_text, html_answer_text = self.package.process_string(text)
+            bb_answer_text, html_answer_text = self.process_string(text)
             self.flow_mat1(response_label, bb_answer_text)
             classname = "correct" if idx in correct else "incorrect"
             self.htmlfile += '\n<li class="'+classname+'">'+html_answer_text+'</li>\n'
@@ -411,11 +1194,11 @@ class Pool(BlackBoardObject):
             #etree.SubElement(respcondition, 'displayfeedback', {'linkrefid':luuid, 'feedbacktype':'Response'}) # leave out
         
         itemfeedback = etree.SubElement(item, 'itemfeedback', {'ident':'correct', 'view':'All'})
-        bb_pos_feedback_text, html_pos_feedback_text = self.package.process_string(positive_feedback)
+        bb_pos_feedback_text, html_pos_feedback_text = self.process_string(positive_feedback)
         self.flow_mat2(itemfeedback, bb_pos_feedback_text)
         
         itemfeedback = etree.SubElement(item, 'itemfeedback', {'ident':'incorrect', 'view':'All'})
-        bb_neg_feedback_text, html_neg_feedback_text = self.package.process_string(negative_feedback)
+        bb_neg_feedback_text, html_neg_feedback_text = self.process_string(negative_feedback)
         self.flow_mat2(itemfeedback, bb_neg_feedback_text)
 
         for idx, luuid in enumerate(a_uuids):
@@ -429,8 +1212,9 @@ class Pool(BlackBoardObject):
             self.htmlfile += '\n<div>+:'+html_pos_feedback_text+'</div>'
             self.htmlfile += '\n<div>-:'+html_neg_feedback_text+'</div>'
         self.htmlfile += '\n</li>'
-        print("Added MAQ "+repr(title))
+        self.added("MAQ", title)
             
+    @recordable
     def addSRQ(self, title, text, answer='', positive_feedback="Good work", negative_feedback="That's not correct", rows=3, maxchars=0):
         # BH: added this, need thorough testing...
         # answers - an optional sample answer
@@ -443,7 +1227,7 @@ class Pool(BlackBoardObject):
         item = etree.SubElement(self.section, 'item', {'title':title, 'maxattempts':'0'})
         md = etree.SubElement(item, 'itemmetadata')
         for key, val in [
-                ('bbmd_asi_object_id', '_'+str(self.package.bbid())+'_1'),
+                ('bbmd_asi_object_id', self.object_id()),
                 ('bbmd_asitype', 'Item'),
                 ('bbmd_assessmenttype', 'Pool'),
                 ('bbmd_sectiontype', 'Subsection'),
@@ -468,7 +1252,7 @@ class Pool(BlackBoardObject):
         flow2 = etree.SubElement(flow1, 'flow', {'class':'QUESTION_BLOCK'})
         flow3 = etree.SubElement(flow2, 'flow', {'class':'FORMATTED_TEXT_BLOCK'})
 
-        bb_question_text, html_question_text = self.package.process_string(text)
+        bb_question_text, html_question_text = self.process_string(text)
         self.htmlfile += '<li>'+html_question_text+'<ul>'
         self.material(flow3, bb_question_text)
 
@@ -491,18 +1275,18 @@ class Pool(BlackBoardObject):
         etree.SubElement(respcondition, 'displayfeedback', {'linkrefid':'incorrect', 'feedbacktype':'Response'})
         
         itemfeedback = etree.SubElement(item, 'itemfeedback', {'ident':'correct', 'view':'All'})
-        bb_pos_feedback_text, html_pos_feedback_text = self.package.process_string(positive_feedback)
+        bb_pos_feedback_text, html_pos_feedback_text = self.process_string(positive_feedback)
         self.flow_mat2(itemfeedback, bb_pos_feedback_text)
         
         itemfeedback = etree.SubElement(item, 'itemfeedback', {'ident':'incorrect', 'view':'All'})
-        bb_neg_feedback_text, html_neg_feedback_text = self.package.process_string(negative_feedback)
+        bb_neg_feedback_text, html_neg_feedback_text = self.process_string(negative_feedback)
         self.flow_mat2(itemfeedback, bb_neg_feedback_text)
         
         itemfeedback = etree.SubElement(item, 'itemfeedback', {'ident':'solution', 'view':'All'})
         solution = etree.SubElement(itemfeedback, 'solution', {'view':'All', 'feedbackstyle':'Complete'})
         solutionmaterial = etree.SubElement(solution, 'solutionmaterial')
         flow = etree.SubElement(solutionmaterial, 'flow_mat', {'class':'Block'})
-        bb_answer_text, html_answer_text = self.package.process_string(answer)
+        bb_answer_text, html_answer_text = self.process_string(answer)
         self.material(flow,bb_answer_text)
         self.htmlfile += '<li class="correct">Sample answer: '+html_answer_text+'</li>'
                 
@@ -511,8 +1295,9 @@ class Pool(BlackBoardObject):
             self.htmlfile += '<div>+:'+html_pos_feedback_text+'</div>'
             self.htmlfile += '<div>-:'+html_neg_feedback_text+'</div>'
         self.htmlfile += '</li>'
-        print("Added SRQ "+repr(title)) ## changed
+        self.added("SRQ", title)
             
+    @recordable
     def addTFQ(self, title, text, istrue=True, positive_feedback="Good work", negative_feedback="That's not correct"):
         # BH: added this, need thorough testing...
         
@@ -522,7 +1307,7 @@ class Pool(BlackBoardObject):
         item = etree.SubElement(self.section, 'item', {'title':title, 'maxattempts':'0'})
         md = etree.SubElement(item, 'itemmetadata')
         for key, val in [
-                ('bbmd_asi_object_id', '_'+str(self.package.bbid())+'_1'),
+                ('bbmd_asi_object_id', self.object_id()),
                 ('bbmd_asitype', 'Item'),
                 ('bbmd_assessmenttype', 'Pool'),
                 ('bbmd_sectiontype', 'Subsection'),
@@ -547,7 +1332,7 @@ class Pool(BlackBoardObject):
         flow2 = etree.SubElement(flow1, 'flow', {'class':'QUESTION_BLOCK'})
         flow3 = etree.SubElement(flow2, 'flow', {'class':'FORMATTED_TEXT_BLOCK'})
 
-        bb_question_text, html_question_text = self.package.process_string(text)
+        bb_question_text, html_question_text = self.process_string(text)
         self.htmlfile += '<li>'+html_question_text+'<ul>'
         self.material(flow3, bb_question_text)
 
@@ -579,11 +1364,11 @@ class Pool(BlackBoardObject):
         self.htmlfile += '<li class="correct">'+('True' if istrue else 'False')+'</li>'
         
         itemfeedback = etree.SubElement(item, 'itemfeedback', {'ident':'correct', 'view':'All'})
-        bb_pos_feedback_text, html_pos_feedback_text = self.package.process_string(positive_feedback)
+        bb_pos_feedback_text, html_pos_feedback_text = self.process_string(positive_feedback)
         self.flow_mat2(itemfeedback, bb_pos_feedback_text)
         
         itemfeedback = etree.SubElement(item, 'itemfeedback', {'ident':'incorrect', 'view':'All'})
-        bb_neg_feedback_text, html_neg_feedback_text = self.package.process_string(negative_feedback)
+        bb_neg_feedback_text, html_neg_feedback_text = self.process_string(negative_feedback)
         self.flow_mat2(itemfeedback, bb_neg_feedback_text)
                 
         self.htmlfile += '</ul>'
@@ -591,8 +1376,9 @@ class Pool(BlackBoardObject):
             self.htmlfile += '<div>+:'+html_pos_feedback_text+'</div>'
             self.htmlfile += '<div>-:'+html_neg_feedback_text+'</div>'
         self.htmlfile += '</li>'
-        print("Added TFQ "+repr(title)) ## changed
+        self.added("TFQ", title)
     
+    @recordable
     def addOQ(self, title, text, answers, positive_feedback="Good work", negative_feedback="That's not correct", shuffle_inds=None):
         # BH: added this, needs thorough testing...
         # The provided order of answers is assumed to be the correct order.
@@ -601,7 +1387,7 @@ class Pool(BlackBoardObject):
         
         if shuffle_inds is None:
             shuffle_inds = list(range(len(answers)))
-            random.shuffle(shuffle_inds) # in-place
+            self.build_random.shuffle(shuffle_inds) # in-place
         
         self.question_counter += 1
         question_id = 'q'+str(self.question_counter)
@@ -609,7 +1395,7 @@ class Pool(BlackBoardObject):
         item = etree.SubElement(self.section, 'item', {'title':title, 'maxattempts':'0'})
         md = etree.SubElement(item, 'itemmetadata')
         for key, val in [
-                ('bbmd_asi_object_id', '_'+str(self.package.bbid())+'_1'),
+                ('bbmd_asi_object_id', self.object_id()),
                 ('bbmd_asitype', 'Item'),
                 ('bbmd_assessmenttype', 'Pool'),
                 ('bbmd_sectiontype', 'Subsection'),
@@ -634,7 +1420,7 @@ class Pool(BlackBoardObject):
         flow2 = etree.SubElement(flow1, 'flow', {'class':'QUESTION_BLOCK'})
         flow3 = etree.SubElement(flow2, 'flow', {'class':'FORMATTED_TEXT_BLOCK'})
 
-        bb_question_text, html_question_text = self.package.process_string(text)
+        bb_question_text, html_question_text = self.process_string(text)
         self.htmlfile += '<li>'+html_question_text+'<ol>'
         self.material(flow3, bb_question_text)
 
@@ -642,11 +1428,11 @@ class Pool(BlackBoardObject):
         response_lid = etree.SubElement(flow2, 'response_lid', {'ident':'response', 'rcardinality':'Ordered', 'rtiming':'No'})
         render_choice = etree.SubElement(response_lid, 'render_choice', {'shuffle':'No', 'minnumber':'0', 'maxnumber':'0'}) # can shuffle be changed to Yes?
 
-        a_uuids = [uuid.uuid4().hex for _ in range(len(answers))]
+        a_uuids = [self.uuid() for _ in range(len(answers))]
         for idx in shuffle_inds:
             flow_label = etree.SubElement(render_choice, 'flow_label', {'class':'Block'})
             response_label = etree.SubElement(flow_label, 'response_label', {'ident':a_uuids[idx], 'shuffle':'Yes', 'rarea':'Ellipse', 'rrange':'Exact'})
-            bb_answer_text, html_answer_text = self.package.process_string(answers[idx])
+            bb_answer_text, html_answer_text = self.process_string(answers[idx])
             self.flow_mat1(response_label, bb_answer_text)
             self.htmlfile += '<li value='+str(idx+1)+'>'+html_answer_text+'</li>'
             
@@ -669,11 +1455,11 @@ class Pool(BlackBoardObject):
         etree.SubElement(respcondition, 'displayfeedback', {'linkrefid':'incorrect', 'feedbacktype':'Response'})
         
         itemfeedback = etree.SubElement(item, 'itemfeedback', {'ident':'correct', 'view':'All'})
-        bb_pos_feedback_text, html_pos_feedback_text = self.package.process_string(positive_feedback)
+        bb_pos_feedback_text, html_pos_feedback_text = self.process_string(positive_feedback)
         self.flow_mat2(itemfeedback, bb_pos_feedback_text)
         
         itemfeedback = etree.SubElement(item, 'itemfeedback', {'ident':'incorrect', 'view':'All'})
-        bb_neg_feedback_text, html_neg_feedback_text = self.package.process_string(negative_feedback)
+        bb_neg_feedback_text, html_neg_feedback_text = self.process_string(negative_feedback)
         self.flow_mat2(itemfeedback, bb_neg_feedback_text)
         
         self.htmlfile += '</ol>'
@@ -681,8 +1467,9 @@ class Pool(BlackBoardObject):
             self.htmlfile += '<div>+:'+html_pos_feedback_text+'</div>'
             self.htmlfile += '<div>-:'+html_neg_feedback_text+'</div>'
         self.htmlfile += '</li>'
-        print("Added OQ "+repr(title))
+        self.added("OQ", title)
     
+    @recordable
     def addMQ(self, title, text, answer_pairs, unmatched=[], positive_feedback="Good work", negative_feedback="That's not correct", neg_weight=0):
         # BH: added this, needs thorough testing... this is somewhat complex...
         # TODO: consider how the question is displayed this in the html file
@@ -696,7 +1483,7 @@ class Pool(BlackBoardObject):
         item = etree.SubElement(self.section, 'item', {'title':title, 'maxattempts':'0'})
         md = etree.SubElement(item, 'itemmetadata')
         for key, val in [
-                ('bbmd_asi_object_id', '_'+str(self.package.bbid())+'_1'),
+                ('bbmd_asi_object_id', self.object_id()),
                 ('bbmd_asitype', 'Item'),
                 ('bbmd_assessmenttype', 'Pool'),
                 ('bbmd_sectiontype', 'Subsection'),
@@ -721,7 +1508,7 @@ class Pool(BlackBoardObject):
         flow2 = etree.SubElement(flow1, 'flow', {'class':'QUESTION_BLOCK'})
         flow3 = etree.SubElement(flow2, 'flow', {'class':'FORMATTED_TEXT_BLOCK'})
 
-        bb_question_text, html_question_text = self.package.process_string(text)
+        bb_question_text, html_question_text = self.process_string(text)
         self.htmlfile += '<li>'+html_question_text+'<ol>'
         self.material(flow3, bb_question_text)
 
@@ -731,30 +1518,30 @@ class Pool(BlackBoardObject):
         for idx,pair in enumerate(answer_pairs):
             # need a uuid here (in place of 'response')
             flow3 = etree.SubElement(flow2, 'flow', {'class':'Block'})
-            a_uuids.append(uuid.uuid4().hex)
+            a_uuids.append(self.uuid())
             response_lid = etree.SubElement(flow3, 'response_lid', {'ident':a_uuids[-1], 'rcardinality':'Single', 'rtiming':'No'})
             render_choice = etree.SubElement(response_lid, 'render_choice', {'shuffle':'Yes', 'minnumber':'0', 'maxnumber':'0'})
             flow_label = etree.SubElement(render_choice, 'flow_label', {'class':'Block'})
             b_uuids = []
             for _ in answer_pairs+unmatched:
-                b_uuids.append(uuid.uuid4().hex)
+                b_uuids.append(self.uuid())
                 response_label = etree.SubElement(flow_label, 'response_label', {'ident':b_uuids[-1], 'shuffle':'Yes', 'rarea':'Ellipse', 'rrange':'Exact'})
             sub_uuids.append(b_uuids)
-            bb_answer_text, html_answer_text = self.package.process_string(pair[0])
+            bb_answer_text, html_answer_text = self.process_string(pair[0])
             flow4 = etree.SubElement(flow3, 'flow', {'class':'FORMATTED_TEXT_BLOCK'})
             self.material(flow4, bb_answer_text)
             self.htmlfile += '<li value='+str(idx+1)+'>'+html_answer_text+'</li>'
-            bb_answer_text, html_answer_text = self.package.process_string(pair[1])
+            bb_answer_text, html_answer_text = self.process_string(pair[1])
             self.htmlfile += '<li class="correct">'+html_answer_text+'</li>'
             
         flow2 = etree.SubElement(flow1, 'flow', {'class':'RIGHT_MATCH_BLOCK'})
         for idx,pair in enumerate(answer_pairs):
-            bb_right_match_text, html_right_match_text = self.package.process_string(pair[1])
+            bb_right_match_text, html_right_match_text = self.process_string(pair[1])
             flow3 = etree.SubElement(flow2, 'flow', {'class':'Block'})
             flow4 = etree.SubElement(flow3, 'flow', {'class':'FORMATTED_TEXT_BLOCK'})
             self.material(flow4, bb_right_match_text)
         for text in unmatched:
-            bb_right_match_text, html_right_match_text = self.package.process_string(text)
+            bb_right_match_text, html_right_match_text = self.process_string(text)
             flow3 = etree.SubElement(flow2, 'flow', {'class':'Block'})
             flow4 = etree.SubElement(flow3, 'flow', {'class':'FORMATTED_TEXT_BLOCK'})
             self.material(flow4, bb_right_match_text)
@@ -780,11 +1567,11 @@ class Pool(BlackBoardObject):
         etree.SubElement(respcondition, 'displayfeedback', {'linkrefid':'incorrect', 'feedbacktype':'Response'})
         
         itemfeedback = etree.SubElement(item, 'itemfeedback', {'ident':'correct', 'view':'All'})
-        bb_pos_feedback_text, html_pos_feedback_text = self.package.process_string(positive_feedback)
+        bb_pos_feedback_text, html_pos_feedback_text = self.process_string(positive_feedback)
         self.flow_mat2(itemfeedback, bb_pos_feedback_text)
         
         itemfeedback = etree.SubElement(item, 'itemfeedback', {'ident':'incorrect', 'view':'All'})
-        bb_neg_feedback_text, html_neg_feedback_text = self.package.process_string(negative_feedback)
+        bb_neg_feedback_text, html_neg_feedback_text = self.process_string(negative_feedback)
         self.flow_mat2(itemfeedback, bb_neg_feedback_text)
         
         self.htmlfile += '</ol>'
@@ -792,14 +1579,15 @@ class Pool(BlackBoardObject):
             self.htmlfile += '<div>+:'+html_pos_feedback_text+'</div>'
             self.htmlfile += '<div>-:'+html_neg_feedback_text+'</div>'
         self.htmlfile += '</li>'
-        print("Added MQ "+repr(title))
+        self.added("MQ", title)
 
+    @recordable
     def addFITBQ(self, title, text, answers, positive_feedback="Good work", negative_feedback="That's not correct"):
         """Fill in the blank questions"""
         item = etree.SubElement(self.section, 'item', {'title':title, 'maxattempts':'0'})
         md = etree.SubElement(item, 'itemmetadata')
         for key, val in [
-                ('bbmd_asi_object_id', '_'+str(self.package.bbid())+'_1'),
+                ('bbmd_asi_object_id', self.object_id()),
                 ('bbmd_asitype', 'Item'),
                 ('bbmd_assessmenttype', 'Pool'),
                 ('bbmd_sectiontype', 'Subsection'),
@@ -823,7 +1611,7 @@ class Pool(BlackBoardObject):
         flow1 = etree.SubElement(presentation, 'flow', {'class':'Block'})
         flow2 = etree.SubElement(flow1, 'flow', {'class':'QUESTION_BLOCK'})
         flow3 = etree.SubElement(flow2, 'flow', {'class':'FORMATTED_TEXT_BLOCK'})
-        bb_question_text, html_question_text = self.package.process_string(text)
+        bb_question_text, html_question_text = self.process_string(text)
         self.htmlfile += '<li>'+html_question_text+'<ul>'
         self.material(flow3, bb_question_text)
 
@@ -854,11 +1642,11 @@ class Pool(BlackBoardObject):
         etree.SubElement(respcondition, 'displayfeedback', {'linkrefid':'incorrect', 'feedbacktype':'Response'})
         
         itemfeedback = etree.SubElement(item, 'itemfeedback', {'ident':'correct', 'view':'All'})
-        bb_pos_feedback_text, html_pos_feedback_text = self.package.process_string(positive_feedback)
+        bb_pos_feedback_text, html_pos_feedback_text = self.process_string(positive_feedback)
         self.flow_mat2(itemfeedback, bb_pos_feedback_text)
         
         itemfeedback = etree.SubElement(item, 'itemfeedback', {'ident':'incorrect', 'view':'All'})
-        bb_neg_feedback_text, html_neg_feedback_text = self.package.process_string(negative_feedback)
+        bb_neg_feedback_text, html_neg_feedback_text = self.process_string(negative_feedback)
         self.flow_mat2(itemfeedback, bb_neg_feedback_text)
         
         self.htmlfile += '</ul>'
@@ -866,7 +1654,7 @@ class Pool(BlackBoardObject):
             self.htmlfile += '<div>+:'+html_pos_feedback_text+'</div>'
             self.htmlfile += '<div>-:'+html_neg_feedback_text+'</div>'
         self.htmlfile += '</li>'
-        print("Added FITBQ "+repr(title))
+        self.added("FITBQ", title)
 
     def addCalcNumQ(self, title, text, xs, count, calc, 
                     errfrac=None, erramt=None, errlow=None, errhigh=None, 
@@ -875,7 +1663,6 @@ class Pool(BlackBoardObject):
                     ):
         
         if validation is not None:
-            import copy
             result = calc(copy.deepcopy(validation))
             divisor = validation['answer'] if validation['answer'] != 0 else 1
             err = abs((result['answer'] - validation['answer']) / divisor)
@@ -891,9 +1678,11 @@ class Pool(BlackBoardObject):
             # Calculate all random variables
             for xk in xs:
                 if hasattr(xs[xk][0], 'rvs'):
-                    x[xk] =  roundSF(xs[xk][0].rvs(1)[0], xs[xk][1]) #round to given S.F.
+                    #Seed scipy from the pool's generator, so that seeding
+                    #it (or the random module) fixes the questions
+                    x[xk] =  roundSF(xs[xk][0].rvs(1, random_state=self.random.getrandbits(32))[0], xs[xk][1]) #round to given S.F.
                 elif isinstance(xs[xk][0], list):
-                    x[xk] = random.choice(xs[xk][0]) #Random choice from list
+                    x[xk] = self.random.choice(xs[xk][0]) #Random choice from list
                 else:
                     raise RuntimeError("Unrecognised distribution/list for the question")
 
@@ -911,8 +1700,11 @@ class Pool(BlackBoardObject):
             t = text
             pos = positive_feedback
             neg = negative_feedback
+            #Only check for sympy expressions if sympy is loaded (calc
+            #can't have made any otherwise)
+            sympy_loaded = 'sympy' in sys.modules
             for var, val in x.items():
-                if isinstance(val, sympy.Basic):
+                if sympy_loaded and isinstance(val, sympy.Basic):
                     t = t.replace('['+var+']', sympy.latex(val))
                     pos = pos.replace('['+var+']', sympy.latex(val))
                     neg = neg.replace('['+var+']', sympy.latex(val))
@@ -923,7 +1715,360 @@ class Pool(BlackBoardObject):
             
             self.addNumQ(title=title, text=t, answer=x['answer'], errfrac=errfrac, erramt=erramt, errlow=errlow, errhigh=errhigh, positive_feedback=pos, negative_feedback=neg)
 
+    def addCalcMCQ(self, title, text, xs, count, calc, answers, correct=0, sig_figs=3, option_text='[value]',
+                   positive_feedback="Good work", negative_feedback="That's not correct",
+                   shuffle_ans=True, batch_size=1000):
+        """Adds count generated multiple choice questions. Like
+        addCalcNumQ, the variables in xs are drawn at random, but a
+        batch at a time: calc is given a dict of numpy arrays (one value
+        per question) and adds the columns named in answers (the correct
+        answer first, unless correct says otherwise, then the
+        distractors), which it should work out for the whole batch at
+        once. It may also add a boolean 'valid' column to reject some.
+
+        Each option is its value rounded to sig_figs, put into
+        option_text as [value]. Questions where two options round to the
+        same value (e.g., a distractor equal to the answer) are dropped
+        and drawn again. Any [var] in the text, feedback and option_text
+        is replaced with the value of var. The questions are added
+        through add_many, so they are all copied from one template.
+        """
+        import numpy as np
+        templates = {name:re.split(r'\[(\w+)\]', template) for name, template in (('title', title), ('text', text), ('option', option_text), ('positive_feedback', positive_feedback), ('negative_feedback', negative_feedback))}
+        def fill(parts, columns, row):
+            return ''.join([part if idx % 2 == 0 else columns[part][row] if part in columns else '['+part+']' for idx, part in enumerate(parts)])
+        
+        added = 0
+        failures = 0
+        quiet, self.quiet = self.quiet, True
+        try:
+            while added < count:
+                size = min(batch_size, count - added)
+                x = {}
+                for name, (dist, sf) in xs.items():
+                    if hasattr(dist, 'rvs'):
+                        values = np.asarray(dist.rvs(size, random_state=self.random.getrandbits(32)), dtype=float)
+                    elif isinstance(dist, list):
+                        values = np.asarray(dist)[np.random.default_rng(self.random.getrandbits(64)).integers(len(dist), size=size)]
+                    else:
+                        raise RuntimeError("Unrecognised distribution/list for the question")
+                    if sf is not None:
+                        values = roundSF_array(values, sf)
+                    x[name] = values
+                x = calc(x)
+
+                #Drop the rows where the options aren't all different
+                #once rounded (or aren't numbers)
+                options = roundSF_array(np.column_stack([np.broadcast_to(np.asarray(x[name], dtype=float), (size,)) for name in answers]), sig_figs)
+                keep = np.isfinite(options).all(axis=1)
+                keep &= ~(np.diff(np.sort(options, axis=1), axis=1) == 0).any(axis=1)
+                if 'valid' in x:
+                    keep &= np.broadcast_to(np.asarray(x['valid'], dtype=bool), (size,))
+                rows = np.flatnonzero(keep)
+                if len(rows) == 0:
+                    failures += 1
+                    if failures >= 100:
+                        raise RuntimeError("No valid questions were generated for "+repr(title)+" in 100 batches, check the distractors")
+                    continue
+                failures = 0
+
+                columns = {name:[str(value) for value in np.broadcast_to(np.asarray(values), (size,))[rows].tolist()] for name, values in x.items()}
+                options = [[str(value) for value in column] for column in options[rows].T.tolist()]
+                for name, column in zip(answers, options):
+                    columns[name] = column
+                def specs():
+                    for row in range(len(rows)):
+                        yield {
+                            'type':'MCQ',
+                            'title':fill(templates['title'], columns, row),
+                            'text':fill(templates['text'], columns, row),
+                            'answers':[fill(templates['option'], dict(columns, value=column), row) for column in options],
+                            'correct':correct,
+                            'positive_feedback':fill(templates['positive_feedback'], columns, row),
+                            'negative_feedback':fill(templates['negative_feedback'], columns, row),
+                            'shuffle_ans':shuffle_ans,
+                        }
+                added += self.add_many(specs(), batch_size)
+        finally:
+            self.quiet = quiet
+        if not self.quiet and self.recording is None:
+            print("Added "+str(added)+" MCQ "+repr(title))
+        return added
+
+    def addArrowNumQ(self, title, text, source, answer='answer',
+                     errfrac=None, erramt=None, errlow=None, errhigh=None,
+                     positive_feedback="Good work", negative_feedback="That's not correct",
+                     batch_size=65536):
+        """Adds a numerical question for each row of a table of
+        precomputed variants, e.g., written by pandas. The source is a
+        Parquet file name, or a pyarrow Table, RecordBatch or
+        RecordBatchReader (this needs pyarrow). Like addCalcNumQ, any
+        [var] in the title, text and feedback is replaced with the value
+        of the column var. The answer, and errfrac, erramt, errlow and
+        errhigh, may be column names (or numbers for the errors), and
+        take precedence as in addNumQ. Values are written into the text
+        as str() would (so 3.0 stays 3.0). Rows with a missing (null)
+        value in any of the columns used are skipped, and counted.
+
+        The table is read a batch at a time (only the columns used),
+        the text is filled in and the tolerances worked out for the
+        whole batch at once, and the questions are added with add_many.
+        """
+        import numpy as np
+        if isinstance(source, str):
+            parquet_file = pyarrow_parquet.ParquetFile(source)
+            names = parquet_file.schema_arrow.names
+        elif isinstance(source, pyarrow.Table):
+            names = source.column_names
+        else:
+            names = source.schema.names
+        
+        #Split the text into its fixed parts and the columns to fill in
+        templates = [re.split(r'\[(\w+)\]', template) for template in (title, text, positive_feedback, negative_feedback)]
+        columns = set(name for parts in templates for name in parts[1::2] if name in names)
+        columns |= set(value for value in (answer, errfrac, erramt, errlow, errhigh) if isinstance(value, str))
+        columns = [name for name in names if name in columns]
+        
+        if isinstance(source, str):
+            batches = parquet_file.iter_batches(batch_size=batch_size, columns=columns)
+        elif isinstance(source, pyarrow.Table):
+            batches = source.select(columns).to_batches(max_chunksize=batch_size)
+        elif isinstance(source, pyarrow.RecordBatch):
+            batches = [source]
+        else:
+            batches = source
+        
+        def as_text(column):
+            #Floats are written as python does, as arrow would drop the .0
+            if pyarrow.types.is_floating(column.type):
+                return pyarrow.array([str(value) for value in column.to_pylist()], pyarrow.string())
+            return pyarrow_compute.cast(column, pyarrow.string())
+        
+        def fill(parts, batch, texts):
+            #Unknown [var]s are left as they are
+            if len(parts) == 1:
+                return itertools.repeat(parts[0], batch.num_rows)
+            pieces = [part if idx % 2 == 0 else texts[part] if part in columns else '['+part+']' for idx, part in enumerate(parts)]
+            return pyarrow_compute.binary_join_element_wise(*pieces, '').to_pylist()
             
+        def values(value, batch):
+            if isinstance(value, str):
+                return batch.column(value).to_numpy(zero_copy_only=False).astype(float)
+            return value
+
+        skipped = 0
+        def specs():
+            nonlocal skipped
+            for batch in batches:
+                #Drop the rows with missing values
+                if any(batch.column(name).null_count for name in columns):
+                    valid = functools.reduce(pyarrow_compute.and_, [batch.column(name).is_valid() for name in columns])
+                    filtered = batch.filter(valid)
+                    skipped += batch.num_rows - filtered.num_rows
+                    batch = filtered
+                    
+                answers = values(answer, batch)
+                #The same tolerances as addNumQ (where erramt overrides
+                #errfrac, which overrides errlow and errhigh), for the
+                #whole batch
+                if erramt is not None:
+                    amount = np.abs(values(erramt, batch))
+                    lows, highs = answers - amount, answers + amount
+                elif errfrac is not None:
+                    fraction = values(errfrac, batch)
+                    lows = np.minimum(answers * (1 - fraction), answers * (1 + fraction))
+                    highs = np.maximum(answers * (1 - fraction), answers * (1 + fraction))
+                elif errlow is not None and errhigh is not None:
+                    lows, highs = values(errlow, batch), values(errhigh, batch)
+                else:
+                    raise Exception("Numerical questions require an error amount, fraction, or bounds")
+                lows = np.broadcast_to(lows, answers.shape).tolist()
+                highs = np.broadcast_to(highs, answers.shape).tolist()
+                
+                texts = {name:as_text(batch.column(name)) for name in set(part for parts in templates for part in parts[1::2] if part in columns)}
+                rows = zip(*[fill(parts, batch, texts) for parts in templates], answers.tolist(), lows, highs)
+                for q_title, q_text, pos, neg, q_answer, low, high in rows:
+                    yield {'type':'NumQ', 'title':q_title, 'text':q_text, 'answer':q_answer, 'errlow':low, 'errhigh':high, 'positive_feedback':pos, 'negative_feedback':neg}
+        
+        quiet, self.quiet = self.quiet, True
+        try:
+            count = self.add_many(specs(), batch_size)
+        finally:
+            self.quiet = quiet
+        if not self.quiet and self.recording is None:
+            print("Added "+str(count)+" NumQ "+repr(title))
+            if skipped:
+                print("Skipped "+str(skipped)+" rows of "+repr(title)+" with missing values")
+        return count
+            
+    @recordable
+    @live_arguments
+    def addItem(self, item):
+        """Adds an already processed question item (e.g., one read back
+        from an existing package with PackageReader) to the pool. The
+        item XML is copied as-is, only the object id and any embedded
+        file references are rewritten for this package.
+        """
+        self.question_counter += 1
+        element = copy.deepcopy(item.element)
+        element.tail = None
+        object_id = element.find('itemmetadata/bbmd_asi_object_id')
+        if object_id is not None:
+            object_id.text = self.object_id()
+
+        #Move any embedded files over to this package, and point the item at them
+        paths = {}
+        def xid_processor(match):
+            xid, path = item.transfer_file(match.group(1), self.package)
+            paths[xid] = path
+            return 'bbcswebdav/xid-'+xid
+        
+        for node in element.iter('mat_formattedtext'):
+            if node.text:
+                node.text = PackageReader.xid_pattern.sub(xid_processor, node.text)
+        self.section.append(element)
+
+        #Use the item's own preview if it has one
+        if item.html is not None:
+            html_question = PackageReader.xid_pattern.sub(xid_processor, item.html)
+        else:
+            html_question = PackageReader.xid_pattern.sub(xid_processor, item.text)
+            html_question = html_question.replace('@X@EmbeddedFile.requestUrlStub@X@', '')
+            html_question = '<li>'+html_question+'<ul><li>('+item.qtype+' question imported from '+item.source+')</li></ul></li>'
+        for xid, path in paths.items():
+            html_question = html_question.replace('bbcswebdav/xid-'+xid, path)
+        self.htmlfile += html_question
+        self.added("Item", item.title)
+
+            
+    def add_many(self, specs, batch_size=1000):
+        """Adds many questions, e.g., from a generator. Each question is
+        a dict of the arguments of its add*Q method, plus its type (as
+        in question_columns, e.g., {'type':'MCQ', 'title':..., 'text':...,
+        'answers':[...], 'correct':1}).
+
+        Questions with the same shape (the same type and the same
+        arguments, apart from their text) are only built once, as a
+        template which is then copied with the text (processed once per
+        batch) filled in. For banks of similar questions, this adds
+        them two to three times as fast as building each one (see
+        tests/test_add_many.py), though writing the package takes as
+        long either way. Returns the number of questions added.
+        """
+        specs = iter(specs)
+        count = 0
+        seen = set()
+        templates = {}
+        builder = None
+        for batch in iter(lambda: list(itertools.islice(specs, batch_size)), []):
+            if self.recording is not None:
+                self.recording.append(('add_many', (batch,), {}))
+                count += len(batch)
+                continue
+            
+            strings = {}
+            for spec in batch:
+                kwargs = dict(spec)
+                method = question_columns[kwargs.pop('type')][0]
+                if method == 'addOQ' and kwargs.get('shuffle_inds') is None:
+                    #Shuffle here, so the shuffle isn't part of the template
+                    kwargs['shuffle_inds'] = list(range(len(kwargs['answers'])))
+                    self.build_random.shuffle(kwargs['shuffle_inds'])
+                if builder is None:
+                    builder = TemplateBuilder(self)
+                values = []
+                template_kwargs = {key:builder.mark_arguments(value, values) for key, value in kwargs.items()}
+                if method == 'addNumQ':
+                    #Work out the bounds here, so addNumQ only writes the
+                    #numbers into the question, and they can be marked
+                    bounds = numq_bounds(kwargs['answer'], kwargs.pop('errfrac', None), kwargs.pop('erramt', None), kwargs.pop('errlow', None), kwargs.pop('errhigh', None))
+                    kwargs['errlow'], kwargs['errhigh'] = bounds
+                    template_kwargs = {key:value for key, value in template_kwargs.items() if key not in ('errfrac', 'erramt')}
+                    for key in ('answer', 'errlow', 'errhigh'):
+                        template_kwargs[key] = builder.mark_number(kwargs[key], values)
+                shape = (method, repr(template_kwargs))
+
+                #Shapes seen once are just built, as a shape which is
+                #never seen again isn't worth a template
+                if shape not in templates and shape in seen:
+                    if len(templates) > 1000:
+                        templates.clear()
+                    templates[shape] = builder.build(method, template_kwargs)
+                if shape in templates:
+                    if self.shard_full():
+                        self.write_shard()
+                    #fill_template only changes the pool once the
+                    #question is complete, so there is nothing to undo
+                    if self.page_size is None:
+                        self.fill_template(templates[shape], values, strings)
+                    else:
+                        with self.preview_page():
+                            self.fill_template(templates[shape], values, strings)
+                    self.count_shard()
+                else:
+                    if len(seen) > 100000:
+                        seen.clear()
+                    seen.add(shape)
+                    quiet, self.quiet = self.quiet, True
+                    try:
+                        getattr(self, method)(**kwargs)
+                    finally:
+                        self.quiet = quiet
+                count += 1
+        if self.recording is None and not self.quiet:
+            print("Added "+str(count)+" questions to "+repr(self.pool_name))
+        return count
+
+    def fill_template(self, template, values, strings):
+        """Adds a copy of a template question (see TemplateBuilder) to
+        the pool, with its text filled in from values (processing each
+        string once per batch of strings) and new ids. The question is
+        only added to the pool once it is complete.
+        """
+        item, fields, html, processed, uuid_count, object_id_count, counter_step = template
+        item = copy.deepcopy(item)
+        nodes = list(item.iter())
+        #What each kind of mark is replaced by
+        versions = {'S':values, 'B':{}, 'H':{}, 'U':self.uuids(uuid_count), 'O':['_'+str(bbid)+'_1' for bbid in self.package.bbids(object_id_count)]}
+        for idx in processed:
+            value = values[idx]
+            if value not in strings:
+                strings[value] = self.process_string(value)
+            versions['B'][idx], versions['H'][idx] = strings[value]
+        def fill(pieces):
+            return ''.join([piece if piece.__class__ is str else versions[piece[0]][piece[1]] for piece in pieces])
+        
+        for idx, name, pieces in fields:
+            if name is None:
+                nodes[idx].text = fill(pieces)
+            else:
+                nodes[idx].set(name, fill(pieces))
+        html = fill(html)
+        self.section.append(item)
+        self.htmlfile += html
+        self.question_counter += counter_step
+
+    def added(self, qtype, title):
+        if not self.quiet:
+            print("Added "+qtype+" "+repr(title))
+        
+    def addFromBank(self, bank, **query):
+        """Adds the questions from a QuestionBank which match a query
+        (see QuestionBank.items) to the pool, without regenerating
+        them. Returns the number of questions added.
+        """
+        count = 0
+        quiet, self.quiet = self.quiet, True
+        try:
+            for item in bank.items(**query):
+                self.addItem(item)
+                count += 1
+        finally:
+            self.quiet = quiet
+        if not self.quiet and self.recording is None:
+            print("Added "+str(count)+" questions from "+repr(bank.filename))
+        return count
+        
     def flow_mat2(self, node, text):
         flow = etree.SubElement(node, 'flow_mat', {'class':'Block'})
         self.flow_mat1(flow, text)
@@ -932,11 +2077,129 @@ class Pool(BlackBoardObject):
         flow = etree.SubElement(node, 'flow_mat', {'class':'FORMATTED_TEXT_BLOCK'})
         self.material(flow, text)
         
+class NumberMark:
+    """Stands in for a number in the arguments of a template question,
+    and is written into the question as its mark.
+    """
+    __slots__ = ('mark',)
+
+    def __init__(self, mark):
+        self.mark = mark
+
+    def __repr__(self):
+        return self.mark
+
+class TemplateBuilder(Pool):
+    """Builds the template questions of Pool.add_many. The builder is a
+    pool of its own (so nothing is added to the real pool) which builds
+    questions from arguments whose strings are replaced by marks (see
+    mark_arguments). Its text processing and ids give marks too, so it
+    is known where each string (as given, or processed for Blackboard
+    or for the preview) and each id goes in the question.
+    """
+    def __init__(self, pool):
+        #The marks are a random string (which won't be in any text),
+        #the kind of mark, and a number
+        self.nonce = 'm'+os.urandom(8).hex()
+        self.mark_pattern = re.compile(self.nonce+'([SBHUO])([0-9]+)'+self.nonce)
+        self.uuid_count = 0
+        self.object_id_count = 0
+        Pool.__init__(self, pool.pool_name, pool.package)
+        self.pool = pool
+        self.recording = None
+        self.quiet = True
+
+    def mark(self, kind, number):
+        return self.nonce+kind+str(number)+self.nonce
+        
+    def mark_number(self, value, values):
+        """Replaces a number which is only written into a question (as
+        its repr) with a numbered mark, collecting its repr in values.
+        """
+        values.append(repr(value))
+        return NumberMark(self.mark('S', len(values) - 1))
+
+    def mark_arguments(self, value, values):
+        """Replaces the (non-empty) strings in the arguments of a
+        question with numbered marks, collecting the strings in values.
+        """
+        if isinstance(value, str):
+            if not value:
+                return value
+            values.append(value)
+            return self.mark('S', len(values) - 1)
+        if isinstance(value, dict):
+            return {self.mark_arguments(key, values):self.mark_arguments(item, values) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return type(value)(self.mark_arguments(item, values) for item in value)
+        return value
+        
+    def uuid(self):
+        self.uuid_count += 1
+        return self.mark('U', self.uuid_count - 1)
+
+    def object_id(self):
+        self.object_id_count += 1
+        return self.mark('O', self.object_id_count - 1)
+
+    def process_string(self, text):
+        """Marks where the processed versions of the arguments go (text
+        which isn't an argument is the same in every copy, so it is
+        processed as normal).
+        """
+        if self.nonce not in text:
+            return self.pool.process_string(text)
+        return (self.mark_pattern.sub(lambda match: self.mark('B' if match.group(1) == 'S' else match.group(1), match.group(2)), text),
+                self.mark_pattern.sub(lambda match: self.mark('H' if match.group(1) == 'S' else match.group(1), match.group(2)), text))
+
+    def pieces(self, text):
+        """Splits text with marks into pieces, which are either text or
+        the (kind, number) of a mark."""
+        result = []
+        last = 0
+        for match in self.mark_pattern.finditer(text):
+            if match.start() > last:
+                result.append(text[last:match.start()])
+            last = match.end()
+            result.append((match.group(1), int(match.group(2))))
+        if last < len(text):
+            result.append(text[last:])
+        return result
+        
+    def build(self, method, kwargs):
+        """Builds a template question from marked arguments, returning
+        the item, where the marks are in it (and in its preview), which
+        arguments are processed, and how many ids and questions it
+        takes.
+        """
+        #The template draws (e.g., shuffles) what the pool would draw next
+        if self.package.deterministic:
+            self.build_random.setstate(self.pool.build_random.getstate())
+        self.uuid_count = self.object_id_count = self.question_counter = 0
+        getattr(self, method)(**kwargs)
+        item = self.section[-1]
+        self.section.remove(item)
+        html, self.htmlfile = self.pieces(str(self.htmlfile)), HTMLBuffer()
+        
+        fields = []
+        for idx, node in enumerate(item.iter()):
+            if node.text and self.nonce in node.text:
+                fields.append((idx, None, self.pieces(node.text)))
+            for name, value in node.attrib.items():
+                if self.nonce in value:
+                    fields.append((idx, name, self.pieces(value)))
+        #Only the arguments which are processed (e.g., not the title) are
+        #processed when the template is filled in
+        processed = sorted(set(piece[1] for field in fields for piece in field[2] + html if isinstance(piece, tuple) and piece[0] in 'BH'))
+        return item, fields, html, processed, self.uuid_count, self.object_id_count, self.question_counter
+
 class Test(BlackBoardObject):
     def __init__(self, test_name, package, description="Created by BlackboardQuiz!", instructions="", preview=True):
         """Initialises a question pool
         """
         self.package = package
+        self.random = package.random
+        self.build_random = package.random
         self.test_name = test_name
         self.preview = preview
         self.question_counter = 0
@@ -973,15 +2236,15 @@ class Test(BlackBoardObject):
 
     def close(self):
         if self.preview:
-            self.package.zf.writestr(self.test_name+'_preview.html', self.htmlfile_head + self.htmlfile + self.htmlfile_tail)
+            self.package.zf.writestr(self.package.zipinfo(self.test_name+'_preview.html'), self.htmlfile_head + self.htmlfile + self.htmlfile_tail)
             self.package.zf.writestr(
-                self.test_name+'_example_preview.html',
+                self.package.zipinfo(self.test_name+'_example_preview.html'),
                 self.htmlfile_head
                 + self.htmlfile_example
                 + '</li><p><b>[Total test marks '+str(self.htmlfile_example_marks)+']</b></p><ul>'
                 + self.htmlfile_tail)
 
-        self.package.embed_resource(self.test_name, "assessment/x-bb-qti-test", '<?xml version="1.0" encoding="UTF-8"?>\n'+etree.tostring(self.questestinterop, pretty_print=False).decode('utf-8'))
+        self.package.embed_resource(self.test_name, "assessment/x-bb-qti-test", self.questestinterop)
 
     def add_pool(self, pool, pool_ref):
         subsec = etree.SubElement(self.section, 'section')
@@ -995,17 +2258,23 @@ class Test(BlackBoardObject):
         self.htmlfile += '<h2>'+pool.pool_name+'</h2>'
         self.htmlfile += '<p> Students will be presented with '+str(pool.questions_per_test)+' questions selected randomly from the pool below.</p>'
         self.htmlfile += '<p> Each question is worth '+str(pool.points_per_q)+' marks.</p>'
-        self.htmlfile += '<ul>'
-        self.htmlfile += pool.htmlfile
-        self.htmlfile += '</ul>'
+        if pool.page_size is None:
+            self.htmlfile += '<ul>'
+            self.htmlfile += pool.htmlfile
+            self.htmlfile += '</ul>'
+        else:
+            #The pool's questions are only linked to, and the example
+            #uses the sample kept while they were added
+            self.htmlfile += '<p><a href="'+escape(pool.pool_name, {'"':'&quot;'})+'_preview.html">Preview the '+str(len(pool.page_index))+' questions of the pool</a></p>'
         self.htmlfile += '</div>'
 
-        
-        from bs4 import BeautifulSoup
-        soup = BeautifulSoup('<html>'+pool.htmlfile+'</html>', 'html.parser')
-        qs = soup.html.findChildren("li" , recursive=False)
-        import random
-        qs = random.sample(qs, pool.questions_per_test)
+        if pool.page_size is None:
+            soup = bs4.BeautifulSoup('<html>'+pool.htmlfile+'</html>', 'html.parser')
+            qs = soup.html.findChildren("li" , recursive=False)
+            qs = self.random.sample(qs, pool.questions_per_test)
+        else:
+            soup = bs4.BeautifulSoup('<html>'+''.join(pool.page_sample)+'</html>', 'html.parser')
+            qs = soup.html.findChildren("li" , recursive=False)
 
         for q in qs:
             p = soup.new_tag('p', class_="points", style="text-align:right;")
@@ -1021,12 +2290,193 @@ class Test(BlackBoardObject):
         kwargs['test'] = self
         return Pool(pool_name, self.package, *args, **kwargs)
         
+class BuildCache:
+    """Stores built pools on disk (pass one to Package as build_cache),
+    so that rebuilding a package only builds the pools which have
+    changed. A pool is identified by a hash of its questions, the files
+    its img tags refer to, the package settings which affect it, and
+    this module itself. Pools with questions which can't be hashed
+    (e.g., ones added with addItem) are always built.
+    """
+    def __init__(self, directory='.BlackboardQuiz_cache/build'):
+        self.directory = directory
+        os.makedirs(os.path.join(directory, 'blobs'), exist_ok=True)
+        self.version = file_digest(os.path.realpath(__file__)).hex()
+        #Packages built at once (with AsyncPackage) may store the same
+        #pool or file at the same time
+        self.lock = threading.Lock()
+
+    def blob(self, digest):
+        """The path of the cached copy of an embedded file."""
+        return os.path.join(self.directory, 'blobs', digest)
+        
+    def pool_key(self, pool, calls):
+        package = pool.package
+        try:
+            spec = json.dumps([self.version, pool.spec, calls, package.latex_mode, package.latex_kwargs, package.seed], sort_keys=True)
+        except TypeError:
+            return None
+
+        #Include the data of any files the questions refer to
+        files = []
+        def find_images(value):
+            if isinstance(value, str):
+                for match in re.finditer(r"<img.*?>", value):
+                    src = html.fragment_fromstring(match.group(0)).attrib.get('src', '')
+                    files.append((src, file_digest(src).hex() if os.path.isfile(src) else None))
+            elif isinstance(value, dict):
+                for item in value.values():
+                    find_images(item)
+            elif isinstance(value, (list, tuple)):
+                for item in value:
+                    find_images(item)
+        find_images(calls)
+        return hashlib.sha256((spec + json.dumps(files)).encode('utf-8')).hexdigest()
+
+    def load(self, key):
+        """Returns the .dat data and details of a cached pool, or None."""
+        try:
+            with open(os.path.join(self.directory, key+'.json')) as f:
+                meta = json.load(f)
+            with open(os.path.join(self.directory, key+'.dat'), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if not all(os.path.isfile(self.blob(asset[1])) for asset in meta['assets']):
+            return None
+        if not all(os.path.isfile(self.blob(equation[2])) for equation in meta['latex']):
+            return None
+        return data, meta
+
+    def store_blob(self, digest, file_data=None, source=None):
+        """Keeps a copy of an embedded file (given its data, or the file
+        to copy it from)."""
+        blob = self.blob(digest.hex())
+        if not os.path.isfile(blob):
+            if file_data is None:
+                shutil.copyfile(source, blob+'.tmp')
+            else:
+                with open(blob+'.tmp', 'wb') as f:
+                    f.write(file_data)
+            os.replace(blob+'.tmp', blob)
+        
+    def store(self, key, pool, assets, latex):
+        with self.lock:
+            self.store_pool(key, pool, assets, latex)
+
+    def store_pool(self, key, pool, assets, latex):
+        meta = {
+            'bbid_start':pool.bbid_start,
+            'bbid_count':pool.package.idcntr - pool.bbid_start,
+            'question_counter':pool.question_counter,
+            'htmlfile':str(pool.htmlfile),
+            'pages':pool.page_texts or [],
+            'page_index':pool.page_index,
+            'page_sample':pool.page_sample,
+            'assets':[],
+            'latex':[],
+        }
+        for filename, digest, file_data, source, (xid, path) in assets:
+            self.store_blob(digest, file_data, source)
+            meta['assets'].append([filename, digest.hex(), xid, path])
+        #The equations are kept separately, as they are renamed (and
+        #may already be embedded) when the pool is reused
+        for formula, display in latex:
+            digest, width_px, height_px, xid, path, img_data = pool.package.latex_files[formula, display]
+            self.store_blob(digest, img_data)
+            meta['latex'].append([formula, display, digest.hex(), width_px, height_px, xid, path])
+        with open(os.path.join(self.directory, key+'.dat'), 'wb') as f:
+            f.write(pool.data)
+        #The details are written last, so only complete entries are loaded
+        with open(os.path.join(self.directory, key+'.json'), 'w') as f:
+            json.dump(meta, f)
+        
+class EmbeddedDirectory:
+    """A node of the trie of directories embedded in a package. Each
+    directory gets its xid (and its descriptor) once, when it is first
+    used, and keeps its xid-tagged path in the package.
+    """
+    __slots__ = ('path', 'children')
+    
+    def __init__(self, path):
+        self.path = path
+        self.children = {}
+
 class Package:
-    def __init__(self, courseID="IMPORT"):
+    def __init__(self, courseID="IMPORT", latex_mode='mathml', image_optimiser=None, seed=None, build_cache=None, max_size=None, other_courseIDs=(), deferred=False, preview_page_size=None, watch_session=None):
         """Initialises a Blackboard package
+
+        latex_mode selects how LaTeX formulas are embedded, either as
+        'mathml', as 'png' images rendered with latex and dvipng, or as
+        'svg' images rendered with latex and dvisvgm.
+
+        image_optimiser may be an ImageOptimiser, which then processes
+        every image embedded in the package.
+
+        If a seed is given, the package is deterministic: all the
+        identifiers and random choices (e.g., shuffled orderings) are
+        drawn from a generator seeded with it, and the zip timestamps
+        and attribute order are fixed, so the same script always
+        produces an identical zip file.
+
+        build_cache may be a BuildCache, which is then used to reuse
+        any pools which are unchanged since a previous build.
+
+        If deferred is True, the questions added to each pool are only
+        kept as the arguments they were added with, and are built (one
+        at a time, straight into the package) when the pool is closed.
+        This uses far less memory for very large pools.
+
+        If preview_page_size is given, pool previews are split into
+        pages of that many questions, with an index page (see Pool).
+
+        If max_size (in bytes) is given and the package turns out larger
+        than it, the package is split into several packages
+        courseID_part1.zip, courseID_part2.zip, ..., which can each be
+        imported on their own.
+
+        To give the same questions to several courses, pass the other
+        course IDs as other_courseIDs. The package is built once, then
+        copied to otherID.zip for each, with only the parts which name
+        the course rewritten.
+
+        watch_session is the WatchSession of `python -m BlackboardQuiz
+        watch` (which it defaults to while the command is running); its
+        build cache and LaTeX renders are shared with the package, and
+        the files the package embeds are watched for changes.
         """
+        if latex_mode not in latex_modes:
+            raise ValueError("Unknown latex_mode "+repr(latex_mode)+" (expected one of "+", ".join(latex_modes)+")")
         self.courseID = courseID
+        self.other_courseIDs = list(other_courseIDs)
+        self.seed = seed
+        self.deterministic = seed is not None
+        if self.deterministic:
+            self.random = random.Random(seed)
+        else:
+            self.random = random
         self.embedded_files = {}
+        self.embedded_digests = {}
+        self.image_optimiser = image_optimiser
+        #Files still being processed (e.g., optimised), which are written
+        #as they finish. At most pending_limit are kept waiting.
+        self.pending_files = []
+        self.pending_limit = 16
+        if watch_session is None:
+            watch_session = WatchSession.current
+        self.watch_session = watch_session
+        if build_cache is None and watch_session is not None:
+            build_cache = watch_session.build_cache
+        self.build_cache = build_cache
+        self.deferred = deferred
+        self.preview_page_size = preview_page_size
+        self.max_size = max_size
+        self.asset_log = None
+        self.latex_log = None
+        #Files larger than this are hashed and copied into the zip in
+        #chunks, instead of being read into memory
+        self.stream_threshold = 8 << 20
+        self.chunk_size = 1 << 20
         try:
             import zlib
             compression = zipfile.ZIP_DEFLATED
@@ -1036,7 +2486,7 @@ class Package:
         self.next_xid = 1000000
         self.equation_counter = 0
         self.resource_counter = 0
-        self.embedded_paths = {}
+        self.embedded_paths = EmbeddedDirectory('')
         #Create the manifest file
         self.xmlNS = "http://www.w3.org/XML/1998/namespace"
         self.bbNS = 'http://www.blackboard.com/content-packaging/'
@@ -1045,13 +2495,25 @@ class Package:
         self.resources = etree.SubElement(self.manifest, 'resources')
 
         self.idcntr = 3191882
+        self.latex_mode = latex_mode
         self.latex_kwargs = dict()
         self.latex_cache = {}
+        #The digest, size, xid and path of each rendered equation (and,
+        #for the build cache, its image)
+        self.latex_files = {}
+        self.latex_renderer = None
+        if watch_session is not None:
+            watch_session.packages.append(self)
         
     def bbid(self):
         self.idcntr += 1
         return self.idcntr
 
+    def bbids(self, count):
+        """Reserves count object ids in one block."""
+        self.idcntr += count
+        return range(self.idcntr - count + 1, self.idcntr + 1)
+
     def create_unique_filename(self, base, ext):
         count = 0
         while True:
@@ -1060,16 +2522,161 @@ class Package:
                 return fname
             count += 1
     
+    def course_context(self, courseID):
+        """The data which implements the course name"""
+        parentContext = etree.Element("parentContextInfo")
+        etree.SubElement(parentContext, "parentContextId").text = courseID
+        return parentContext
+    
     def close(self):
         #Write additional data to implement the course name
-        parentContext = etree.Element("parentContextInfo")
-        etree.SubElement(parentContext, "parentContextId").text = self.courseID
-        self.embed_resource(self.courseID, "resource/x-mhhe-course-cx", '<?xml version="1.0" encoding="utf-8"?>\n'+etree.tostring(parentContext, pretty_print=False).decode('utf-8'))
+        self.course_resource = self.embed_resource(self.courseID, "resource/x-mhhe-course-cx", self.course_context(self.courseID), declaration=b'<?xml version="1.0" encoding="utf-8"?>\n')
 
+        #Write out any files which were still being processed
+        self.write_pending_files()
+        if self.image_optimiser is not None:
+            self.image_optimiser.report()
+        
         #Finally, write the manifest file
-        self.zf.writestr('imsmanifest.xml', '<?xml version="1.0" encoding="utf-8"?>\n'+etree.tostring(self.manifest, pretty_print=False).decode('utf-8'))
-        self.zf.writestr('.bb-package-info', open(os.path.join(os.path.dirname(__file__), '.bb-package-info')).read())
+        self.write_xml('imsmanifest.xml', self.manifest, declaration=b'<?xml version="1.0" encoding="utf-8"?>\n')
+        with open(os.path.join(os.path.dirname(__file__), '.bb-package-info'), 'rb') as f:
+            self.zf.writestr(self.zipinfo('.bb-package-info'), f.read())
         self.zf.close()
+        if self.latex_renderer is not None:
+            self.latex_renderer.close()
+        for courseID in self.other_courseIDs:
+            self.copy_for_course(courseID)
+        for courseID in [self.courseID] + self.other_courseIDs:
+            if self.max_size is not None and os.path.getsize(courseID+'.zip') > self.max_size:
+                self.split_volumes(courseID)
+
+    def course_manifest(self, courseID):
+        """A copy of the manifest, naming the given course"""
+        manifest = copy.deepcopy(self.manifest)
+        for resource in manifest.find('resources'):
+            if resource.get('type') == "resource/x-mhhe-course-cx":
+                resource.set(etree.QName(self.bbNS, 'title'), courseID)
+        return manifest
+
+    def copy_for_course(self, courseID):
+        """Copies the (closed) package for another course, to
+        courseID.zip. Only the course resource, the manifest, and the
+        descriptors of the embedded files name the course, so the
+        questions and files are copied as they are.
+        """
+        old = escape('#/courses/'+self.courseID+'/').encode('utf-8')
+        new = escape('#/courses/'+courseID+'/').encode('utf-8')
+        manifest = self.course_manifest(courseID)
+        context = self.course_resource+'.dat'
+        with zipfile.ZipFile(self.courseID+'.zip') as src, zipfile.ZipFile(courseID+'.zip', mode='w', compression=self.zf.compression) as dest:
+            names = set(src.namelist())
+            directories = set(os.path.dirname(name) for name in names)
+            for info in src.infolist():
+                name = info.filename
+                if name == 'imsmanifest.xml':
+                    self.write_xml(name, manifest, declaration=b'<?xml version="1.0" encoding="utf-8"?>\n', zf=dest)
+                elif name == context:
+                    self.write_xml(name, self.course_context(courseID), declaration=b'<?xml version="1.0" encoding="utf-8"?>\n', zf=dest)
+                elif name.startswith('csfiles/home_dir/') and name.endswith('.xml') and (name[:-4] in names or name[:-4] in directories):
+                    dest.writestr(self.zipinfo(name), src.read(info).replace(old, new))
+                else:
+                    copy_zip_entry(src, info, dest, self.chunk_size)
+        print("Copied the package for course "+repr(courseID))
+
+    def split_volumes(self, courseID=None):
+        """Splits the (closed) package into volumes of at most max_size
+        bytes. Each test is kept with its pools, and each pool or test
+        with the files it uses, which may then be in several volumes.
+        The pools and tests are packed into as few volumes as possible
+        (first fit, largest first).
+        """
+        if courseID is None:
+            courseID = self.courseID
+        filename = courseID+'.zip'
+        with PackageReader(filename) as reader:
+            infos = {info.filename:info for info in reader.zf.infolist()}
+            def entry_size(name):
+                #Roughly the compressed data and its local and central headers
+                return infos[name].compress_size + 2 * len(name.encode('utf-8')) + 100
+            
+            def file_entries(path):
+                #The file, its descriptor, and the descriptors of its directories
+                entries = {path, path+'.xml'}
+                directory = os.path.dirname(path)
+                while directory != 'csfiles/home_dir':
+                    entries.add(directory+'.xml')
+                    directory = os.path.dirname(directory)
+                return entries
+            
+            #Entries needed in every volume
+            common = {'.bb-package-info'}
+            groups = {}
+            pattern = re.compile(rb'bbcswebdav/xid-([0-9]+_1)|<sourcebank_ref>([^<]*)</sourcebank_ref>')
+            for identifier, (type, dat, title) in reader.resources.items():
+                if type == "resource/x-mhhe-course-cx":
+                    common.add(dat)
+                    continue
+                group = {'resources':{identifier}, 'entries':{dat}}
+                for preview in (title+'_preview.html', title+'_example_preview.html'):
+                    if preview in infos:
+                        group['entries'].add(preview)
+                page = 1
+                while title+'_page'+str(page)+'_preview.html' in infos:
+                    group['entries'].add(title+'_page'+str(page)+'_preview.html')
+                    page += 1
+                with reader.zf.open(dat) as src:
+                    for chunk in xml_chunks(src, self.chunk_size):
+                        for match in pattern.finditer(chunk):
+                            if match.group(1) is not None:
+                                path = reader.embedded_files.get(match.group(1).decode('ascii'))
+                                if path is not None:
+                                    group['entries'] |= file_entries(path)
+                            elif match.group(2).decode('utf-8') in groups:
+                                #Keep the pools of a test with it
+                                other = groups[match.group(2).decode('utf-8')]
+                                group['resources'] |= other['resources']
+                                group['entries'] |= other['entries']
+                for member in group['resources']:
+                    groups[member] = group
+
+            #Each group is only packed once, biggest first
+            unique = list({id(group):group for group in groups.values()}.values())
+            for group in unique:
+                group['size'] = sum(entry_size(name) for name in group['entries']) + 250 * len(group['resources'])
+            unique.sort(key=lambda group: -group['size'])
+            budget = self.max_size - sum(entry_size(name) for name in common) - 1000
+            volumes = []
+            for group in unique:
+                for volume in volumes:
+                    extra = sum(entry_size(name) for name in group['entries'] - volume['entries']) + 250 * len(group['resources'])
+                    if volume['size'] + extra <= budget:
+                        break
+                else:
+                    if group['size'] > budget:
+                        print("WARNING: "+repr(sorted(reader.resources[r][2] for r in group['resources']))+" alone is larger than max_size")
+                    volume = {'resources':set(), 'entries':set(), 'size':0}
+                    volumes.append(volume)
+                    extra = group['size']
+                volume['resources'] |= group['resources']
+                volume['entries'] |= group['entries']
+                volume['size'] += extra
+
+            #Write each volume, with its own manifest
+            for idx, volume in enumerate(volumes):
+                volume_zf = zipfile.ZipFile(courseID+'_part'+str(idx+1)+'.zip', mode='w', compression=self.zf.compression)
+                entries = volume['entries'] | common
+                for info in reader.zf.infolist():
+                    if info.filename in entries:
+                        copy_zip_entry(reader.zf, info, volume_zf, self.chunk_size)
+                manifest = self.course_manifest(courseID)
+                resources = manifest.find('resources')
+                for resource in list(resources):
+                    if resource.get('identifier') not in volume['resources'] and resource.get(etree.QName(self.bbNS, 'file')) not in common:
+                        resources.remove(resource)
+                self.write_xml('imsmanifest.xml', manifest, declaration=b'<?xml version="1.0" encoding="utf-8"?>\n', zf=volume_zf)
+                volume_zf.close()
+        os.remove(filename)
+        print("Split the package into "+str(len(volumes))+" volumes of at most "+str(self.max_size)+" bytes")
 
     def __enter__(self):
         return self
@@ -1083,19 +2690,84 @@ class Package:
     def createPool(self, pool_name, *args, **kwargs):
         return Pool(pool_name, self, *args, **kwargs)
 
-    def embed_resource(self, title, type, content):
+    def zipinfo(self, filename):
+        """Creates the ZipInfo for a new entry in the package (with a
+        fixed timestamp if the package is deterministic).
+        """
+        if self.deterministic:
+            date_time = (1980, 1, 1, 0, 0, 0)
+        else:
+            date_time = time.localtime(time.time())[:6]
+        zinfo = zipfile.ZipInfo(filename, date_time=date_time)
+        zinfo.compress_type = self.zf.compression
+        zinfo.external_attr = 0o600 << 16
+        return zinfo
+
+    def canonicalise(self, node):
+        """Sorts the attributes of a tree if the package is deterministic."""
+        if self.deterministic:
+            for element in node.iter(tag=etree.Element):
+                if len(element.attrib) > 1:
+                    attrib = sorted(element.attrib.items())
+                    element.attrib.clear()
+                    element.attrib.update(attrib)
+    
+    def write_xml(self, filename, node, declaration=b'<?xml version="1.0" encoding="UTF-8"?>\n', zf=None):
+        """Serializes an XML tree straight into a zip entry (of the
+        package, unless another zip file is given), without building the
+        document as a string first. Deterministic packages have their
+        attributes written in sorted order.
+        """
+        self.canonicalise(node)
+        if zf is None:
+            zf = self.zf
+        with zf.open(self.zipinfo(filename), mode='w') as f:
+            f.write(declaration)
+            #Written as ASCII (with character references for anything
+            #else), the same bytes etree.tostring always gave us
+            etree.ElementTree(node).write(f, encoding='us-ascii', xml_declaration=False)
+        
+    def embed_resource(self, title, type, content, declaration=b'<?xml version="1.0" encoding="UTF-8"?>\n'):
+        """Adds a resource to the manifest and writes its .dat file. The
+        content is either an XML tree, the (already serialized) data, or
+        a function which writes the data to the file object it is given.
+        """
         self.resource_counter += 1
         name = 'res'+format(self.resource_counter, '05')
         resource = etree.SubElement(self.resources, 'resource', {'identifier':name, 'type':type})
         resource.attrib[etree.QName(self.xmlNS, 'base')] = name
         resource.attrib[etree.QName(self.bbNS, 'file')] = name+'.dat'
         resource.attrib[etree.QName(self.bbNS, 'title')] = title
-        self.zf.writestr(name+'.dat', content)
+        if etree.iselement(content):
+            self.write_xml(name+'.dat', content, declaration)
+        elif callable(content):
+            with self.zf.open(self.zipinfo(name+'.dat'), mode='w', force_zip64=True) as f:
+                content(f)
+        else:
+            self.zf.writestr(self.zipinfo(name+'.dat'), content)
         return name
+
+    def write_pending_files(self, finished=False):
+        """Writes the files whose content was still being processed when
+        they were embedded, in the order they were embedded. If finished
+        is True, only those which are ready are written (and any beyond
+        the pending_limit, waiting for them). Deterministic packages only
+        write the ones beyond the limit, so the order of the zip doesn't
+        depend on how long each file took.
+        """
+        while self.pending_files:
+            filepath, future = self.pending_files[0]
+            if finished and len(self.pending_files) <= self.pending_limit and (self.deterministic or not future.done()):
+                break
+            self.zf.writestr(self.zipinfo(filepath), future.result())
+            del self.pending_files[0]
         
-    def embed_file_data(self, name, content):
+    def embed_file_data(self, name, content, size=None):
         """Embeds a file (given a name and content) to the quiz and returns the
-        unique id of the file, and the path to the file in the zip
+        unique id of the file, and the path to the file in the zip. The
+        content may also be a future, in which case it is written once
+        it is ready, or a file object, in which case it is copied in
+        chunks (size can be given if the file object is not a real file).
         """                
 
         #First, we need to process the path of the file, and embed xid
@@ -1104,115 +2776,161 @@ class Package:
         #Split the name into filename and path
         path, filename = os.path.split(name)
 
-        #Simplify the path (remove any ./ items and simplify ../ items to come at the start)
+        #Simplify the path (remove any ./ items and simplify ../ items
+        #to come at the start), then drop any useless entries
         if (path != ""):
             path = os.path.relpath(path)
-        
-        #Split the path up into its components
-        def rec_split(s):
-            rest, tail = os.path.split(s)
-            if rest in ('', os.path.sep):
-                return [tail]
-            return rec_split(s) + [tail]
-
-        path = rec_split(path)
+        path = [entry for entry in path.split(os.path.sep) if entry not in ('', '.', '..')]
         root, ext = os.path.splitext(filename)
 
-        def processDirectories(path, embedded_paths, i=0):
-            #Keep processing until the whole path is processed
-            if i >= len(path):
-                return path
-
-            #Slice any useless entries from the path
-            if i==0 and (path[0] == ".." or path[0] == '/' or path[0] == ''):
-                path = path[1:]
-                return processDirectories(path, embedded_paths, i)
-
-            #Check if the path is already processed
-            if path[i] in embedded_paths:
-                new_e_paths = embedded_paths[path[i]][1]
-                path[i] = embedded_paths[path[i]][0]
-            else:
-                #Path not processed, add it
-                descriptor_node = etree.Element("lom") #attrib = {'xmlns':, 'xmlns:xsi':'http://www.w3.org/2001/XMLSchema-instance', 'xsi:schemaLocation':'http://www.imsglobal.org/xsd/imsmd_rootv1p2p1 imsmd_rootv1p2p1.xsd'}
-                relation = etree.SubElement(descriptor_node, 'relation')
-                resource = etree.SubElement(relation, 'resource')
-
-                self.next_xid += 1
-                transformed_path = path[i]+'__xid-'+str(self.next_xid)+'_1'
-                etree.SubElement(resource, 'identifier').text = str(self.next_xid)+'_1' + '#' + '/courses/'+self.courseID+'/' + os.path.join(*(path[:i+1]))
-                embedded_paths[path[i]] = [transformed_path, {}]
-                new_e_paths = embedded_paths[path[i]][1]
-
-                path[i] = transformed_path
-                
-                self.zf.writestr(os.path.join('csfiles/home_dir', *(path[:i+1]))+'.xml', '<?xml version="1.0" encoding="UTF-8"?>\n'+etree.tostring(descriptor_node, pretty_print=False).decode('utf-8'))
-
-            return processDirectories(path, new_e_paths, i+1)
-
-        processDirectories(path, self.embedded_paths)
+        directory = self.embedded_directory(path)
         
         #Finally, assign a xid to the file itself
         self.next_xid += 1
         filename = root + '__xid-'+str(self.next_xid)+'_1' + ext
 
         #Merge the path pieces and filename
-        path = path + [filename]
-        path = os.path.join(*path)
+        path = os.path.join(directory.path, filename)
         filepath = os.path.join('csfiles/home_dir/', path)
-        self.zf.writestr(filepath, content)
+        if isinstance(content, concurrent.futures.Future):
+            self.pending_files.append((filepath, content))
+            self.write_pending_files(finished=True)
+        elif hasattr(content, 'read'):
+            if size is None:
+                size = os.fstat(content.fileno()).st_size
+            force_zip64 = size > zipfile.ZIP64_LIMIT
+            with self.zf.open(self.zipinfo(filepath), mode='w', force_zip64=force_zip64) as dest:
+                shutil.copyfileobj(content, dest, self.chunk_size)
+        else:
+            self.zf.writestr(self.zipinfo(filepath), content)
         
         descriptor_node = etree.Element("lom") #attrib = {'xmlns':, 'xmlns:xsi':'http://www.w3.org/2001/XMLSchema-instance', 'xsi:schemaLocation':'http://www.imsglobal.org/xsd/imsmd_rootv1p2p1 imsmd_rootv1p2p1.xsd'}
         relation = etree.SubElement(descriptor_node, 'relation')
         resource = etree.SubElement(relation, 'resource')
         etree.SubElement(resource, 'identifier').text = str(self.next_xid) + '#' + '/courses/'+self.courseID+'/'+path
-        self.zf.writestr(filepath+'.xml', '<?xml version="1.0" encoding="UTF-8"?>\n'+etree.tostring(descriptor_node, pretty_print=False).decode('utf-8'))
+        self.write_xml(filepath+'.xml', descriptor_node)
         return str(self.next_xid)+'_1', filepath
 
-    def embed_file(self, filename, file_data=None, attrib={}):
-        """Embeds a file, and returns an img tag for use in blackboard, and an equivalent for html.
+    def embedded_directory(self, path):
+        """Returns the EmbeddedDirectory for a path (a list of directory
+        names), embedding any directories along it which are not
+        already embedded.
         """
-        #Grab the file data
-        if file_data == None:
+        directory = self.embedded_paths
+        for name in path:
+            if name not in directory.children:
+                #Directory not processed, add it
+                descriptor_node = etree.Element("lom") #attrib = {'xmlns':, 'xmlns:xsi':'http://www.w3.org/2001/XMLSchema-instance', 'xsi:schemaLocation':'http://www.imsglobal.org/xsd/imsmd_rootv1p2p1 imsmd_rootv1p2p1.xsd'}
+                relation = etree.SubElement(descriptor_node, 'relation')
+                resource = etree.SubElement(relation, 'resource')
+
+                self.next_xid += 1
+                etree.SubElement(resource, 'identifier').text = str(self.next_xid)+'_1' + '#' + '/courses/'+self.courseID+'/' + os.path.join(directory.path, name)
+                child = EmbeddedDirectory(os.path.join(directory.path, name+'__xid-'+str(self.next_xid)+'_1'))
+                directory.children[name] = child
+                self.write_xml(os.path.join('csfiles/home_dir', child.path)+'.xml', descriptor_node)
+            directory = directory.children[name]
+        return directory
+
+    def embed_directory(self, dirname, workers=None, batch_size=64):
+        """Embeds every file in a directory (and its subdirectories),
+        returning a dict of the embedded (xid, path) for each filename.
+        Files are read and hashed in parallel, batch_size files at a
+        time. The files can then be used in questions (e.g., in img
+        tags) as normal, and won't be embedded a second time.
+        """
+        filenames = []
+        for root, dirs, files in os.walk(dirname):
+            dirs.sort()
+            filenames += [os.path.normpath(os.path.join(root, name)) for name in sorted(files)]
+
+        def read(filename):
+            if os.path.getsize(filename) > self.stream_threshold:
+                #Large files are only hashed here, and streamed in later
+                return None, file_digest(filename, self.chunk_size)
             with open(filename, mode='rb') as file:
-                file_data = file.read()
-            
-        #Check if this file has already been embedded
-        if filename not in  self.embedded_files:
-            xid, path = self.embed_file_data(filename, file_data)
-            self.embedded_files[filename] = (xid, path)
-            return xid, path
+                data = file.read()
+            return data, hashlib.sha1(data).digest()
+
+        embedded = {}
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            for start in range(0, len(filenames), batch_size):
+                batch = filenames[start:start+batch_size]
+                for filename, (data, digest) in zip(batch, executor.map(read, batch)):
+                    embedded[filename] = self.embed_file(filename, data, digest=digest)
+        print("Embedded "+str(len(embedded))+" files from "+repr(dirname))
+        return embedded
+        
+    def embed_file(self, filename, file_data=None, attrib={}, digest=None, source=None):
+        """Embeds a file, and returns an img tag for use in blackboard, and an equivalent for html.
+
+        If the file data is not given, it is read from source (which
+        defaults to the filename).
+        """
+        if source is None:
+            source = filename
+        if self.watch_session is not None and file_data is None and os.path.isfile(filename):
+            self.watch_session.files.add(os.path.abspath(filename))
             
-        #Hmm something already exists with that name, check the data
-        xid, path = self.embedded_files[filename]
-        fz = self.zf.open(path)
-        if file_data == fz.read():
-            #It is the same file! return the existing link
-            return xid, path
-        fz.close()
-        
-        #Try generating a new filename, checking if that already exists in the store too
+        #Grab the file data, unless the file is large enough to be
+        #streamed into the package (images being optimised are always
+        #read in)
+        stream = False
+        if file_data == None:
+            optimise = self.image_optimiser is not None and self.image_optimiser.handles(filename)
+            if not optimise and os.path.getsize(source) > self.stream_threshold:
+                stream = True
+                if digest is None:
+                    digest = file_digest(source, self.chunk_size)
+            else:
+                with open(source, mode='rb') as file:
+                    file_data = file.read()
+
+        #Files are compared by the digest of their (original) data
+        if digest is None:
+            digest = hashlib.sha1(file_data).digest()
+        
+        #Check if this file has already been embedded, otherwise try
+        #generating a new filename, checking if that already exists in
+        #the store too. Names are normalised, so e.g. ./dir/x.png and
+        #dir/x.png are the same file.
+        fname = os.path.normpath(filename)
         count=-1
-        fbase, ext = os.path.splitext(filename)
-        while True:
+        fbase, ext = os.path.splitext(fname)
+        while fname in self.embedded_files:
+            if self.embedded_digests[fname] == digest:
+                #It is the same file! use the existing link
+                break
             count += 1 
             fname = fbase + '_'+str(count)+ext
-            if fname in self.embedded_files:
-                xid, path = self.embedded_files[fname]
-                fz = self.zf.open(path)
-                if file_data == fz.read():
-                    return xid, path
-                else:
-                    continue
-            break
-        #OK we have a new unique name, fname. Use this to embed the file
-        xid, path = self.embed_file_data(fname, file_data)
-        self.embedded_files[fname] = (xid, path)
-        return xid, path
+            
+        if fname not in self.embedded_files:
+            #OK we have a new unique name, fname. Use this to embed the file
+            content = file_data
+            name = fname
+            if stream:
+                with open(source, mode='rb') as file:
+                    xid, path = self.embed_file_data(name, file)
+            else:
+                if self.image_optimiser is not None and self.image_optimiser.handles(fname):
+                    content = self.image_optimiser.submit(fname, file_data)
+                    name = self.image_optimiser.output_name(fname)
+                xid, path = self.embed_file_data(name, content)
+            self.embedded_files[fname] = (xid, path)
+            self.embedded_digests[fname] = digest
+
+        #Keep track of the files used by a pool being built for the build cache
+        if self.asset_log is not None:
+            self.asset_log.append((filename, digest, file_data, source, self.embedded_files[fname]))
+        return self.embedded_files[fname]
         
                                 
     def embed_image(self, filename, img_data=None, attrib={}):
         xid, path = self.embed_file(filename, img_data)
+        return self.img_tags(xid, path, attrib)
+
+    def img_tags(self, xid, path, attrib={}):
+        """Returns the img tags (for blackboard and html) of an embedded file."""
         output_bb = '<img src="@X@EmbeddedFile.requestUrlStub@X@bbcswebdav/xid-'+xid+'"'
         output_html = '<img src="'+path+'"'
         for key, value in attrib.items():
@@ -1228,25 +2946,37 @@ class Package:
         question or answer.
         """
 
-        if display:
-            display = "block"
-        else:
-            display = "inline"
-            
-        if True:
+        if self.latex_mode == 'mathml':
             #Here we use MathML instead of rendering images
-            import latex2mathml.converter
-            output_bb = latex2mathml.converter.convert(formula, display= display)
+            output_bb = latex2mathml_converter.convert(formula, display="block" if display else "inline")
             output_html = output_bb
             return output_bb, output_html
             
-        if formula in self.latex_cache:
-            return self.latex_cache[formula]
+        if (formula, display) not in self.latex_cache:
+            if self.watch_session is not None:
+                img_data, width_px, height_px = self.watch_session.render_latex(self, formula, display)
+            else:
+                if self.latex_renderer is None:
+                    self.latex_renderer = LatexRenderer(image_format=self.latex_mode, **self.latex_kwargs)
+                img_data, width_px, height_px = self.latex_renderer.render(formula, display=display)
+            self.embed_latex_image(formula, display, width_px, height_px, img_data)
+        self.log_latex(formula, display)
+        return self.latex_cache[formula, display]
+
+    def log_latex(self, formula, display):
+        """Keeps track of the equations used by a pool being built for the build cache"""
+        if self.latex_log is not None:
+            self.latex_log[formula, display] = True
         
-        name = "LaTeX/eq"+str(self.equation_counter)+".png"
+    def embed_latex_image(self, formula, display, width_px, height_px, img_data=None, digest=None, source=None):
+        """Embeds the image of a rendered equation as the next LaTeX/eqN
+        file (either its data, or its digest and a file to read it
+        from), and adds it to the latex cache.
+        """
+        name = "LaTeX/eq"+str(self.equation_counter)+"."+self.latex_mode
         self.equation_counter += 1
-
-        img_data, width_px, height_px = render_latex(formula, display=display, dvioptions=['-D','125'], **self.latex_kwargs)
+        if digest is None:
+            digest = hashlib.sha1(img_data).digest()
 
         #This gives a 44px=1em height
         width_em = width_px / 44.0
@@ -1261,8 +2991,15 @@ class Package:
         attrib['height'] = str(height_px)
         # we escape '[' and ']' too, since they cause problems in Fill-in-the-Blank questions.
         attrib['alt'] = escape(formula, entities={'[': '(', ']': ')'})
-        self.latex_cache[formula] = self.embed_image(name, img_data, attrib=attrib)
-        return self.latex_cache[formula]
+
+        #The equation is logged as a whole (by log_latex), not as a file
+        asset_log, self.asset_log = self.asset_log, None
+        try:
+            xid, path = self.embed_file(name, img_data, digest=digest, source=source)
+        finally:
+            self.asset_log = asset_log
+        self.latex_files[formula, display] = (digest, width_px, height_px, xid, path, img_data if self.build_cache is not None else None)
+        self.latex_cache[formula, display] = self.img_tags(xid, path, attrib)
 
     def process_string(self, in_string):
         """Scan a string for LaTeX equations, image tags, etc, and process them.
@@ -1300,3 +3037,1091 @@ class Package:
             html_string[i] = html_img
 
         return ''.join(in_string), ''.join(html_string)
+
+
+class AsyncPackage:
+    """An asyncio front end to Package, for building packages without
+    blocking the event loop, e.g.,
+
+        async with AsyncPackage("MyBlackboardPackage") as package:
+            async with package.createPool('Pool') as pool:
+                await pool.addMCQ(...)
+
+    Each call (including the LaTeX rendering, file reading and zip
+    writing it does) runs on the executor, the loop's default thread
+    pool unless one is given, which bounds how many run at once. The
+    calls made on one package run one at a time, in the order they
+    are awaited, so the package is the same as one built with Package.
+    Several packages are built concurrently.
+
+    Packages without a seed all draw their random choices from the
+    random module, so when several are built at once their draws are
+    interleaved in whatever order the calls happen to run, and
+    differ from run to run (even under watch, which seeds it). Give
+    each package a seed if they must be reproducible. Under watch, the
+    packages also share the watch session (its LaTeX renderers and build
+    cache), which are locked so only one package uses them at a time.
+    """
+    def __init__(self, *args, executor=None, **kwargs):
+        self.create = functools.partial(Package, *args, **kwargs)
+        self.executor = executor
+        self.lock = asyncio.Lock()
+        self.package = None
+
+    async def run(self, function, *args, **kwargs):
+        """Runs a call on the package's turn on the executor."""
+        async with self.lock:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(function, *args, **kwargs))
+
+    async def __aenter__(self):
+        self.package = await self.run(self.create)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.run(self.package.close)
+
+    def createTest(self, test_name, *args, **kwargs):
+        return AsyncObject(self, lambda: self.package.createTest(test_name, *args, **kwargs))
+
+    def createPool(self, pool_name, *args, **kwargs):
+        return AsyncObject(self, lambda: self.package.createPool(pool_name, *args, **kwargs))
+
+class AsyncObject:
+    """A Pool or Test of an AsyncPackage (the object itself is wrapped).
+    Its methods are coroutines, which run on the package's turn.
+    """
+    def __init__(self, package, create):
+        self.package = package
+        self.create = create
+        self.wrapped = None
+
+    async def __aenter__(self):
+        self.wrapped = await self.package.run(self.create)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.package.run(self.wrapped.close)
+
+    def createPool(self, pool_name, *args, **kwargs):
+        return AsyncObject(self.package, lambda: self.wrapped.createPool(pool_name, *args, **kwargs))
+
+    def __getattr__(self, name):
+        #Only the methods of the wrapped object become coroutines, other
+        #attributes (even callable ones) are returned as they are
+        attr = getattr(self.wrapped, name)
+        if not inspect.ismethod(attr):
+            return attr
+        @functools.wraps(attr)
+        async def method(*args, **kwargs):
+            return await self.package.run(attr, *args, **kwargs)
+        return method
+
+
+class PackageReader:
+    """Reads an existing Blackboard package (either one made by this
+    module, or one exported from Blackboard) so that its questions can
+    be inspected or added to a new package. Only the manifest is
+    parsed up front, the pools are parsed lazily, one item at a time.
+    """
+    xid_pattern = re.compile(r'bbcswebdav/xid-([0-9]+_1)')
+    file_xid_pattern = re.compile(r'__xid-([0-9]+_1)')
+    
+    def __init__(self, filename):
+        self.filename = filename
+        self.zf = zipfile.ZipFile(filename, mode='r')
+        self.bbNS = 'http://www.blackboard.com/content-packaging/'
+        
+        self.resources = {}
+        with self.zf.open('imsmanifest.xml') as f:
+            for _, resource in etree.iterparse(f, events=('end',), tag='resource'):
+                self.resources[resource.get('identifier')] = (resource.get('type'), resource.get(etree.QName(self.bbNS, 'file')), resource.get(etree.QName(self.bbNS, 'title')))
+                resource.clear()
+
+        #Index the embedded files by their xid, skipping the lom
+        #descriptor files for files and directories
+        names = self.names = set(self.zf.namelist())
+        directories = set(os.path.dirname(name) for name in names)
+        self.embedded_files = {}
+        for name in names:
+            if not name.startswith('csfiles/home_dir/'):
+                continue
+            if name.endswith('.xml') and (name[:-4] in names or name[:-4] in directories):
+                continue
+            match = self.file_xid_pattern.search(os.path.basename(name))
+            if match:
+                self.embedded_files[match.group(1)] = name
+                
+        #The xids of files already copied into other packages
+        self.transferred = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.zf.close()
+        
+    def pools(self):
+        """Returns the question pools in the package, in manifest order."""
+        return [PackagePool(self, identifier, filename, title) for identifier, (type, filename, title) in self.resources.items() if type == 'assessment/x-bb-qti-pool']
+
+    def transfer_file(self, xid, package):
+        """Copies an embedded file into another package (once), and
+        returns the new xid and path of the file.
+        """
+        transferred = self.transferred.setdefault(package, {})
+        if xid not in transferred:
+            if xid not in self.embedded_files:
+                raise RuntimeError("Embedded file xid-"+xid+" not found in "+repr(self.filename))
+            path = self.embedded_files[xid]
+            with self.zf.open(path) as f:
+                transferred[xid] = package.embed_file(self.original_name(path), f.read())
+        return transferred[xid]
+
+    def original_name(self, path):
+        """Strips the home dir and xid tags from the path of an embedded
+        file to get its original name back.
+        """
+        return self.file_xid_pattern.sub('', path[len('csfiles/home_dir/'):])
+
+class PackagePool:
+    """A question pool within a package being read by PackageReader."""
+    def __init__(self, reader, identifier, filename, title):
+        self.reader = reader
+        self.identifier = identifier
+        self.filename = filename
+        self.title = title
+
+    def __iter__(self):
+        return self.items()
+        
+    def items(self):
+        """Iterates over the question items in the pool. Each item is
+        detached from the parsed document as soon as it is complete, so
+        memory use does not grow with the size of the pool.
+        """
+        previews = self.previews()
+        with self.reader.zf.open(self.filename) as f:
+            for idx, (_, element) in enumerate(etree.iterparse(f, events=('end',), tag='item')):
+                element.getparent().remove(element)
+                yield PackageItem(self.reader, element, previews[idx] if previews is not None else None)
+
+    def previews(self):
+        """Returns the preview HTML of each question in the pool, read
+        from the preview of the pool (or its pages) in the package, with
+        the paths of embedded files swapped for their xids (as in the
+        question XML). Returns None if the package has no preview of the
+        pool, or it doesn't match the questions.
+        """
+        names = self.reader.names
+        pages = []
+        while self.title+'_page'+str(len(pages) + 1)+'_preview.html' in names:
+            pages.append(self.title+'_page'+str(len(pages) + 1)+'_preview.html')
+        if not pages and self.title+'_preview.html' in names:
+            pages.append(self.title+'_preview.html')
+        if not pages:
+            return None
+        
+        paths = {path:xid for xid, path in self.reader.embedded_files.items()}
+        def path_processor(match):
+            if match.group(0) in paths:
+                return 'bbcswebdav/xid-'+paths[match.group(0)]
+            return match.group(0)
+        previews = []
+        for page in pages:
+            document = html.fromstring(self.reader.zf.read(page))
+            for mainlist in document.find_class('mainlist'):
+                for question in mainlist.iterchildren('li'):
+                    text = etree.tostring(question, method='html', encoding='us-ascii', with_tail=False).decode('ascii')
+                    previews.append(re.sub(r'csfiles/home_dir/[^"\'<>\s]+', path_processor, text))
+
+        #Only use the previews if there is one for each question
+        with self.reader.zf.open(self.filename) as f:
+            count = sum(chunk.count(b'<item ') for chunk in xml_chunks(f))
+        return previews if len(previews) == count else None
+
+class PackageItem:
+    """A single question item read from a package, and its preview HTML
+    (if the package has one).
+    """
+    def __init__(self, reader, element, html=None):
+        self.reader = reader
+        self.html = html
+        self.element = element
+        self.title = element.get('title')
+        self.qtype = element.findtext('itemmetadata/bbmd_questiontype', default='')
+        self.text = element.findtext('presentation/flow/flow/flow/material/mat_extension/mat_formattedtext', default='')
+        self.source = reader.filename
+
+    def transfer_file(self, xid, package):
+        return self.reader.transfer_file(xid, package)
+
+class QuestionBank:
+    """A store of fully built questions (their XML, preview text and
+    embedded files) in an SQLite database, so that packages can be
+    assembled from them again later without regenerating them. The
+    questions are added from built packages, and indexed by their
+    type, topic (which defaults to the pool name), tags, and the
+    generator which made them (a string, or a function which is
+    identified by a hash of its source).
+    """
+    def __init__(self, filename='questions.db'):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        with self.db:
+            self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS questions (id INTEGER PRIMARY KEY, title TEXT, qtype TEXT, topic TEXT, generator TEXT, xml BLOB, text TEXT);
+            CREATE TABLE IF NOT EXISTS tags (question INTEGER, tag TEXT);
+            CREATE TABLE IF NOT EXISTS assets (digest TEXT PRIMARY KEY, name TEXT, data BLOB);
+            CREATE TABLE IF NOT EXISTS question_assets (question INTEGER, xid TEXT, digest TEXT);
+            CREATE INDEX IF NOT EXISTS questions_topic ON questions (topic);
+            CREATE INDEX IF NOT EXISTS questions_qtype ON questions (qtype);
+            CREATE INDEX IF NOT EXISTS questions_generator ON questions (generator);
+            CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag, question);
+            CREATE INDEX IF NOT EXISTS question_assets_question ON question_assets (question, xid);
+            ''')
+            #Banks made before questions had their preview and digest
+            columns = [row[1] for row in self.db.execute('PRAGMA table_info(questions)')]
+            for column in ('html', 'digest'):
+                if column not in columns:
+                    self.db.execute('ALTER TABLE questions ADD COLUMN '+column+' TEXT')
+            self.db.execute('CREATE UNIQUE INDEX IF NOT EXISTS questions_digest ON questions (digest)')
+        #The files already copied into packages, by package and digest
+        self.transferred = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    @staticmethod
+    def generator_hash(generator):
+        if callable(generator):
+            return hashlib.sha1(inspect.getsource(generator).encode('utf-8')).hexdigest()
+        return generator
+        
+    def add_package(self, filename, topic=None, tags=(), generator=None):
+        """Adds all the questions in the pools of a package to the bank,
+        returning the number added. The preview of each question is kept
+        too, if the package has previews of its pools. Questions already
+        in the bank (e.g., if a package is added twice) are not added
+        again, but are given any new tags.
+        """
+        generator = self.generator_hash(generator)
+        count = 0
+        duplicates = 0
+        with PackageReader(filename) as reader, self.db:
+            digests = {}
+            for pool in reader.pools():
+                for item in pool.items():
+                    xml = etree.tostring(item.element)
+                    xids = set(PackageReader.xid_pattern.findall(xml.decode('utf-8')))
+                    for xid in xids:
+                        #Each file is stored once, by the digest of its data
+                        if xid not in digests:
+                            path = reader.embedded_files[xid]
+                            data = reader.zf.read(path)
+                            digests[xid] = hashlib.sha1(data).hexdigest()
+                            self.db.execute('INSERT OR IGNORE INTO assets VALUES (?, ?, ?)', (digests[xid], reader.original_name(path), data))
+                    
+                    #Questions are the same if their XML is, apart from
+                    #their object id and the xids of their files
+                    element = copy.deepcopy(item.element)
+                    for object_id in element.iter('bbmd_asi_object_id'):
+                        object_id.text = None
+                    digest = hashlib.sha1(PackageReader.xid_pattern.sub(lambda match: 'bbcswebdav/'+digests[match.group(1)], etree.tostring(element).decode('utf-8')).encode('utf-8')).hexdigest()
+                    row = self.db.execute('SELECT id FROM questions WHERE digest = ?', (digest,)).fetchone()
+                    if row is not None:
+                        question = row[0]
+                        duplicates += 1
+                    else:
+                        question = self.db.execute('INSERT INTO questions (title, qtype, topic, generator, xml, text, html, digest) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (item.title, item.qtype, topic if topic is not None else pool.title, generator, xml, item.text, item.html, digest)).lastrowid
+                        self.db.executemany('INSERT INTO question_assets VALUES (?, ?, ?)', [(question, xid, digests[xid]) for xid in xids])
+                        count += 1
+                    self.db.executemany('INSERT INTO tags SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM tags WHERE question = ? AND tag = ?)', [(question, tag, question, tag) for tag in set(tags)])
+        print("Added "+str(count)+" questions from "+repr(filename)+" to the bank")
+        if duplicates:
+            print("Skipped "+str(duplicates)+" questions already in the bank")
+        return count
+
+    def query(self, topic=None, qtype=None, generator=None, tags=()):
+        """Returns the SQL condition (and its parameters) for a query."""
+        conditions, parameters = [], []
+        for column, value in (('topic', topic), ('qtype', qtype), ('generator', self.generator_hash(generator))):
+            if value is not None:
+                conditions.append(column+' = ?')
+                parameters.append(value)
+        if tags:
+            #Questions with all of the tags
+            conditions.append('id IN (SELECT question FROM tags WHERE tag IN ('+', '.join('?' * len(tags))+') GROUP BY question HAVING COUNT(DISTINCT tag) = ?)')
+            parameters += list(tags) + [len(set(tags))]
+        return ' AND '.join(conditions) or '1', parameters
+
+    def count(self, **query):
+        """Returns the number of questions matching a query (see items),
+        e.g., to check if a generator needs running."""
+        condition, parameters = self.query(**query)
+        return self.db.execute('SELECT COUNT(*) FROM questions WHERE '+condition, parameters).fetchone()[0]
+        
+    def items(self, topic=None, qtype=None, generator=None, tags=(), limit=None):
+        """Iterates over the questions matching a query, in the order they
+        were added, as items which can be added to a pool with
+        Pool.addItem. The query is on the topic, type (e.g., 'Numeric'),
+        generator and tags (questions must have all of them).
+        """
+        condition, parameters = self.query(topic=topic, qtype=qtype, generator=generator, tags=tags)
+        sql = 'SELECT id, xml, html FROM questions WHERE '+condition+' ORDER BY id'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            parameters.append(limit)
+        for question, xml, preview in self.db.execute(sql, parameters):
+            yield BankItem(self, question, etree.fromstring(xml), preview)
+
+    def transfer_file(self, question, xid, package):
+        """Copies a file used by a question into a package (once), and
+        returns the new xid and path of the file.
+        """
+        transferred = self.transferred.setdefault(package, {})
+        row = self.db.execute('SELECT digest FROM question_assets WHERE question = ? AND xid = ?', (question, xid)).fetchone()
+        if row is None:
+            raise RuntimeError("Embedded file xid-"+xid+" not found in the bank "+repr(self.filename))
+        digest = row[0]
+        if digest not in transferred:
+            name, data = self.db.execute('SELECT name, data FROM assets WHERE digest = ?', (digest,)).fetchone()
+            transferred[digest] = package.embed_file(name, data)
+        return transferred[digest]
+
+class BankItem(PackageItem):
+    """A question item from a QuestionBank."""
+    def __init__(self, bank, question, element, html=None):
+        super().__init__(bank, element, html)
+        self.question = question
+
+    def transfer_file(self, xid, package):
+        return self.reader.transfer_file(self.question, xid, package)
+
+def xml_chunks(src, chunk_size=1 << 20):
+    """Reads XML data from src in chunks, only splitting it before a tag
+    which doesn't open an element, so that any simple element (a tag,
+    its text, and its closing tag) or text is never split across
+    chunks. This lets regular expressions run over the chunks.
+    """
+    buf = b''
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            yield buf
+            return
+        buf += chunk
+        #Split before the last tag, or before the tag before it if that
+        #one opens an element
+        split = buf.rfind(b'<')
+        previous = buf.rfind(b'<', 0, split)
+        if previous != -1 and buf[previous+1:previous+2] != b'/':
+            split = previous
+        if split <= 0:
+            continue
+        yield buf[:split]
+        buf = buf[split:]
+        
+def rewrite_stream(src, dest, pattern, processor, chunk_size=1 << 20):
+    """Copies XML data from src to dest in chunks, substituting matches of
+    a regular expression (in bytes). Matches must not contain a '<'
+    except in their first tag.
+    """
+    for chunk in xml_chunks(src, chunk_size):
+        dest.write(pattern.sub(processor, chunk))
+
+#The zipfile internals copy_zip_entry needs to copy raw entries
+zip_module_internals = ('_strip_extra', 'ZIP64_LIMIT', 'structFileHeader', 'sizeFileHeader', 'stringFileHeader', '_FH_SIGNATURE', '_FH_FILENAME_LENGTH', '_FH_EXTRA_FIELD_LENGTH')
+zip_file_internals = ('_lock', '_writing', '_didModify', 'start_dir', 'fp', 'filelist', 'NameToInfo')
+
+def copy_zip_entry(src, info, dest, chunk_size=1 << 20):
+    """Copies an entry of the zip file src into dest (open for writing)
+    as it is, so it is only ever compressed once. zipfile can't do
+    this itself, so this writes the local header and the raw data the
+    way ZipFile.open does. If this version of zipfile doesn't have the
+    internals that needs, the entry is decompressed and compressed
+    again instead.
+    """
+    if not (all(hasattr(zipfile, name) for name in zip_module_internals) and all(hasattr(zf, name) for zf in (src, dest) for name in zip_file_internals)):
+        zinfo = zipfile.ZipInfo(info.filename, info.date_time)
+        zinfo.compress_type = info.compress_type
+        zinfo.external_attr = info.external_attr
+        #So ZipFile.open knows if zip64 is needed
+        zinfo.file_size = info.file_size
+        with src.open(info) as fsrc, dest.open(zinfo, mode='w') as fdest:
+            shutil.copyfileobj(fsrc, fdest, chunk_size)
+        return
+    
+    zinfo = copy.copy(info)
+    #The sizes and crc are known, so no data descriptor is needed, and
+    #FileHeader adds its own zip64 extra field if one is needed
+    zinfo.flag_bits &= ~0x08
+    zinfo.extra = zipfile._strip_extra(zinfo.extra, (1,))
+    with src._lock, dest._lock:
+        if dest._writing:
+            raise ValueError("Can't copy an entry while another is being written")
+        src.fp.seek(info.header_offset)
+        header = struct.unpack(zipfile.structFileHeader, src.fp.read(zipfile.sizeFileHeader))
+        if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile("Bad local header for "+repr(info.filename))
+        src.fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+        dest.fp.seek(dest.start_dir)
+        zinfo.header_offset = dest.fp.tell()
+        dest.fp.write(zinfo.FileHeader(zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT))
+        remaining = info.compress_size
+        while remaining:
+            chunk = src.fp.read(min(remaining, chunk_size))
+            if not chunk:
+                raise zipfile.BadZipFile("Truncated data for "+repr(info.filename))
+            dest.fp.write(chunk)
+            remaining -= len(chunk)
+        dest.start_dir = dest.fp.tell()
+        dest.filelist.append(zinfo)
+        dest.NameToInfo[zinfo.filename] = zinfo
+        dest._didModify = True
+
+def merge_packages(courseID, filenames, **kwargs):
+    """Merges several packages (e.g., built separately on different
+    machines) into one package, courseID.zip. Resources, object ids and
+    embedded files are renumbered so they don't collide, and identical
+    embedded files are only included once. Everything is copied in
+    chunks, and the XML is only rewritten with regular expressions
+    (never parsed), so large packages can be merged quickly. Any
+    other arguments are passed to Package.
+    """
+    with Package(courseID, **kwargs) as package:
+        embedded = {}
+        for filename in filenames:
+            with PackageReader(filename) as reader:
+                #Copy the embedded files, skipping any identical to one
+                #already in the package
+                xids = {}
+                paths = {}
+                for xid, path in reader.embedded_files.items():
+                    digest = hashlib.sha1()
+                    with reader.zf.open(path) as f:
+                        for chunk in iter(lambda: f.read(package.chunk_size), b''):
+                            digest.update(chunk)
+                    digest = digest.digest()
+                    if digest not in embedded:
+                        with reader.zf.open(path) as f:
+                            embedded[digest] = package.embed_file_data(reader.original_name(path), f, size=reader.zf.getinfo(path).file_size)
+                    xids[xid.encode('ascii')], paths[path.encode('utf-8')] = [value.encode('utf-8') for value in embedded[digest]]
+
+                #Work out the new names of the resources first, as tests refer to pools
+                resources = [(identifier, values) for identifier, values in reader.resources.items() if values[0] != "resource/x-mhhe-course-cx"]
+                names = {}
+                for idx, (identifier, values) in enumerate(resources):
+                    names[identifier.encode('utf-8')] = ('res'+format(package.resource_counter + idx + 1, '05')).encode('ascii')
+
+                bbids = {}
+                def processor(match):
+                    if match.group(1) is not None:
+                        old = match.group(1)
+                        if old not in bbids:
+                            bbids[old] = str(package.bbid()).encode('ascii')
+                        return b'<bbmd_asi_object_id>_'+bbids[old]+b'_1</bbmd_asi_object_id>'
+                    if match.group(2) is not None:
+                        return b'<sourcebank_ref>'+names.get(match.group(2), match.group(2))+b'</sourcebank_ref>'
+                    if match.group(3) is not None:
+                        return b'bbcswebdav/xid-'+xids.get(match.group(3), match.group(3))
+                    return paths.get(match.group(4), match.group(4))
+                pattern = re.compile(rb'<bbmd_asi_object_id>_([0-9]+)_1</bbmd_asi_object_id>|<sourcebank_ref>([^<]*)</sourcebank_ref>|bbcswebdav/xid-([0-9]+_1)|(csfiles/home_dir/[^"\'<> ]+)')
+
+                for identifier, (type, dat, title) in resources:
+                    def write(dest):
+                        with reader.zf.open(dat) as src:
+                            rewrite_stream(src, dest, pattern, processor, package.chunk_size)
+                    package.embed_resource(title, type, write)
+
+                #The previews are copied too (if their names are free)
+                existing = set(package.zf.namelist())
+                for name in reader.zf.namelist():
+                    if name.endswith('_preview.html') and name not in existing:
+                        with reader.zf.open(name) as src, package.zf.open(package.zipinfo(name), mode='w') as dest:
+                            rewrite_stream(src, dest, pattern, processor, package.chunk_size)
+            print("Merged "+repr(filename))
+
+def verify_resource(filename, dat, xids, pools):
+    """Checks one pool or test resource of a package (see
+    verify_package), returning a list of the problems found. The
+    resource is parsed one item at a time, so this runs in constant
+    memory.
+    """
+    problems = []
+    with zipfile.ZipFile(filename) as zf, zf.open(dat) as f:
+        try:
+            for _, element in etree.iterparse(f, events=('end',), tag=('item', 'sourcebank_ref')):
+                if element.tag == 'sourcebank_ref':
+                    if element.text not in pools:
+                        problems.append(dat+": sourcebank_ref "+repr(element.text)+" is not a pool in the package")
+                    continue
+                where = dat+": item "+repr(element.get('title'))+": "
+                for node in element.iter('mat_formattedtext'):
+                    for xid in PackageReader.xid_pattern.findall(node.text or ''):
+                        if xid not in xids:
+                            problems.append(where+"embedded file xid-"+xid+" is not in the package")
+                
+                qtype = element.findtext('itemmetadata/bbmd_questiontype')
+                if qtype in ('Multiple Choice', 'Multiple Answer'):
+                    labels = set(node.get('ident') for node in element.iter('response_label'))
+                    responses = set(node.get('ident') for node in element.iter('response_lid'))
+                    for node in element.iter('varequal'):
+                        if node.text and node.text not in labels:
+                            problems.append(where+"varequal "+repr(node.text)+" does not match a response_label")
+                        if node.get('respident') not in labels | responses:
+                            problems.append(where+"varequal respident "+repr(node.get('respident'))+" does not match a response")
+                elif qtype == 'Fill in the Blank Plus':
+                    for node in element.iter('varsubset'):
+                        try:
+                            re.compile(node.text or '')
+                        except re.error as e:
+                            problems.append(where+"regex "+repr(node.text)+" does not compile ("+str(e)+")")
+                element.clear()
+                if element.getparent() is not None:
+                    element.getparent().remove(element)
+        except etree.XMLSyntaxError as e:
+            problems.append(dat+": invalid XML ("+str(e)+")")
+    return problems
+
+def verify_package(filename, workers=None):
+    """Checks a package for problems which would otherwise only show up
+    when it is imported into Blackboard, and returns a list of them
+    (empty if there are none). This checks that every resource in the
+    manifest exists, that tests only refer to pools in the package,
+    that every embedded file referred to (and its descriptors) exists,
+    that the answers of multiple choice/answer questions match their
+    choices, and that the regular expressions of fill in the blank
+    questions compile. The pools and tests are checked in parallel by
+    worker processes.
+    """
+    problems = []
+    with PackageReader(filename) as reader:
+        names = set(reader.zf.namelist())
+        if '.bb-package-info' not in names:
+            problems.append("missing .bb-package-info")
+        resources = []
+        for identifier, (type, dat, title) in reader.resources.items():
+            if dat not in names:
+                problems.append("resource "+identifier+" ("+repr(title)+"): file "+repr(dat)+" is missing")
+            elif type in ("assessment/x-bb-qti-pool", "assessment/x-bb-qti-test"):
+                resources.append(dat)
+        pools = frozenset(identifier for identifier, (type, dat, title) in reader.resources.items() if type == "assessment/x-bb-qti-pool")
+
+        #Each embedded file needs a descriptor, as does each directory it is in
+        for xid, path in reader.embedded_files.items():
+            descriptors = [path+'.xml']
+            directory = os.path.dirname(path)
+            while directory != 'csfiles/home_dir':
+                descriptors.append(directory+'.xml')
+                directory = os.path.dirname(directory)
+            for descriptor in descriptors:
+                if descriptor not in names:
+                    problems.append("embedded file "+repr(path)+": descriptor "+repr(descriptor)+" is missing")
+        xids = frozenset(reader.embedded_files)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for resource_problems in executor.map(verify_resource, itertools.repeat(filename), resources, itertools.repeat(xids), itertools.repeat(pools)):
+            problems += resource_problems
+    #Directories are shared by files, so only report them once
+    return list(dict.fromkeys(problems))
+
+def grade_numeric(items, sig_figs, problems):
+    """Grades a batch of numeric items, given as (where, low, high,
+    answer, responses) tuples, against synthetic responses, all at once
+    with numpy.
+    """
+    import numpy as np
+    low = np.array([item[1] for item in items])
+    high = np.array([item[2] for item in items])
+    answer = np.array([item[3] for item in items])
+
+    #The synthetic responses are the answer as a student would type it
+    #(to sig_figs significant figures), with its sign flipped, and
+    #with increasing relative errors
+    magnitude = np.floor(np.log10(np.where(answer == 0, 1, np.abs(answer))))
+    scale = 10.0 ** (sig_figs - 1 - magnitude)
+    rounded = np.round(answer * scale) / scale
+    errors = np.array([-0.5, -0.1, 0.1, 0.5])
+    responses = np.column_stack([answer, rounded, -answer, answer[:, None] * (1 + errors)])
+    correct = (responses >= low[:, None]) & (responses <= high[:, None])
+
+    checks = [
+        (low > high, "the tolerance range is empty, so full marks can't be reached"),
+        ((low <= high) & ~correct[:, 0], "the answer is outside its own tolerance range"),
+        (correct[:, 0] & ~correct[:, 1], "the answer to "+str(sig_figs)+" significant figures is marked wrong"),
+        ((answer != 0) & correct[:, 2], "the answer with the wrong sign is marked correct"),
+        #There is nothing to be 10% out from zero
+        ((answer != 0) & correct[:, 3:].any(axis=1), "answers 10% or more out are marked correct"),
+    ]
+    for flags, message in checks:
+        for idx in np.flatnonzero(flags):
+            problems.append(items[idx][0]+message)
+    
+    for where, low, high, answer, responses in items:
+        if responses:
+            values = np.array(responses, dtype=float)
+            for value in values[(values < low) | (values > high)]:
+                problems.append(where+"the response "+repr(float(value))+" is marked wrong")
+
+def grade_overlaps(where, ranges, problems):
+    """Flags numeric questions with several variants (the numeric items
+    of a pool with the same title) where the tolerance range of a
+    variant accepts the answer of another one, given the (low, high,
+    answer) of each variant by title.
+    """
+    import numpy as np
+    for title, values in ranges.items():
+        low, high, answer = np.array(values).T
+        answers = np.unique(answer)
+        if len(answers) < 2:
+            continue
+        #Count the distinct answers inside each range, other than its own
+        inside = np.searchsorted(answers, high, side='right') - np.searchsorted(answers, low, side='left')
+        inside -= (answer >= low) & (answer <= high)
+        overlapping = np.count_nonzero(inside > 0)
+        if overlapping:
+            problems.append(where+": item "+repr(title)+": "+str(overlapping)+" of "+str(len(values))+" variants have tolerances which overlap another variant's answer")
+
+def grade_package(filename, responses={}, sig_figs=3):
+    """Grades the questions of a package offline (without uploading it)
+    against synthetic responses, to check that the marking works as
+    intended. Returns a list of the problems found, e.g., numeric
+    tolerances which don't accept the answer (or accept the wrong
+    sign, or the answer of another variant of the question), multiple
+    answer weights which don't add up to full marks for
+    the correct answers, and fill in the blank patterns which accept a
+    blank answer. The responses (a dict of item titles to lists of
+    responses) are checked to get full marks too; numbers for numeric
+    questions, and dicts of blank names to text for fill in the blank
+    questions.
+    """
+    import numpy as np
+    problems = []
+    patterns = {}
+    counts = {}
+    with PackageReader(filename) as reader:
+        for pool in reader.pools():
+            numeric = []
+            ranges = {}
+            for item in pool.items():
+                where = pool.filename+": item "+repr(item.title)+": "
+                counts[item.qtype] = counts.get(item.qtype, 0) + 1
+                resprocessing = item.element.find('resprocessing')
+                if resprocessing is None:
+                    continue
+                if item.qtype == 'Numeric':
+                    conditionvar = resprocessing.find('respcondition/conditionvar')
+                    numeric.append((where, float(conditionvar.findtext('vargte')), float(conditionvar.findtext('varlte')), float(conditionvar.findtext('varequal')), responses.get(item.title)))
+                    ranges.setdefault(item.title, []).append(numeric[-1][1:4])
+                    #Grade in batches so memory stays bounded
+                    if len(numeric) >= 1 << 16:
+                        grade_numeric(numeric, sig_figs, problems)
+                        numeric = []
+                    
+                elif item.qtype in ('Multiple Choice', 'Multiple Answer'):
+                    labels = [node.get('ident') for node in item.element.iter('response_label')]
+                    correct = resprocessing.find("respcondition[@title='correct']/conditionvar")
+                    required = set(node.text for node in correct.iter('varequal') if node.getparent().tag != 'not')
+                    forbidden = set(node.text for node in correct.iter('varequal') if node.getparent().tag == 'not')
+                    if not required <= set(labels) or required & forbidden or (item.qtype == 'Multiple Choice' and len(required) != 1):
+                        problems.append(where+"no choice of answers gets full marks")
+                    if item.qtype == 'Multiple Answer' and len(labels) <= 16:
+                        #Score every possible selection of the answers by
+                        #their partial credit weights
+                        weights = {node.get('respident'):float(node.getparent().getparent().findtext('setvar')) for node in resprocessing.iter('varequal') if node.get('respident') in labels}
+                        selections = (np.arange(1 << len(labels))[:, None] >> np.arange(len(labels))) & 1
+                        scores = np.clip(selections @ np.array([weights.get(label, 0) for label in labels]), 0, None)
+                        correct_idx = sum(1 << idx for idx, label in enumerate(labels) if label in required)
+                        if scores[correct_idx] < 99.9:
+                            problems.append(where+"the correct answers only get "+format(scores[correct_idx], '.4g')+"% partial credit")
+                        if np.delete(scores, correct_idx).max(initial=0) >= 99.9:
+                            problems.append(where+"an incorrect selection of answers gets full partial credit")
+                
+                elif item.qtype == 'Fill in the Blank Plus':
+                    blanks = {}
+                    for node in resprocessing.iter('varsubset'):
+                        #Each pattern is only compiled once
+                        if node.text not in patterns:
+                            try:
+                                patterns[node.text] = re.compile(node.text or '')
+                            except re.error:
+                                patterns[node.text] = None
+                        pattern = patterns[node.text]
+                        if pattern is None:
+                            problems.append(where+"the pattern "+repr(node.text)+" does not compile")
+                            continue
+                        if pattern.search(''):
+                            problems.append(where+"the pattern "+repr(node.text)+" for blank "+repr(node.get('respident'))+" accepts a blank answer")
+                        blanks.setdefault(node.get('respident'), []).append(pattern)
+                    for response in responses.get(item.title, []):
+                        for blank, text in response.items():
+                            if not any(pattern.search(text) for pattern in blanks.get(blank, [])):
+                                problems.append(where+"the response "+repr(text)+" for blank "+repr(blank)+" matches no pattern")
+            if numeric:
+                grade_numeric(numeric, sig_figs, problems)
+            grade_overlaps(pool.filename, ranges, problems)
+    print("Graded "+str(sum(counts.values()))+" items ("+", ".join(str(count)+" "+qtype for qtype, count in counts.items())+")")
+    return problems
+
+def as_list(value, convert=str):
+    """Converts a question bank value to a list. CSV cells hold either
+    a JSON list, or the items separated by |'s."""
+    if isinstance(value, str):
+        value = json.loads(value) if value.startswith('[') else [item.strip() for item in value.split('|')]
+    return [convert(item) for item in value]
+
+def as_bool(value):
+    if isinstance(value, str):
+        if value.strip().lower() not in ('true', 'false', 'yes', 'no', '1', '0'):
+            raise ValueError("expected true or false, not "+repr(value))
+        return value.strip().lower() in ('true', 'yes', '1')
+    return bool(value)
+
+def as_json(value):
+    """Structured values (e.g. answer pairs) are JSON in CSV cells."""
+    return json.loads(value) if isinstance(value, str) else value
+
+#The columns of each question type in a question bank (see
+#build_package), besides title, text, positive_feedback and
+#negative_feedback, and how their values are converted
+question_columns = {
+    'NumQ':('addNumQ', {'answer':float, 'errfrac':float, 'erramt':float, 'errlow':float, 'errhigh':float}),
+    'MCQ':('addMCQ', {'answers':as_list, 'correct':int, 'shuffle_ans':as_bool}),
+    'MAQ':('addMAQ', {'answers':as_list, 'correct':lambda value: as_list(value, int), 'weights':lambda value: as_list(value, float), 'shuffle_ans':as_bool}),
+    'SRQ':('addSRQ', {'answer':str, 'rows':int, 'maxchars':int}),
+    'TFQ':('addTFQ', {'istrue':as_bool}),
+    'OQ':('addOQ', {'answers':as_list, 'shuffle_inds':lambda value: as_list(value, int)}),
+    'MQ':('addMQ', {'answer_pairs':as_json, 'unmatched':as_list, 'neg_weight':float}),
+    'FITBQ':('addFITBQ', {'answers':as_json}),
+}
+
+#The columns which set up the pool (and test) of a question, these are
+#taken from the first question of each pool
+pool_columns = {'description':str, 'instructions':str, 'points_per_q':float, 'questions_per_test':int}
+
+def read_question_bank(filename):
+    """Reads the rows of a CSV, JSONL or YAML question bank one at a
+    time, yielding the line number and a dict of each row. Empty CSV
+    cells are left out. YAML banks are either a list of rows, or one
+    row per document (which can be streamed).
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    with open(filename, newline='', encoding='utf-8') as f:
+        if ext == '.csv':
+            import csv
+            reader = csv.DictReader(f)
+            #Read the header first, so the first row is on line 2
+            reader.fieldnames
+            line = reader.line_num + 1
+            for row in reader:
+                yield line, {key:value for key, value in row.items() if key is not None and value not in (None, '')}
+                line = reader.line_num + 1
+        elif ext in ('.jsonl', '.ndjson'):
+            for line, text in enumerate(f, 1):
+                if text.strip():
+                    try:
+                        yield line, json.loads(text)
+                    except ValueError as e:
+                        yield line, e
+        elif ext in ('.yaml', '.yml'):
+            loader = yaml.SafeLoader(f)
+            try:
+                while loader.check_node():
+                    node = loader.get_node()
+                    rows = node.value if isinstance(node, yaml.SequenceNode) else [node]
+                    for row in rows:
+                        yield row.start_mark.line + 1, loader.construct_object(row, deep=True)
+            finally:
+                loader.dispose()
+        else:
+            raise ValueError("Unknown question bank format "+repr(ext)+" (expected .csv, .jsonl or .yaml)")
+
+def build_package(courseID, filenames, **kwargs):
+    """Builds a package, courseID.zip, from question bank files (CSV,
+    JSONL or YAML), which are read a row at a time. Each row is a
+    question, with a type (one of question_columns), pool, title and
+    text, and the arguments of the add*Q method of its type, e.g.,
+    answers and correct for an MCQ. A row may also have a test (to put
+    its pool in a test), and the pool_columns. A row which can't be
+    added is reported with its line number and skipped. Returns the
+    number of rows skipped. Any other arguments are passed to Package.
+
+    The files are read twice: first to find the last row of each pool
+    and test, so that each one is closed (and written out) straight
+    after it. Only the pools whose rows are mixed together are in
+    memory at once. For very large pools, pass deferred=True too (the
+    questions of a pool are then only built, and any problems reported,
+    when the pool is closed).
+    """
+    last_rows = {}
+    for file_idx, filename in enumerate(filenames):
+        for line, row in read_question_bank(filename):
+            if isinstance(row, dict):
+                try:
+                    last_rows[row.get('test'), row.get('pool')] = (file_idx, line)
+                    if row.get('test') is not None:
+                        last_rows[row.get('test')] = (file_idx, line)
+                except TypeError:
+                    pass
+
+    errors = 0
+    with Package(courseID, **kwargs) as package:
+        tests = {}
+        pools = {}
+        rows = {}
+        def report_recorded(where):
+            def on_error(idx, e):
+                nonlocal errors
+                errors += 1
+                print(where[idx]+": "+type(e).__name__+": "+str(e))
+            return on_error
+        
+        def close(objects, key, where):
+            nonlocal errors
+            try:
+                objects.pop(key).close()
+            except Exception as e:
+                errors += 1
+                print(where+": "+type(e).__name__+": "+str(e))
+                
+        try:
+            for file_idx, filename in enumerate(filenames):
+                for line, row in read_question_bank(filename):
+                    test_name = pool_name = None
+                    try:
+                        if isinstance(row, Exception):
+                            raise row
+                        if not isinstance(row, dict):
+                            raise ValueError("expected a row of columns, not "+repr(row))
+                        row = dict(row)
+                        qtype = row.pop('type', None)
+                        if qtype not in question_columns:
+                            raise ValueError("unknown question type "+repr(qtype)+" (expected one of "+", ".join(question_columns)+")")
+                        method, columns = question_columns[qtype]
+                        test_name = row.pop('test', None)
+                        pool_name = row.pop('pool', None)
+                        if pool_name is None:
+                            raise ValueError("no pool given")
+                        pool_kwargs = {key:convert(row.pop(key)) for key, convert in pool_columns.items() if key in row}
+                        question_kwargs = {}
+                        for key, value in row.items():
+                            if key in ('title', 'text', 'positive_feedback', 'negative_feedback'):
+                                question_kwargs[key] = str(value)
+                            elif key in columns:
+                                question_kwargs[key] = columns[key](value)
+                            else:
+                                raise ValueError("unknown column "+repr(key)+" for a "+qtype)
+
+                        key = (test_name, pool_name)
+                        if key not in pools:
+                            if test_name is None:
+                                pools[key] = package.createPool(pool_name, **pool_kwargs)
+                            else:
+                                if test_name not in tests:
+                                    tests[test_name] = package.createTest(test_name)
+                                pools[key] = tests[test_name].createPool(pool_name, **pool_kwargs)
+                        pool = pools[key]
+                        getattr(pool, method)(**question_kwargs)
+                        if pool.recording is not None:
+                            #The question is only built when the pool is
+                            #closed, so remember where it came from
+                            if pool.on_error is None:
+                                pool.on_error = report_recorded(rows.setdefault(key, []))
+                            rows[key].append(filename+":"+str(line))
+                    except Exception as e:
+                        errors += 1
+                        print(filename+":"+str(line)+": "+type(e).__name__+": "+str(e))
+
+                    #Close the pool (and test) if this was its last row
+                    try:
+                        if last_rows.get((test_name, pool_name)) == (file_idx, line) and (test_name, pool_name) in pools:
+                            close(pools, (test_name, pool_name), filename+":"+str(line)+": pool "+repr(pool_name))
+                            rows.pop((test_name, pool_name), None)
+                        if test_name is not None and last_rows.get(test_name) == (file_idx, line) and test_name in tests:
+                            close(tests, test_name, filename+":"+str(line)+": test "+repr(test_name))
+                    except TypeError:
+                        pass
+        finally:
+            for key in list(pools):
+                close(pools, key, "pool "+repr(key[1]))
+            for key in list(tests):
+                close(tests, key, "test "+repr(key))
+    if errors:
+        print(str(errors)+" question(s) skipped")
+    return errors
+
+class WatchSession:
+    """The state kept between the builds of a watched script: the build
+    cache, the LaTeX renderers (with their preamble formats) and the
+    formulas they have rendered, and the files the last build used.
+    """
+    #The session of `python -m BlackboardQuiz watch`, while it is
+    #running, which packages use unless they are given another
+    current = None
+
+    def __init__(self, build_cache=None):
+        self.build_cache = build_cache if build_cache is not None else BuildCache()
+        self.latex_renderers = {}
+        self.latex_renders = {}
+        self.files = set()
+        self.packages = []
+        #Packages built at once (with AsyncPackage) share the renderers
+        self.lock = threading.Lock()
+
+    def render_latex(self, package, formula, display):
+        settings = (package.latex_mode, repr(sorted(package.latex_kwargs.items())))
+        key = settings + (formula, display)
+        with self.lock:
+            if key not in self.latex_renders:
+                if settings not in self.latex_renderers:
+                    self.latex_renderers[settings] = LatexRenderer(image_format=package.latex_mode, **package.latex_kwargs)
+                self.latex_renders[key] = self.latex_renderers[settings].render(formula, display=display)
+            return self.latex_renders[key]
+
+    def close(self):
+        for renderer in self.latex_renderers.values():
+            renderer.close()
+
+def watch(script, interval=0.2, preview_dir=None):
+    """Runs a script which builds packages, then runs it again each
+    time it, a module it imports from its own directory, or a file
+    its packages embed changes, until interrupted. The interpreter (and
+    its imports), the LaTeX renders and a build cache are kept between
+    runs. The whole script is run each time, but the pools which
+    haven't changed are then reused from the cache instead of being
+    built again. The random module (and numpy's, if it is installed)
+    is seeded the same way before each run, so generated questions
+    don't change (and miss the cache) on every run. If
+    preview_dir is given, the previews of each package (and the files
+    they show) are extracted into preview_dir/courseID after each run.
+    """
+    script = os.path.abspath(script)
+    directory = os.path.dirname(script)
+    module_file = os.path.realpath(__file__)
+    sys.path.insert(0, directory)
+    session = WatchSession.current = WatchSession()
+    seed = int.from_bytes(hashlib.sha1(script.encode('utf-8')).digest()[:4], 'big')
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    def mtimes():
+        times = {}
+        for filename in session.files:
+            try:
+                times[filename] = os.stat(filename).st_mtime_ns
+            except OSError:
+                times[filename] = None
+        return times
+
+    try:
+        while True:
+            start = time.perf_counter()
+            previous, session.files = session.files, {script}
+            session.packages = []
+            modules = set(sys.modules)
+            random.seed(seed)
+            if numpy is not None:
+                numpy.random.seed(seed)
+            try:
+                runpy.run_path(script, run_name='__main__')
+                ok = True
+            except SystemExit as e:
+                ok = e.code in (None, 0)
+            except Exception:
+                traceback.print_exc()
+                ok = False
+
+            #Modules the script imported from its own directory are
+            #watched, and imported afresh on the next run
+            for name in set(sys.modules) - modules:
+                filename = getattr(sys.modules[name], '__file__', None)
+                if filename is not None and os.path.realpath(filename) != module_file and os.path.realpath(filename).startswith(os.path.realpath(directory)+os.sep):
+                    session.files.add(os.path.abspath(filename))
+                    del sys.modules[name]
+
+            #A failed run may not have got as far as using all its files
+            if not ok:
+                session.files |= previous
+            elif preview_dir is not None:
+                for package in session.packages:
+                    if os.path.isfile(package.courseID+'.zip'):
+                        with zipfile.ZipFile(package.courseID+'.zip') as zf:
+                            zf.extractall(os.path.join(preview_dir, package.courseID), [name for name in zf.namelist() if name.endswith('_preview.html') or name.startswith('csfiles/')])
+            print(("Built" if ok else "Failed")+" in "+format(time.perf_counter() - start, '.2f')+"s, watching "+str(len(session.files))+" file(s) for changes")
+
+            times = mtimes()
+            while mtimes() == times:
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        WatchSession.current = None
+        session.close()
+        sys.path.remove(directory)
+
+def main(argv=None):
+    """The command line interface, e.g., python -m BlackboardQuiz merge ..."""
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m BlackboardQuiz', description="Tools for Blackboard question pool packages.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    merge = commands.add_parser('merge', help="Merge several packages into one.")
+    merge.add_argument('courseID', help="The course ID of the merged package (it is written to courseID.zip).")
+    merge.add_argument('packages', nargs='+', help="The package zip files to merge.")
+
+    verify = commands.add_parser('verify', help="Check packages for problems before uploading them.")
+    verify.add_argument('packages', nargs='+', help="The package zip files to check.")
+    verify.add_argument('--workers', type=int, default=None, help="The number of worker processes (default: one per CPU).")
+    
+    grade = commands.add_parser('grade', help="Grade the questions of packages against synthetic responses, to check the marking.")
+    grade.add_argument('packages', nargs='+', help="The package zip files to grade.")
+    grade.add_argument('--sig-figs', type=int, default=3, help="The significant figures students give numeric answers to (default: 3).")
+    
+    build = commands.add_parser('build', help="Build a package from question bank files (CSV, JSONL or YAML).")
+    build.add_argument('courseID', help="The course ID of the package (it is written to courseID.zip).")
+    build.add_argument('banks', nargs='+', help="The question bank files.")
+    build.add_argument('--latex-mode', default='mathml', choices=latex_modes, help="How LaTeX is rendered (default: mathml).")
+    build.add_argument('--seed', default=None, help="Build a reproducible package from this seed.")
+    build.add_argument('--deferred', action='store_true', help="Build each pool's questions one at a time when it is closed, for very large pools.")
+    
+    watch_parser = commands.add_parser('watch', help="Rebuild the packages of a script whenever it (or a file it uses) changes.")
+    watch_parser.add_argument('script', help="The python script which builds the packages.")
+    watch_parser.add_argument('--interval', type=float, default=0.2, help="How often to check for changes, in seconds (default: 0.2).")
+    watch_parser.add_argument('--preview-dir', default=None, help="Extract the previews of each package into this directory after each build.")
+    
+    args = parser.parse_args(argv)
+    if args.command == 'build':
+        if build_package(args.courseID, args.banks, latex_mode=args.latex_mode, seed=args.seed, deferred=args.deferred):
+            sys.exit(1)
+    elif args.command == 'merge':
+        merge_packages(args.courseID, args.packages)
+    elif args.command == 'verify':
+        failed = False
+        for filename in args.packages:
+            problems = verify_package(filename, args.workers)
+            for problem in problems:
+                print(filename+": "+problem)
+            print(filename+": "+("OK" if not problems else str(len(problems))+" problem(s) found"))
+            failed = failed or bool(problems)
+        sys.exit(1 if failed else 0)
+    elif args.command == 'grade':
+        for filename in args.packages:
+            for problem in grade_package(filename, sig_figs=args.sig_figs):
+                print(filename+": "+problem)
+    elif args.command == 'watch':
+        #The script imports BlackboardQuiz, which is a different module
+        #to this one when run with python -m, so watch from that one
+        importlib.import_module('BlackboardQuiz').watch(args.script, args.interval, args.preview_dir)
+
+if __name__ == "__main__":
+    main()
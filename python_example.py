@@ -61,7 +61,7 @@ with BlackboardQuiz.Package("MyQuestionPools") as package:
 
     #Do the same as above, but using the calc question interface
     with package.createPool('Linear function solving2', description="Solve the $y=m*x+c$", instructions="") as pool:
-        import scipy
+        import scipy.stats
         #First, declare the "random" variables
         xs = {
             # 'm' : [scipy.stats.uniform(-10, 10), 2], #2 S.F.
@@ -0,0 +1,64 @@
+"""Checks that Pool.add_many gives exactly the same package as adding
+the questions one at a time, and that it is faster.
+"""
+import os
+import time
+import zipfile
+
+import BlackboardQuiz
+
+def specs(count):
+    for i in range(count):
+        n = str(i)
+        yield {'type':'NumQ', 'title':'n'+n, 'text':'What is '+n+'+1?', 'answer':i + 1, 'erramt':0.1}
+        yield {'type':'MCQ', 'title':'m'+n, 'text':'Pick <b>'+n+'</b>', 'answers':['a'+n, 'b', 'c & d'], 'correct':i % 3}
+        yield {'type':'MAQ', 'title':'a'+n, 'text':'Pick some', 'answers':['a', 'b'+n, 'c'], 'correct':[0, i % 2 + 1]}
+        yield {'type':'SRQ', 'title':'s'+n, 'text':'Say '+n, 'answer':'It is '+n}
+        yield {'type':'TFQ', 'title':'t'+n, 'text':'Is '+n+' even?', 'istrue':i % 2 == 0}
+        yield {'type':'OQ', 'title':'o'+n, 'text':'Order these', 'answers':['1', '2', n]}
+        yield {'type':'MQ', 'title':'q'+n, 'text':'Match these', 'answer_pairs':[['a', '1'], ['b', n]], 'unmatched':['x']}
+        yield {'type':'FITBQ', 'title':'f'+n, 'text':'The answer is [x]', 'answers':{'x':[n]}}
+
+def build(directory, many, count=20):
+    os.makedirs(directory)
+    os.chdir(directory)
+    with BlackboardQuiz.Package('Many', seed=5) as package:
+        with package.createPool('Pool', preview=True) as pool:
+            if many:
+                pool.add_many(specs(count))
+            else:
+                for spec in specs(count):
+                    spec = dict(spec)
+                    getattr(pool, BlackboardQuiz.question_columns[spec.pop('type')][0])(**spec)
+    with zipfile.ZipFile('Many.zip') as zf:
+        return {name:zf.read(name) for name in zf.namelist()}
+
+def test_add_many_matches_a_loop(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert build(str(tmp_path / 'many'), True) == build(str(tmp_path / 'loop'), False)
+
+def test_add_many_benchmark(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    def mcqs():
+        for i in range(3000):
+            yield {'type':'MCQ', 'title':'Q'+str(i), 'text':'What is '+str(i)+'+'+str(i)+'?', 'answers':[str(2 * i), str(2 * i + 1), 'x', 'y'], 'correct':i % 4}
+    def timed(many):
+        #Only adding the questions is timed, not writing the package
+        with BlackboardQuiz.Package('Benchmark', seed=1) as package:
+            with package.createPool('Pool') as pool:
+                pool.quiet = True
+                start = time.perf_counter()
+                if many:
+                    pool.add_many(mcqs())
+                else:
+                    for spec in mcqs():
+                        spec = dict(spec)
+                        del spec['type']
+                        pool.addMCQ(**spec)
+                return time.perf_counter() - start
+    loop_time = min(timed(False) for repeat in range(2))
+    many_time = min(timed(True) for repeat in range(2))
+    print("\nloop: {:.1f}us per question, add_many: {:.1f}us per question".format(1e6 * loop_time / 3000, 1e6 * many_time / 3000))
+    #This is two to three times as fast, the margin allows for noisy
+    #machines
+    assert many_time * 1.6 < loop_time
@@ -0,0 +1,42 @@
+"""Checks that Pool.addArrowNumQ gives the same package as adding each
+row with addNumQ, skips rows with missing values, and leaves the pool's
+quiet setting as it was.
+"""
+import os
+import zipfile
+
+import pytest
+
+pyarrow = pytest.importorskip('pyarrow')
+
+import BlackboardQuiz
+
+def table():
+    return pyarrow.table({'x':[1, 2, None, 4, 5], 'y':[0.5, 1.5, 2.5, None, -3.0], 'tol':[0.1, 0.2, 0.3, 0.4, 0.5]})
+
+def build(directory, arrow, quiet=False):
+    os.makedirs(directory)
+    os.chdir(directory)
+    with BlackboardQuiz.Package('Arrow', seed=3) as package:
+        with package.createPool('Pool', preview=True) as pool:
+            pool.quiet = quiet
+            if arrow:
+                assert pool.addArrowNumQ('Sum [x]', 'What is [x] + [y]?', table().append_column('sum', pyarrow.array([1.5, 3.5, None, None, 2.0])), answer='sum', erramt='tol', positive_feedback='Yes, [x] + [y]') == 3
+                assert pool.quiet == quiet
+            else:
+                for x, y, tol in ((1, 0.5, 0.1), (2, 1.5, 0.2), (5, -3.0, 0.5)):
+                    pool.addNumQ('Sum '+str(x), 'What is '+str(x)+' + '+str(y)+'?', x + y, erramt=tol, positive_feedback='Yes, '+str(x)+' + '+str(y))
+    with zipfile.ZipFile('Arrow.zip') as zf:
+        return {name:zf.read(name) for name in zf.namelist()}
+
+def test_arrow_matches_a_loop(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert build(str(tmp_path / 'arrow'), True) == build(str(tmp_path / 'loop'), False)
+
+@pytest.mark.parametrize('quiet', [False, True])
+def test_arrow_quiet(tmp_path, monkeypatch, capsys, quiet):
+    monkeypatch.chdir(tmp_path)
+    build(str(tmp_path / 'arrow'), True, quiet)
+    out = capsys.readouterr().out
+    assert ("Added 3 NumQ 'Sum [x]'" in out) != quiet
+    assert ("Skipped 2 rows of 'Sum [x]' with missing values" in out) != quiet
@@ -0,0 +1,57 @@
+"""Checks building packages from question bank files: the line numbers
+rows are reported with, and that a row which can't be added is
+skipped without leaving any part of it behind.
+"""
+import pytest
+
+import BlackboardQuiz
+
+csv_bank = '''type,pool,test,title,text,answer,erramt,answers,correct
+NumQ,P1,,n1,What is 1?,1,0.1,,
+MCQ,P1,,m1,"Pick
+one",,,a|b,5
+NumQ,P2,T,n2,What is 2?,2,0.1,,
+Essay,P1,,e1,Write,,,,
+NumQ,P1,,n3,What is 3?,3,0.1,,
+'''
+
+jsonl_bank = '''{"type": "NumQ", "pool": "P1", "title": "n1", "text": "What is 1?", "answer": 1, "erramt": 0.1}
+
+{"type": "MCQ", "pool": "P1", "title": "m1", "text": "Pick", "answers": ["a", "b"], "correct": 5}
+{not json
+{"type": "NumQ", "pool": "P1", "title": "n3", "text": "What is 3?", "answer": 3, "erramt": 0.1}
+'''
+
+def titles(filename):
+    with BlackboardQuiz.PackageReader(filename) as reader:
+        return {pool.title:[item.title for item in pool.items()] for pool in reader.pools()}
+
+def test_csv_line_numbers(tmp_path):
+    (tmp_path / 'bank.csv').write_text(csv_bank)
+    rows = list(BlackboardQuiz.read_question_bank(str(tmp_path / 'bank.csv')))
+    #The header is line 1, and the MCQ's text runs over two lines
+    assert [line for line, row in rows] == [2, 3, 5, 6, 7]
+    assert rows[1][1]['text'] == 'Pick\none'
+    assert 'answers' not in rows[0][1]
+
+def test_jsonl_line_numbers(tmp_path):
+    (tmp_path / 'bank.jsonl').write_text(jsonl_bank)
+    rows = list(BlackboardQuiz.read_question_bank(str(tmp_path / 'bank.jsonl')))
+    assert [line for line, row in rows] == [1, 3, 4, 5]
+    assert isinstance(rows[2][1], ValueError)
+
+@pytest.mark.parametrize('deferred', [False, True])
+def test_build_skips_bad_rows(tmp_path, monkeypatch, capsys, deferred):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'bank.csv').write_text(csv_bank)
+    (tmp_path / 'bank.jsonl').write_text(jsonl_bank)
+    errors = BlackboardQuiz.build_package('Bank', ['bank.csv', 'bank.jsonl'], seed=1, deferred=deferred)
+    output = capsys.readouterr().out
+    assert errors == 4
+    #Each bad row is reported with its own line (the bad MCQs only when
+    #their pool is built, in a deferred package)
+    for where in ('bank.csv:3: ', 'bank.csv:6: ', 'bank.jsonl:3: ', 'bank.jsonl:4: '):
+        assert where in output
+    #Nothing of the bad rows is left in the package
+    assert titles('Bank.zip') == {'P1':['n1', 'n3', 'n1', 'n3'], 'P2':['n2']}
+    assert BlackboardQuiz.verify_package('Bank.zip') == []
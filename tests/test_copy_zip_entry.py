@@ -0,0 +1,52 @@
+"""Checks that the entries copied still compressed (for other courses,
+and into volumes) are intact, with or without the zipfile internals
+copy_zip_entry uses.
+"""
+import glob
+import zipfile
+import zlib
+
+import pytest
+
+import BlackboardQuiz
+
+def build():
+    with open('dot.png', 'wb') as f:
+        f.write(b'not really a png' * 100)
+    with BlackboardQuiz.Package('A', seed=1, other_courseIDs=['B'], max_size=12000) as package:
+        for name in ('First', 'Second', 'Third'):
+            with package.createPool(name, preview=True) as pool:
+                pool.addMCQ(name, 'What is this? <img src="dot.png">', ['A dot', 'A line'], correct=0)
+                for i in range(20):
+                    pool.addNumQ(name+' '+str(i), 'What is '+str(i)+'+1?', i + 1, erramt=0.1)
+    return package
+
+def entries(filename):
+    """Checks the zip file, and returns its entries."""
+    with zipfile.ZipFile(filename) as zf:
+        assert zf.testzip() is None
+        data = {}
+        for info in zf.infolist():
+            data[info.filename] = zf.read(info)
+            assert zlib.crc32(data[info.filename]) == info.CRC
+            assert len(data[info.filename]) == info.file_size
+        return data
+
+@pytest.mark.parametrize('internals', [True, False])
+def test_copied_entries(tmp_path, monkeypatch, internals):
+    monkeypatch.chdir(tmp_path)
+    if not internals:
+        monkeypatch.delattr(zipfile, '_strip_extra')
+    package = build()
+    volumes = {course:sorted(glob.glob(course+'_part*.zip')) for course in ('A', 'B')}
+    assert len(volumes['A']) > 1
+    assert len(volumes['B']) == len(volumes['A'])
+    for a_volume, b_volume in zip(volumes['A'], volumes['B']):
+        a_entries, b_entries = entries(a_volume), entries(b_volume)
+        assert a_entries.keys() == b_entries.keys()
+        #Only the entries which name the course are different
+        for name in a_entries:
+            if name not in ('imsmanifest.xml', package.course_resource+'.dat') and not (name.startswith('csfiles/') and name.endswith('.xml')):
+                assert a_entries[name] == b_entries[name]
+        assert BlackboardQuiz.verify_package(a_volume) == []
+        assert BlackboardQuiz.verify_package(b_volume) == []
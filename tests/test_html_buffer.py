@@ -0,0 +1,40 @@
+"""Checks HTMLBuffer, which collects the preview HTML of pools and
+tests a piece at a time.
+"""
+from io import BytesIO
+
+from BlackboardQuiz import HTMLBuffer, HTMLSpool
+
+def test_html_buffer_behaves_like_a_string():
+    html = HTMLBuffer('<ul>')
+    html += '<li>one</li>'
+    html += '<li>two</li>'
+    assert str(html) == '<ul><li>one</li><li>two</li>'
+    assert '<html>' + html + '</ul>' == '<html><ul><li>one</li><li>two</li></ul>'
+    html += '</ul>'
+    assert str(html) == '<ul><li>one</li><li>two</li></ul>'
+
+def test_html_buffer_joins_lazily():
+    html = HTMLBuffer()
+    for i in range(100000):
+        html += '<li>'+str(i)+'</li>'
+    #The pieces are only joined (once) when the HTML is used
+    assert len(html.parts) == 100001
+    text = str(html)
+    assert len(html.parts) == 1
+    assert text.startswith('<li>0</li><li>1</li>') and text.endswith('<li>99999</li>')
+
+def test_html_spool_writes_to_a_file():
+    html = HTMLSpool('<ul>', max_size=16)
+    for i in range(1000):
+        html += '<li>\u00e9\r\n'+str(i)+'</li>'
+    #It no longer fits in max_size, so it is on disk
+    assert html.file._rolled
+    expected = '<ul>' + ''.join('<li>\u00e9\r\n'+str(i)+'</li>' for i in range(1000))
+    assert str(html) == expected
+    f = BytesIO()
+    html.write_to(f, chunk_size=100)
+    assert f.getvalue() == expected.encode('utf-8')
+    #It can still be added to after being read
+    html += '</ul>'
+    assert '<html>' + html == '<html>' + expected + '</ul>'
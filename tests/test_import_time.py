@@ -0,0 +1,35 @@
+"""Checks that importing BlackboardQuiz stays fast, i.e., that the heavy
+dependencies are only imported when they are used.
+"""
+import os
+import re
+import subprocess
+import sys
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#The import of BlackboardQuiz itself (including lxml) should take well
+#under this, in microseconds
+IMPORT_BUDGET_US = 500000
+
+HEAVY_MODULES = ['sympy', 'scipy', 'scipy.stats', 'PIL.Image', 'bs4', 'latex2mathml', 'yaml', 'pyarrow', 'numpy', 'asyncio']
+
+def test_import_time():
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import BlackboardQuiz'], cwd=repo, capture_output=True, text=True, check=True)
+    cumulative = None
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \| BlackboardQuiz$', line)
+        if match:
+            cumulative = int(match.group(1))
+    assert cumulative is not None
+    assert cumulative < IMPORT_BUDGET_US, "importing BlackboardQuiz took "+str(cumulative)+"us"
+
+def test_heavy_modules_are_lazy():
+    code = 'import sys, BlackboardQuiz; print(",".join(name for name in '+repr(HEAVY_MODULES)+' if name in sys.modules))'
+    result = subprocess.run([sys.executable, '-c', code], cwd=repo, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == ''
+
+def test_scipy_stats_attribute():
+    code = 'import BlackboardQuiz; print(BlackboardQuiz.scipy.stats.norm.__class__.__name__)'
+    result = subprocess.run([sys.executable, '-c', code], cwd=repo, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == 'norm_gen'
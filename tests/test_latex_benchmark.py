@@ -0,0 +1,60 @@
+"""Compares the png and svg LaTeX backends: the time each takes to
+render a set of formulas, that they give the same image sizes, and
+the size of the images and of the packages they make. Needs latex,
+dvipng and dvisvgm, and is skipped without them.
+"""
+import os
+import shutil
+import time
+import zipfile
+
+import pytest
+
+import BlackboardQuiz
+
+formulas = [
+    (r'x^2', False),
+    (r'\frac{x^{n+1}}{n+1}', False),
+    (r'\int_0^\infty e^{-x^2}\,dx = \frac{\sqrt{\pi}}{2}', True),
+    (r'\sum_{k=1}^{n} k = \frac{n(n+1)}{2}', True),
+    (r'\mathbf{F} = m\mathbf{a}', False),
+] * 4
+
+pytestmark = pytest.mark.skipif(not all(shutil.which(tool) for tool in ('latex', 'dvipng', 'dvisvgm')), reason="needs latex, dvipng and dvisvgm")
+
+def render_all(image_format):
+    with BlackboardQuiz.LatexRenderer(image_format=image_format) as renderer:
+        start = time.perf_counter()
+        sizes = [renderer.render(formula, display)[1:] for formula, display in formulas]
+        return time.perf_counter() - start, sizes
+
+def test_png_svg_benchmark():
+    png_time, png_sizes = render_all('png')
+    svg_time, svg_sizes = render_all('svg')
+    print("\npng: {:.1f}ms per formula, svg: {:.1f}ms per formula".format(1000 * png_time / len(formulas), 1000 * svg_time / len(formulas)))
+    #The svg sizes are scaled to match the pngs (to within the
+    #pixel rounding and the bounding box dvipng trims to)
+    for (png_width, png_height), (svg_width, svg_height) in zip(png_sizes, svg_sizes):
+        assert abs(png_width - svg_width) <= 2
+        assert abs(png_height - svg_height) <= 2
+
+def package_sizes(latex_mode):
+    """Builds a package of the formulas, and returns the total size of
+    its images and the size of the package (both in bytes).
+    """
+    with BlackboardQuiz.Package(latex_mode, latex_mode=latex_mode) as package:
+        for formula, display in formulas:
+            package.embed_latex(formula, display)
+    with zipfile.ZipFile(latex_mode+'.zip') as zf:
+        image_bytes = sum(info.file_size for info in zf.infolist() if info.filename.endswith('.'+latex_mode))
+    return image_bytes, os.path.getsize(latex_mode+'.zip')
+
+def test_png_svg_package_size(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    png_images, png_package = package_sizes('png')
+    svg_images, svg_package = package_sizes('svg')
+    print("\npng: {} bytes of images, {} byte package; svg: {} bytes of images, {} byte package".format(png_images, png_package, svg_images, svg_package))
+    assert png_images > 0 and svg_images > 0
+    #The svgs are text, so they shrink a lot in the zip, and the svg
+    #package should be the smaller of the two
+    assert svg_package < png_package
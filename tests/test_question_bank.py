@@ -0,0 +1,79 @@
+"""Checks that questions put into a QuestionBank come back out (with
+their images and previews) as they went in, that adding a package twice
+doesn't duplicate them, and that addFromBank leaves the pool's quiet
+setting as it was.
+"""
+import os
+import zipfile
+
+import pytest
+
+import BlackboardQuiz
+
+def build_source(directory):
+    """Builds a package with an image and previews, and a bank of it."""
+    os.makedirs(directory)
+    os.chdir(directory)
+    with open('dot.png', 'wb') as f:
+        f.write(b'not really a png')
+    with BlackboardQuiz.Package('Source', seed=1) as package:
+        with package.createPool('Old', preview=True) as pool:
+            pool.addMCQ('Picture', 'What is this? <img src="dot.png">', ['A dot', 'A line'], correct=0)
+            for i in range(3):
+                pool.addNumQ('Old '+str(i), 'What is '+str(i)+'+1?', i + 1, erramt=0.1)
+    with BlackboardQuiz.QuestionBank('questions.db') as bank:
+        assert bank.add_package('Source.zip', tags=['week1']) == 4
+    return os.path.join(directory, 'Source.zip'), os.path.join(directory, 'questions.db')
+
+def package_items(filename):
+    """The titles, question text and previews of the items in a package,
+    and the embedded files they use (by their original name).
+    """
+    with BlackboardQuiz.PackageReader(filename) as reader:
+        items = [(item.title, item.text, item.html) for pool in reader.pools() for item in pool.items()]
+        files = {reader.original_name(path):reader.zf.read(path) for path in reader.embedded_files.values()}
+    return items, files
+
+def test_add_twice(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    source, bank_file = build_source(str(tmp_path / 'source'))
+    with BlackboardQuiz.QuestionBank(bank_file) as bank:
+        capsys.readouterr()
+        assert bank.add_package(source, tags=['week2']) == 0
+        assert "Skipped 4 questions already in the bank" in capsys.readouterr().out
+        assert bank.count() == 4
+        #They are only given the new tag
+        assert bank.count(tags=['week1', 'week2']) == 4
+        assert bank.count(qtype='Numeric') == 3
+        assert bank.db.execute('SELECT COUNT(*) FROM assets').fetchone()[0] == 1
+
+@pytest.mark.parametrize('kwargs', [{}, {'deferred':True}, {'build_cache':True}])
+def test_round_trip(tmp_path, monkeypatch, kwargs):
+    monkeypatch.chdir(tmp_path)
+    source, bank_file = build_source(str(tmp_path / 'source'))
+    if kwargs.get('build_cache'):
+        kwargs = {'build_cache':BlackboardQuiz.BuildCache(str(tmp_path / 'cache'))}
+    os.makedirs(str(tmp_path / 'new'))
+    os.chdir(str(tmp_path / 'new'))
+    with BlackboardQuiz.QuestionBank(bank_file) as bank:
+        with BlackboardQuiz.Package('New', seed=2, **kwargs) as package:
+            with package.createPool('Old', preview=True) as pool:
+                assert pool.addFromBank(bank, tags=['week1']) == 4
+    old_items, old_files = package_items(source)
+    new_items, new_files = package_items('New.zip')
+    assert new_items == old_items
+    assert list(new_files.values()) == list(old_files.values()) == [b'not really a png']
+    assert BlackboardQuiz.verify_package('New.zip') == []
+
+@pytest.mark.parametrize('quiet', [False, True])
+def test_add_from_bank_quiet(tmp_path, monkeypatch, capsys, quiet):
+    monkeypatch.chdir(tmp_path)
+    source, bank_file = build_source(str(tmp_path / 'source'))
+    capsys.readouterr()
+    with BlackboardQuiz.QuestionBank(bank_file) as bank:
+        with BlackboardQuiz.Package('New', seed=2) as package:
+            with package.createPool('Pool') as pool:
+                pool.quiet = quiet
+                assert pool.addFromBank(bank, qtype='Numeric') == 3
+                assert pool.quiet == quiet
+    assert ("Added 3 questions from "+repr(bank_file) in capsys.readouterr().out) != quiet
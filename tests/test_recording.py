@@ -0,0 +1,89 @@
+"""Checks that pools which record their questions (with a build cache,
+or in a deferred package) build the same questions as a pool which
+builds them straight away, including questions which can't be
+recorded (items from another package or a question bank).
+"""
+import os
+import zipfile
+
+import BlackboardQuiz
+
+def build_source(directory):
+    """Builds a package to read items back from, and a question bank of it."""
+    os.makedirs(directory)
+    os.chdir(directory)
+    with BlackboardQuiz.Package('Source', seed=1) as package:
+        with package.createPool('Old', preview=True) as pool:
+            for i in range(3):
+                pool.addNumQ('Old '+str(i), 'What is '+str(i)+'+1?', i + 1, erramt=0.1)
+    with BlackboardQuiz.QuestionBank('questions.db') as bank:
+        bank.add_package('Source.zip')
+    return os.path.join(directory, 'Source.zip'), os.path.join(directory, 'questions.db')
+
+def build(directory, source, bank_file, **kwargs):
+    """Builds a package mixing new questions with ones from the source
+    package and the bank, and returns its entries.
+    """
+    os.makedirs(directory)
+    os.chdir(directory)
+    with BlackboardQuiz.PackageReader(source) as reader, BlackboardQuiz.QuestionBank(bank_file) as bank:
+        with BlackboardQuiz.Package('Mixed', seed=2, **kwargs) as package:
+            with package.createPool('Items', preview=True) as pool:
+                pool.addMCQ('Before', 'Pick one', ['a', 'b'], correct=1)
+                for old_pool in reader.pools():
+                    for item in old_pool.items():
+                        pool.addItem(item)
+                pool.addNumQ('After', 'What is 2+2?', 4, erramt=0.1)
+            with package.createPool('Bank', preview=True) as pool:
+                pool.addFromBank(bank)
+                pool.addTFQ('Last', 'True?', True)
+            with package.createPool('New', preview=True) as pool:
+                pool.addNumQ('New', 'What is 3+3?', 6, erramt=0.1)
+    with zipfile.ZipFile('Mixed.zip') as zf:
+        return {name:zf.read(name) for name in zf.namelist()}
+
+def test_items_with_build_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    source, bank_file = build_source(str(tmp_path / 'source'))
+    eager = build(str(tmp_path / 'eager'), source, bank_file)
+    cache = BlackboardQuiz.BuildCache(str(tmp_path / 'cache'))
+    cold = build(str(tmp_path / 'cold'), source, bank_file, build_cache=cache)
+    warm = build(str(tmp_path / 'warm'), source, bank_file, build_cache=cache)
+    assert cold == eager
+    assert warm == eager
+
+def test_items_deferred(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    source, bank_file = build_source(str(tmp_path / 'source'))
+    eager = build(str(tmp_path / 'eager'), source, bank_file)
+    assert build(str(tmp_path / 'deferred'), source, bank_file, deferred=True) == eager
+
+def build_new(directory, **kwargs):
+    """Builds a package of new questions (of every type, some added
+    with add_many, and some paged) and returns its entries.
+    """
+    os.makedirs(directory)
+    os.chdir(directory)
+    with BlackboardQuiz.Package('New', seed=3, **kwargs) as package:
+        with package.createPool('Loose', preview=True) as pool:
+            pool.addNumQ('Num', 'What is 1+1?', 2, errfrac=0.1)
+            pool.addMCQ('MCQ', 'Pick <i>one</i>', ['a', 'b', 'c'], correct=2)
+            pool.addMAQ('MAQ', 'Pick some', ['a', 'b', 'c'], correct=[0, 2])
+            pool.addSRQ('SRQ', 'Say something', 'Anything')
+            pool.addTFQ('TFQ', 'True?', False)
+            pool.addOQ('OQ', 'Order these', ['1', '2', '3'])
+            pool.addMQ('MQ', 'Match these', [['a', '1'], ['b', '2']], unmatched=['x'])
+            pool.addFITBQ('FITBQ', 'The answer is [x]', {'x':['42']})
+        with package.createPool('Many', preview=True) as pool:
+            pool.add_many({'type':'MCQ', 'title':'M'+str(i), 'text':'Pick '+str(i), 'answers':[str(i), 'b'], 'correct':i % 2} for i in range(30))
+        with package.createTest('Test', preview=True) as test:
+            with test.createPool('In test', preview=True) as pool:
+                for i in range(5):
+                    pool.addNumQ('T'+str(i), 'What is '+str(i)+'+1?', i + 1, erramt=0.1)
+    with zipfile.ZipFile('New.zip') as zf:
+        return {name:zf.read(name) for name in zf.namelist()}
+
+def test_deferred_matches_eager(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert build_new(str(tmp_path / 'deferred'), deferred=True) == build_new(str(tmp_path / 'eager'))
+    assert build_new(str(tmp_path / 'paged deferred'), deferred=True, preview_page_size=4) == build_new(str(tmp_path / 'paged'), preview_page_size=4)
@@ -0,0 +1,44 @@
+"""Checks that pools with max_items/max_bytes are split into several
+pools, and that pools in a test refuse to be split.
+"""
+import pytest
+
+import BlackboardQuiz
+
+def shard_sizes(filename):
+    with BlackboardQuiz.PackageReader(filename) as reader:
+        return {pool.title:len(list(pool.items())) for pool in reader.pools()}
+
+def test_max_items(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with BlackboardQuiz.Package('Sharded', seed=1) as package:
+        with package.createPool('Generated', max_items=100) as pool:
+            for i in range(250):
+                pool.addNumQ('Q'+str(i), 'What is '+str(i)+'+1?', i + 1, erramt=0.1)
+        #Templated questions are split the same way
+        with package.createPool('Many', max_items=100) as pool:
+            pool.add_many({'type':'MCQ', 'title':'M'+str(i), 'text':'Pick '+str(i), 'answers':['a', 'b'], 'correct':i % 2} for i in range(150))
+    assert shard_sizes('Sharded.zip') == {'Generated (1)':100, 'Generated (2)':100, 'Generated (3)':50, 'Many (1)':100, 'Many (2)':50}
+    assert BlackboardQuiz.verify_package('Sharded.zip') == []
+
+def test_max_bytes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with BlackboardQuiz.Package('Sharded', seed=1) as package:
+        with package.createPool('Generated', max_bytes=20000) as pool:
+            for i in range(100):
+                pool.addNumQ('Q'+str(i), 'What is '+str(i)+'+1?', i + 1, erramt=0.1)
+    sizes = shard_sizes('Sharded.zip')
+    assert len(sizes) > 1
+    assert sum(sizes.values()) == 100
+    assert BlackboardQuiz.verify_package('Sharded.zip') == []
+
+def test_no_shards_in_a_test(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with BlackboardQuiz.Package('Sharded') as package:
+        with package.createTest('Test') as test:
+            #This is refused straight away, not once the pool fills up
+            with pytest.raises(ValueError):
+                test.createPool('Generated', max_items=100)
+            with test.createPool('Whole') as pool:
+                pool.addNumQ('Q', 'What is 1+1?', 2, erramt=0.1)
+    assert BlackboardQuiz.verify_package('Sharded.zip') == []
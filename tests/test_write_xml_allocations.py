@@ -0,0 +1,41 @@
+"""Checks that XML is streamed into the package, rather than serialized
+into one big string first.
+"""
+import tracemalloc
+import zipfile
+
+from lxml import etree
+
+import BlackboardQuiz
+
+def big_tree(count=20000):
+    root = etree.Element('questestinterop')
+    section = etree.SubElement(root, 'section')
+    for i in range(count):
+        item = etree.SubElement(section, 'item', {'ident':format(i, '032x'), 'title':'Question '+str(i)})
+        etree.SubElement(item, 'mat_formattedtext', {'type':'HTML'}).text = '<p>What is '+str(i)+' + '+str(i)+'? (&eacute; &plusmn;)</p>'
+    return root
+
+def test_write_xml_allocations(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    root = big_tree()
+    size = len(etree.tostring(root))
+    with BlackboardQuiz.Package('Allocations') as package:
+        tracemalloc.start()
+        try:
+            package.write_xml('big.xml', root)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    #Only a chunk of the document should ever be held in memory
+    assert peak < size / 10, "writing "+str(size)+" bytes of XML peaked at "+str(peak)+" bytes"
+
+def test_write_xml_matches_tostring(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    root = big_tree(10)
+    etree.SubElement(root, 'text').text = 'Non-ASCII: é ± μ'
+    with BlackboardQuiz.Package('Bytes') as package:
+        package.write_xml('small.xml', root)
+    with zipfile.ZipFile('Bytes.zip') as zf:
+        data = zf.read('small.xml')
+    assert data == b'<?xml version="1.0" encoding="UTF-8"?>\n' + etree.tostring(root)